@@ -101,6 +101,7 @@ Provides formulas for Prometheus exporters and Grafana dashboards configuration.
 %install
 %pyproject_install
 %python_clone -a %{buildroot}%{_bindir}/salined
+%python_clone -a %{buildroot}%{_bindir}/saline-bench
 %python_expand %fdupes %{buildroot}%{$python_sitelib}
 
 install -Dpm 0644 salined.service %{buildroot}%{_unitdir}/salined.service
@@ -143,7 +144,7 @@ cp -a formulas/states/* %{buildroot}%{salt_formulas_dir}/states/
 %python_libalternatives_reset_alternative salined
 
 %post -n python-saline
-%python_install_alternative salined
+%python_install_alternative salined saline-bench
 
 %postun -n python-saline
 %python_uninstall_alternative salined
@@ -176,6 +177,7 @@ cp -a formulas/states/* %{buildroot}%{salt_formulas_dir}/states/
 %license LICENSE
 %defattr(-,root,root,-)
 %python_alternative %{_bindir}/salined
+%python_alternative %{_bindir}/saline-bench
 %{python_sitelib}/saline*
 
 %changelog
@@ -0,0 +1,173 @@
+"""
+Synthetic Salt events for the benchmarks
+
+Generates the raw events as published by the Salt Master
+with the mix of the tags close to the real fleets: the jobs targeting
+the part of the fleet followed by the returns of the targeted minions,
+interleaved with the authentication, minion start and refresh events.
+"""
+
+import random
+
+from copy import deepcopy
+from datetime import datetime, timezone
+from itertools import islice
+from time import time
+
+
+# The functions of the jobs with the weights
+JOB_FUNCS = (
+    ("state.apply", 4),
+    ("test.ping", 3),
+    ("cmd.run", 2),
+    ("grains.items", 1),
+)
+
+# The sizes of the targets with the weights, None is the whole fleet
+JOB_TARGETS = (
+    (1, 4),
+    (10, 3),
+    (100, 2),
+    (None, 1),
+)
+
+# The part of the events not related to the jobs
+NOISE_RATIO = 0.1
+
+# The noise events templates with the weights
+NOISE_EVENTS = (
+    ("salt/auth", 5),
+    ("minion/refresh/%s", 3),
+    ("salt/minion/%s/start", 1),
+    ("salt/stats/master", 1),
+)
+
+STATE_MODULES = (
+    ("pkg", "installed"),
+    ("file", "managed"),
+    ("service", "running"),
+    ("cmd", "run"),
+    ("user", "present"),
+)
+
+
+def get_stamp(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def get_minions(count):
+    return ["minion-%06d.example.org" % i for i in range(count)]
+
+
+def get_state_return(states, rnd=None, fail_ratio=0.05):
+    """
+    Get the return of ``state.apply`` with the number of the states specified
+    """
+
+    if rnd is None:
+        rnd = random.Random(0)
+    ret = {}
+    for i in range(states):
+        mod, fun = STATE_MODULES[i % len(STATE_MODULES)]
+        sls = "formula%d.sls%d" % (i // 100, i // 10 % 10)
+        sid = "%s_state_%d" % (mod, i)
+        name = "/etc/formula%d/file%d.conf" % (i // 100, i) if mod == "file" else sid
+        result = rnd.random() >= fail_ratio
+        ret["%s_|-%s_|-%s_|-%s" % (mod, sid, name, fun)] = {
+            "name": name,
+            "changes": {"diff": "New file"} if rnd.random() < 0.1 else {},
+            "result": result,
+            "comment": "State was applied" if result else "State failed",
+            "__sls__": sls,
+            "__run_num__": i,
+            "start_time": "12:00:00.000000",
+            "duration": rnd.random() * 100,
+            "__id__": sid,
+        }
+    return ret
+
+
+def _get_weighted(items):
+    values = []
+    for value, weight in items:
+        values.extend([value] * weight)
+    return values
+
+
+def iter_events(minions=1000, states=100, seed=0, ts=None, realtime=False):
+    """
+    Iterate over the endless stream of the raw events as (tag, data) tuples
+
+    The targets list of the fleet is shared by the job events
+    and the state returns are copied from the same template
+    to keep the generating cheap on the huge fleets and returns.
+    The events are stamped with the current time if realtime is set.
+    """
+
+    rnd = random.Random(seed)
+    fleet = get_minions(minions)
+    funcs = _get_weighted(JOB_FUNCS)
+    targets = _get_weighted(JOB_TARGETS)
+    noise = _get_weighted(NOISE_EVENTS)
+    state_return = get_state_return(states, rnd)
+    ts = datetime.now(timezone.utc).timestamp() if ts is None else ts
+    jid = int(datetime.fromtimestamp(ts, timezone.utc).strftime("%Y%m%d%H%M%S%f"))
+
+    while True:
+        jid += 1
+        fun = rnd.choice(funcs)
+        target = rnd.choice(targets)
+        if target is None or target >= minions:
+            job_minions = fleet
+        else:
+            start = rnd.randrange(minions - target + 1)
+            job_minions = fleet[start : start + target]
+        fun_args = ["test=True"] if fun == "state.apply" and rnd.random() < 0.1 else []
+        ts = time() if realtime else ts
+        yield (
+            "salt/job/%d/new" % jid,
+            {
+                "jid": str(jid),
+                "tgt": job_minions[0] if len(job_minions) == 1 else "*",
+                "tgt_type": "glob",
+                "user": "root",
+                "fun": fun,
+                "arg": fun_args,
+                "minions": job_minions,
+                "_stamp": get_stamp(ts),
+            },
+        )
+        for minion in job_minions:
+            ts = time() if realtime else ts + 0.001
+            if rnd.random() < NOISE_RATIO:
+                tag = rnd.choice(noise)
+                if "%s" in tag:
+                    tag = tag % rnd.choice(fleet)
+                yield (tag, {"id": rnd.choice(fleet), "_stamp": get_stamp(ts)})
+            if fun == "state.apply":
+                ret = deepcopy(state_return)
+            elif fun == "grains.items":
+                ret = {"id": minion, "os": "SUSE", "osrelease": "15.6"}
+            else:
+                ret = True
+            yield (
+                "salt/job/%d/ret/%s" % (jid, minion),
+                {
+                    "jid": str(jid),
+                    "id": minion,
+                    "fun": fun,
+                    "fun_args": fun_args,
+                    "return": ret,
+                    "retcode": 0,
+                    "success": True,
+                    "_stamp": get_stamp(ts),
+                },
+            )
+
+
+def generate_events(count, minions=1000, states=100, seed=0, ts=None):
+    """
+    Generate the list of the raw events as (tag, data) tuples
+    """
+
+    return list(islice(iter_events(minions, states, seed, ts), count))
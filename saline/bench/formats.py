@@ -0,0 +1,116 @@
+"""
+Benchmark of the exposition formats against the number of series
+
+Measures the rendering of the series table to each of the formats,
+the size of the rendered exposition and the parsing of it.
+The text formats are parsed with prometheus_client if it's installed,
+the protobuf exposition is only split into the length delimited messages.
+
+Run with: python -m saline.bench.formats [series count ...]
+"""
+
+import sys
+
+from time import perf_counter
+
+from saline.bench.render import get_collection
+from saline.data.exposition import (
+    FORMAT_NAMES,
+    FORMAT_OPENMETRICS,
+    FORMAT_PROTOBUF,
+    FORMAT_TEXT,
+    MetricsTable,
+)
+
+try:
+    from prometheus_client.openmetrics.parser import (
+        text_string_to_metric_families as openmetrics_parser,
+    )
+    from prometheus_client.parser import (
+        text_string_to_metric_families as text_parser,
+    )
+
+    HAS_PROMETHEUS_CLIENT = True
+except ImportError:
+    HAS_PROMETHEUS_CLIENT = False
+
+DEFAULT_SERIES = (10000, 100000)
+
+
+def split_protobuf(buf):
+    """
+    Split the length delimited messages without decoding them
+    """
+
+    pos = 0
+    count = 0
+    while pos < len(buf):
+        length = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            length |= (b & 0x7F) << shift
+            shift += 7
+            if b < 0x80:
+                break
+        pos += length
+        count += 1
+    return count
+
+
+def parse(buf, fmt):
+    if fmt == FORMAT_PROTOBUF:
+        return split_protobuf(buf)
+    if not HAS_PROMETHEUS_CLIENT:
+        return None
+    parser = openmetrics_parser if fmt == FORMAT_OPENMETRICS else text_parser
+    return sum(len(family.samples) for family in parser(buf))
+
+
+def bench_formats(count):
+    table = MetricsTable()
+    table.apply_snapshot(1, get_collection(count).get_snapshot())
+
+    res = {}
+    for fmt in (FORMAT_TEXT, FORMAT_OPENMETRICS, FORMAT_PROTOBUF):
+        start = perf_counter()
+        buf = table.get_buf(fmt=fmt)
+        render = perf_counter() - start
+
+        start = perf_counter()
+        parsed = parse(buf, fmt)
+        parse_time = perf_counter() - start
+
+        res[fmt] = {
+            "size": len(buf),
+            "render": render,
+            "parse": parse_time if parsed is not None else None,
+        }
+    return res
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    counts = [int(x) // 2 for x in args] if args else [x // 2 for x in DEFAULT_SERIES]
+    print(
+        "%10s %12s %12s %12s %12s"
+        % ("series", "format", "size KiB", "render ms", "parse ms")
+    )
+    for count in counts:
+        for fmt, res in bench_formats(count).items():
+            print(
+                "%10d %12s %12d %12.3f %12s"
+                % (
+                    count * 2,
+                    FORMAT_NAMES[fmt],
+                    res["size"] // 1024,
+                    res["render"] * 1000,
+                    "-" if res["parse"] is None else "%.3f" % (res["parse"] * 1000),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Micro-benchmarks of the hot paths of the events pipeline
+
+Measures the tag matching, the events parsing, merging the parsed events,
+generating the rename rules and rendering the metrics on the synthetic events
+of the fleets and the highstate returns of the different sizes.
+Each benchmark is run twice: to measure the time and with tracemalloc
+to measure the peak of the memory allocated while running.
+The results can be saved to JSON and compared with the previous run.
+
+Run with: python -m saline.bench.hotpaths [--quick] [--output FILE]
+          [--compare FILE] [--label LABEL] [benchmark ...]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+
+from time import perf_counter, time
+
+from saline.bench.events import generate_events
+from saline.bench.render import get_collection
+from saline.data.event import EventParser
+from saline.data.merger import DataMerger
+from saline.data.parser import get_tag_mask
+from saline.data.smart import SmartMerger
+
+
+# The parameters of each benchmark in the full and the quick runs
+DEFAULT_PARAMS = {
+    "tag_mask": ([{"events": 100000}], [{"events": 10000}]),
+    "parse": (
+        [{"states": x, "events": max(200000 // x, 20)} for x in (10, 100, 1000, 5000)],
+        [{"states": x, "events": max(20000 // x, 5)} for x in (10, 100, 1000)],
+    ),
+    "merge": (
+        [{"minions": x, "states": 50, "events": 20000} for x in (100, 1000, 50000)],
+        [{"minions": x, "states": 50, "events": 2000} for x in (100, 1000)],
+    ),
+    "smart_rules": (
+        [{"items": x} for x in (50, 100, 200)],
+        [{"items": x} for x in (50,)],
+    ),
+    "metrics_buf": (
+        [{"series": x} for x in (1000, 10000, 100000)],
+        [{"series": x} for x in (1000, 10000)],
+    ),
+}
+
+
+def setup_tag_mask(events):
+    tags = [tag for tag, _ in generate_events(events)]
+
+    def run():
+        for tag in tags:
+            get_tag_mask(tag, return_all=True, return_minion_id=True)
+
+    return run, len(tags)
+
+
+def setup_parse(states, events):
+    raw = generate_events(events, states=states)
+    parser = EventParser({})
+
+    def run():
+        for tag, data in raw:
+            parser.parse(tag, data)
+
+    return run, len(raw)
+
+
+def setup_merge(minions, states, events):
+    parser = EventParser({})
+    parsed = [
+        parser.parse(tag, data)
+        for tag, data in generate_events(events, minions=minions, states=states)
+    ]
+    parsed = [data for data in parsed if data is not None]
+    datamerger = DataMerger({})
+
+    def run():
+        for data in parsed:
+            datamerger.add(data)
+
+    return run, len(parsed)
+
+
+def setup_smart_rules(items):
+    # The state IDs with the variable parts making the metrics grow
+    values = [
+        "pkg_%s_installed_%d" % (("kernel", "python3", "salt")[i % 3], i * 7919)
+        for i in range(items)
+    ]
+    smart_merger = SmartMerger(items + 1, data=values)
+
+    def run():
+        smart_merger.get_new_rules()
+
+    return run, 1
+
+
+def setup_metrics_buf(series):
+    metrics = get_collection(series // 2)
+
+    def run():
+        metrics.get_buf()
+
+    return run, 1
+
+
+BENCHMARKS = {
+    "tag_mask": setup_tag_mask,
+    "parse": setup_parse,
+    "merge": setup_merge,
+    "smart_rules": setup_smart_rules,
+    "metrics_buf": setup_metrics_buf,
+}
+
+
+def run_benchmark(name, params, memory=True):
+    """
+    Run the benchmark with the parameters specified
+    """
+
+    setup = BENCHMARKS[name]
+    run, calls = setup(**params)
+    start = perf_counter()
+    run()
+    seconds = perf_counter() - start
+    res = {
+        "name": name,
+        "params": params,
+        "calls": calls,
+        "seconds": seconds,
+        "us_per_call": seconds * 1e6 / calls,
+        "calls_per_second": calls / seconds if seconds else None,
+        "peak_bytes": None,
+    }
+    if memory:
+        # The benchmark is set up again as the runs can change the data
+        run, _ = setup(**params)
+        tracemalloc.start()
+        try:
+            run()
+            res["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return res
+
+
+def get_key(res):
+    return "%s %s" % (
+        res["name"],
+        " ".join("%s=%s" % (k, v) for k, v in sorted(res["params"].items())),
+    )
+
+
+def compare(results, baseline):
+    """
+    Get the relative changes of the time per call and the peak memory
+    of the results against the baseline results
+    """
+
+    base = {get_key(res): res for res in baseline["results"]}
+    changes = {}
+    for res in results:
+        key = get_key(res)
+        if key not in base:
+            continue
+        change = {
+            "us_per_call": res["us_per_call"] / base[key]["us_per_call"] - 1,
+            "peak_bytes": None,
+        }
+        if res["peak_bytes"] and base[key]["peak_bytes"]:
+            change["peak_bytes"] = res["peak_bytes"] / base[key]["peak_bytes"] - 1
+        changes[key] = change
+    return changes
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog="python -m saline.bench.hotpaths")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="The benchmarks to run: %s, all by default" % ", ".join(BENCHMARKS),
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="Run with the smaller sizes"
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Skip measuring the peak memory"
+    )
+    parser.add_argument("--output", help="Save the results to the JSON file")
+    parser.add_argument("--compare", help="Compare with the results in the JSON file")
+    parser.add_argument("--label", help="The label of the run saved with the results")
+    args = parser.parse_args(args)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark '%s'" % name)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    results = []
+    print(
+        "%-40s %10s %12s %12s %12s"
+        % ("benchmark", "calls", "us/call", "calls/s", "peak KiB")
+    )
+    for name in args.benchmarks or BENCHMARKS:
+        for params in DEFAULT_PARAMS[name][1 if args.quick else 0]:
+            res = run_benchmark(name, params, memory=not args.no_memory)
+            results.append(res)
+            print(
+                "%-40s %10d %12.3f %12.1f %12s"
+                % (
+                    get_key(res),
+                    res["calls"],
+                    res["us_per_call"],
+                    res["calls_per_second"] or 0,
+                    "-" if res["peak_bytes"] is None else res["peak_bytes"] // 1024,
+                )
+            )
+
+    report = {
+        "label": args.label,
+        "timestamp": time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if baseline is not None:
+        changes = compare(results, baseline)
+        print()
+        print("Compared with %s" % (baseline.get("label") or args.compare))
+        print("%-40s %12s %12s" % ("benchmark", "us/call", "peak"))
+        for key, change in changes.items():
+            print(
+                "%-40s %+11.1f%% %12s"
+                % (
+                    key,
+                    change["us_per_call"] * 100,
+                    (
+                        "-"
+                        if change["peak_bytes"] is None
+                        else "%+.1f%%" % (change["peak_bytes"] * 100)
+                    ),
+                )
+            )
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
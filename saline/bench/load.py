@@ -0,0 +1,526 @@
+"""
+End-to-end load generator of the Saline processes
+
+Publishes the synthetic or recorded events on the local IPC socket
+the Saline Events Manager subscribes to instead of the Salt Master event bus
+and measures with scraping the metrics of the running Saline:
+the sustained throughput of the pipeline, the latency from publishing
+the event to counting it in the metrics and the CPU usage and RSS
+of each of the Saline processes. The rates are run one after another
+to find the saturation point of the Saline configuration.
+
+The Salt Master must be stopped as the socket of its event bus is used.
+
+Run with: saline-bench [--rate EPS ...] [--duration SEC] [--events FILE]
+"""
+
+import argparse
+import json
+import os
+import queue
+import re
+import socket
+import ssl
+import sys
+import urllib.request
+
+from itertools import cycle
+from threading import Thread
+from time import sleep, time
+
+import salt.config
+import salt.ext.tornado.gen
+import salt.syspaths
+import salt.utils.jid
+
+from salt.ext.tornado.ioloop import IOLoop
+from salt.transport.ipc import IPCMessagePublisher
+from salt.utils.event import get_event
+
+from saline.bench.events import get_stamp, iter_events
+
+
+DEFAULT_RATES = (1000,)
+
+# The function of the marker jobs to measure the latency with
+MARKER_FUN = "saline.bench_marker"
+
+# The interval of publishing the events in seconds
+PUBLISH_TICK = 0.01
+
+# The max number of the events published in one tick
+PUBLISH_BATCH = 10000
+
+# The number of the events packed in advance
+PACKED_QUEUE_SIZE = 10000
+
+METRIC_LINE_RE = re.compile(r"^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)")
+METRIC_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(buf, names):
+    """
+    Parse the metrics in the text exposition format
+    to the values by the names and the labels sorted
+    """
+
+    res = {name: {} for name in names}
+    for line in buf.splitlines():
+        if not line or line[0] == "#":
+            continue
+        match = METRIC_LINE_RE.match(line)
+        if match is None or match.group(1) not in res:
+            continue
+        labels = tuple(sorted(METRIC_LABEL_RE.findall(match.group(2) or "")))
+        try:
+            res[match.group(1)][labels] = float(match.group(3))
+        except ValueError:
+            pass
+    return res
+
+
+def load_events(path):
+    """
+    Load the recorded events as printed by ``salt-run state.event``
+    with the tag and the JSON data separated with the tab
+    or the JSON objects with the tag and the data per line
+    """
+
+    events = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                event = json.loads(line)
+                events.append((event["tag"], event["data"]))
+            else:
+                tag, data = line.split("\t", 1)
+                events.append((tag, json.loads(data)))
+    return events
+
+
+def iter_recorded(events):
+    """
+    Iterate over the recorded events endlessly stamped with the current time
+    """
+
+    for tag, data in cycle(events):
+        data = dict(data)
+        data["_stamp"] = get_stamp(time())
+        yield tag, data
+
+
+class MetricsScraper:
+    """
+    The scraper of the metrics groups of the REST API of Saline
+    """
+
+    def __init__(self, url, insecure=False, timeout=5):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._context = None
+        if self.url.startswith("https:"):
+            self._context = ssl.create_default_context()
+            if insecure:
+                self._context.check_hostname = False
+                self._context.verify_mode = ssl.CERT_NONE
+
+    def scrape(self, group, names):
+        with urllib.request.urlopen(
+            "%s/metrics/%s" % (self.url, group),
+            timeout=self.timeout,
+            context=self._context,
+        ) as resp:
+            return parse_metrics(resp.read().decode(), names)
+
+
+class LoadStep:
+    """
+    The measurements of running the load with the rate
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = None
+        self.end = None
+        self.published = 0
+        self.latencies = []
+        self.lost_markers = 0
+        self.first = None
+        self.last = None
+        self.rss = {}
+
+    def add_sample(self, sample):
+        if self.first is None:
+            self.first = sample
+        self.last = sample
+        for process, rss in sample["rss"].items():
+            self.rss[process] = max(self.rss.get(process, 0), rss)
+
+    def get_report(self):
+        duration = self.end - self.start
+        res = {
+            "rate": self.rate,
+            "duration": duration,
+            "published": self.published,
+            "published_rate": self.published / duration,
+            "merged_rate": None,
+            "dropped": None,
+            "latency": None,
+            "lost_markers": self.lost_markers,
+            "processes": {},
+        }
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            res["latency"] = {
+                "min": latencies[0],
+                "p50": latencies[len(latencies) // 2],
+                "p99": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+                "max": latencies[-1],
+            }
+        if self.first is None or self.last is self.first:
+            return res
+        first, last = self.first, self.last
+        elapsed = last["ts"] - first["ts"]
+        res["merged_rate"] = (last["merged"] - first["merged"]) / elapsed
+        res["dropped"] = last["dropped"] - first["dropped"]
+        for process, cpu in last["cpu"].items():
+            res["processes"][process] = {
+                "cpu": (cpu - first["cpu"].get(process, cpu)) / elapsed,
+                "rss": self.rss.get(process),
+            }
+        return res
+
+
+class LoadGenerator:
+    """
+    The stand-in of the Salt Master event bus publishing the events
+    with the rate specified
+    """
+
+    def __init__(
+        self,
+        mopts,
+        events,
+        scraper,
+        rates=DEFAULT_RATES,
+        duration=60,
+        warmup=5,
+        marker_interval=1.0,
+        scrape_interval=0.1,
+    ):
+        self.mopts = mopts
+        self.events = events
+        self.scraper = scraper
+        self.rates = rates
+        self.duration = duration
+        self.warmup = warmup
+        self.marker_interval = marker_interval
+        self.scrape_interval = scrape_interval
+        self.pub_uri = os.path.join(mopts["sock_dir"], "master_event_pub.ipc")
+        self.steps = []
+        self.io_loop = None
+        self.publisher = None
+        self._packer = get_event("master", opts=mopts, listen=False, raise_errors=False)
+        self._packed = queue.Queue(maxsize=PACKED_QUEUE_SIZE)
+        self._step = None
+        self._rate_start = None
+        self._rate_published = 0
+        self._markers = 0
+        self._stop = False
+
+    def check_socket(self):
+        """
+        Check the socket of the event bus is not used by the running Salt Master
+        """
+
+        if not os.path.exists(self.pub_uri):
+            return True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.pub_uri)
+        except OSError:
+            # The socket is left by the stopped Salt Master
+            return True
+        finally:
+            sock.close()
+        return False
+
+    def _pack_events(self):
+        for tag, data in self.events:
+            if self._stop:
+                break
+            self._packed.put(self._packer.pack(tag, data))
+
+    def _set_step(self, step):
+        if self._step is not None:
+            self._step.end = time()
+        self._step = step
+        if step is not None:
+            self._rate_start = step.start = time()
+            self._rate_published = 0
+
+    @salt.ext.tornado.gen.coroutine
+    def publish_events(self):
+        while not self._stop:
+            yield salt.ext.tornado.gen.sleep(PUBLISH_TICK)
+            step = self._step
+            if step is None:
+                continue
+            due = int(step.rate * (time() - self._rate_start)) - self._rate_published
+            count = 0
+            for _ in range(min(due, PUBLISH_BATCH)):
+                try:
+                    raw = self._packed.get_nowait()
+                except queue.Empty:
+                    # The load is limited by packing the events
+                    break
+                self.publisher.publish(raw)
+                count += 1
+            self._rate_published += count
+            step.published += count
+
+    def publish_marker(self):
+        """
+        Publish the job of the marker function counted in the metrics
+        """
+
+        jid = salt.utils.jid.gen_jid(self.mopts)
+        raw = self._packer.pack(
+            "salt/job/%s/new" % jid,
+            {
+                "jid": jid,
+                "fun": MARKER_FUN,
+                "minions": [],
+                "user": "saline-bench",
+                "_stamp": get_stamp(time()),
+            },
+        )
+        self.io_loop.add_callback(self.publisher.publish, raw)
+        self._markers += 1
+        return time()
+
+    def get_sample(self):
+        """
+        Get the counters of the pipeline and the processes from the metrics
+        """
+
+        events = self.scraper.scrape("events", ("salt_events_tags_funcs",))
+        internal = self.scraper.scrape(
+            "internal", ("saline_internal_stage_events_total",)
+        )
+        process = self.scraper.scrape(
+            "process",
+            (
+                "saline_process_cpu_seconds_total",
+                "saline_process_resident_memory_bytes",
+            ),
+        )
+        stages = {
+            dict(labels).get("stage"): value
+            for labels, value in internal["saline_internal_stage_events_total"].items()
+        }
+        return {
+            "ts": time(),
+            "markers": events["salt_events_tags_funcs"].get(
+                (("fun", MARKER_FUN), ("tag", "salt/job/*/new")), 0
+            ),
+            "merged": stages.get("merged", 0),
+            "dropped": stages.get("dropped", 0),
+            "cpu": {
+                dict(labels)["process"]: value
+                for labels, value in process["saline_process_cpu_seconds_total"].items()
+            },
+            "rss": {
+                dict(labels)["process"]: value
+                for labels, value in process[
+                    "saline_process_resident_memory_bytes"
+                ].items()
+            },
+        }
+
+    def measure(self):
+        try:
+            self._measure()
+        finally:
+            self._stop = True
+            self.io_loop.add_callback(self.io_loop.stop)
+
+    def _measure(self):
+        start = time()
+        while not self.publisher.streams:
+            if time() - start > 60:
+                print("The Saline Events Manager is not connected to the event bus")
+                return
+            sleep(0.5)
+        # The markers published before the run are not waited for
+        markers_base = None
+        while markers_base is None:
+            try:
+                markers_base = self.get_sample()["markers"] - self._markers
+            except OSError as exc:
+                print("Unable to scrape the metrics: %s" % exc)
+                if time() - start > 60:
+                    return
+                sleep(1)
+        for rate in self.rates:
+            step = LoadStep(rate)
+            self.io_loop.add_callback(self._set_step, step)
+            print("Running with %d events/s for %d seconds" % (rate, self.duration))
+            step_start = time()
+            marker = None
+            last_marker = 0
+            while time() - step_start < self.duration:
+                cur_time = time()
+                if (
+                    marker is None
+                    and cur_time - step_start >= self.warmup
+                    and cur_time - last_marker >= self.marker_interval
+                ):
+                    last_marker = self.publish_marker()
+                    marker = (last_marker, self._markers)
+                try:
+                    sample = self.get_sample()
+                except OSError as exc:
+                    print("Unable to scrape the metrics: %s" % exc)
+                    sleep(self.scrape_interval)
+                    continue
+                if cur_time - step_start >= self.warmup:
+                    step.add_sample(sample)
+                if marker is not None:
+                    published, expected = marker
+                    if sample["markers"] - markers_base >= expected:
+                        step.latencies.append(sample["ts"] - published)
+                        marker = None
+                    elif sample["ts"] - published > self.marker_interval * 10:
+                        step.lost_markers += 1
+                        markers_base += 1
+                        marker = None
+                sleep(self.scrape_interval)
+            self.steps.append(step)
+            self.io_loop.add_callback(self._set_step, None)
+
+    def run(self):
+        """
+        Publish the events and measure the load until all the rates are run
+        """
+
+        Thread(target=self._pack_events, daemon=True).start()
+        self.io_loop = IOLoop()
+        self.publisher = IPCMessagePublisher(
+            {"ipc_write_buffer": 0}, self.pub_uri, io_loop=self.io_loop
+        )
+        self.publisher.start()
+        self.io_loop.add_callback(self.publish_events)
+        Thread(target=self.measure, daemon=True).start()
+        try:
+            self.io_loop.start()
+        finally:
+            self._stop = True
+            self.publisher.close()
+            self.io_loop.close()
+        return [step.get_report() for step in self.steps if step.end is not None]
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog="saline-bench")
+    parser.add_argument(
+        "--rate",
+        type=int,
+        nargs="+",
+        default=DEFAULT_RATES,
+        help="The rates of the events per second to run one after another",
+    )
+    parser.add_argument(
+        "--duration", type=int, default=60, help="The duration of each rate"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=5,
+        help="The seconds of each rate not counted in the measurements",
+    )
+    parser.add_argument(
+        "--events",
+        help="Publish the events recorded with 'salt-run state.event' to the file",
+    )
+    parser.add_argument("--minions", type=int, default=1000)
+    parser.add_argument("--states", type=int, default=100)
+    parser.add_argument(
+        "--master-config",
+        default=os.path.join(salt.syspaths.CONFIG_DIR, "master"),
+        help="The Salt Master config to get the sock_dir from",
+    )
+    parser.add_argument(
+        "--url", default="https://localhost:8216", help="The Saline REST API URL"
+    )
+    parser.add_argument(
+        "--insecure", action="store_true", help="Skip verifying the certificate"
+    )
+    parser.add_argument("--output", help="Save the results to the JSON file")
+    args = parser.parse_args(args)
+
+    mopts = salt.config.client_config(args.master_config)
+    mopts["serial"] = "msgpack"
+    if mopts.get("ipc_mode") == "tcp":
+        parser.error("Only the Salt Master event bus with 'ipc_mode: ipc' is supported")
+
+    if args.events:
+        events = iter_recorded(load_events(args.events))
+    else:
+        events = iter_events(args.minions, args.states, realtime=True)
+
+    generator = LoadGenerator(
+        mopts,
+        events,
+        MetricsScraper(args.url, insecure=args.insecure),
+        rates=args.rate,
+        duration=args.duration,
+        warmup=args.warmup,
+    )
+    if not generator.check_socket():
+        parser.error(
+            "The event bus socket %s is in use, stop the Salt Master"
+            % generator.pub_uri
+        )
+    results = generator.run()
+
+    print(
+        "%10s %12s %12s %12s %12s %12s"
+        % ("rate", "published/s", "merged/s", "dropped", "p50 lat ms", "p99 lat ms")
+    )
+    for res in results:
+        latency = res["latency"] or {}
+        print(
+            "%10d %12.1f %12s %12s %12s %12s"
+            % (
+                res["rate"],
+                res["published_rate"],
+                "-" if res["merged_rate"] is None else "%.1f" % res["merged_rate"],
+                "-" if res["dropped"] is None else "%d" % res["dropped"],
+                "-" if "p50" not in latency else "%.1f" % (latency["p50"] * 1000),
+                "-" if "p99" not in latency else "%.1f" % (latency["p99"] * 1000),
+            )
+        )
+        for process, stats in sorted(res["processes"].items()):
+            print(
+                "%10s %-30s cpu %6.1f%% rss %8.1f MiB"
+                % (
+                    "",
+                    process,
+                    stats["cpu"] * 100,
+                    (stats["rss"] or 0) / 1048576,
+                )
+            )
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump({"timestamp": time(), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
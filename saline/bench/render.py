@@ -0,0 +1,83 @@
+"""
+Benchmark of rendering the metrics exposition against the number of series
+
+Measures the full rendering and the incremental rendering
+after updating the part of the series.
+
+Run with: python -m saline.bench.render [series count ...]
+"""
+
+import sys
+
+from time import perf_counter
+
+from saline.data.metrics import Metrics, MetricsCollection
+
+DEFAULT_SERIES = (1000, 10000, 100000, 200000)
+
+# The part of the series updated between the renderings
+UPDATED_PART = 0.01
+
+
+def get_collection(count):
+    metrics = MetricsCollection()
+    for i in range(count):
+        labels = ("sls%d" % (i % 100), "sid%d" % i, "pkg.installed", "succeeded")
+        metrics.inc(Metrics.SALT_STATE_RESULTS, labels)
+        metrics.inc(Metrics.SALT_STATE_DURATION, labels, inc_by=i * 0.1)
+    return metrics
+
+
+def bench_render(count):
+    metrics = get_collection(count)
+
+    start = perf_counter()
+    metrics.get_buf()
+    full = perf_counter() - start
+
+    start = perf_counter()
+    metrics.get_buf()
+    unchanged = perf_counter() - start
+
+    step = max(int(1 / UPDATED_PART), 1)
+    for i in range(0, count, step):
+        labels = ("sls%d" % (i % 100), "sid%d" % i, "pkg.installed", "succeeded")
+        metrics.inc(Metrics.SALT_STATE_DURATION, labels, inc_by=1.5)
+
+    start = perf_counter()
+    buf = metrics.get_buf()
+    updated = perf_counter() - start
+
+    return {
+        "series": count * 2,
+        "size": len(buf),
+        "full": full,
+        "unchanged": unchanged,
+        "updated": updated,
+    }
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    counts = [int(x) // 2 for x in args] if args else [x // 2 for x in DEFAULT_SERIES]
+    print(
+        "%10s %12s %12s %14s %14s"
+        % ("series", "size KiB", "full ms", "unchanged ms", "updated 1% ms")
+    )
+    for count in counts:
+        res = bench_render(count)
+        print(
+            "%10d %12d %12.3f %14.3f %14.3f"
+            % (
+                res["series"],
+                res["size"] // 1024,
+                res["full"] * 1000,
+                res["unchanged"] * 1000,
+                res["updated"] * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
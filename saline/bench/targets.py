@@ -0,0 +1,91 @@
+"""
+Benchmark of handling the huge target lists of ``salt/job/<jid>/new`` events
+
+Measures the latency from receiving the parsed event in Data Manager
+to the moment the job is visible in the metrics.
+
+Run with: python -m saline.bench.targets [minions count ...]
+"""
+
+import pickle
+import sys
+
+from time import perf_counter, time
+
+from saline.data.merger import DataMerger
+from saline.data.parser import EventTags
+
+
+DEFAULT_TARGETS = (1000, 10000, 50000)
+
+
+def get_new_event(jid, minions, ts=None):
+    """
+    Get the parsed ``salt/job/<jid>/new`` event of ``state.apply``
+    """
+
+    return {
+        "tag": "salt/job/%s/new" % jid,
+        "tag_mask": "salt/job/*/new",
+        "ts": time() if ts is None else ts,
+        "jid": jid,
+        "fun": "state.apply",
+        "minions": minions,
+        "tag_main": EventTags.SALT_JOB,
+        "tag_sub": EventTags.SALT_JOB_NEW,
+        "state_fun_args": ("state.apply", (), False),
+    }
+
+
+def bench_targets(count, jid=20240101000000000000):
+    minions = ["minion-%06d.example.org" % i for i in range(count)]
+    # The list is passed from the readers to Data Manager with the queue
+    raw = pickle.dumps(get_new_event(jid, minions))
+
+    datamerger = DataMerger({})
+
+    start = perf_counter()
+    data = pickle.loads(raw)
+    loaded = perf_counter()
+    datamerger.add(data)
+    merged = perf_counter()
+    datamerger.jobs_metrics_update()
+    buf = datamerger.get_metrics()
+    visible = perf_counter()
+
+    if 'status="pending"} %d\n' % count not in buf:
+        raise RuntimeError("The job is not visible in the metrics")
+
+    return {
+        "targets": count,
+        "unpickle": loaded - start,
+        "merge": merged - loaded,
+        "metrics": visible - merged,
+        "total": visible - start,
+    }
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    counts = [int(x) for x in args] if args else DEFAULT_TARGETS
+    print(
+        "%10s %12s %12s %12s %12s"
+        % ("targets", "unpickle ms", "merge ms", "metrics ms", "total ms")
+    )
+    for count in counts:
+        res = bench_targets(count)
+        print(
+            "%10d %12.3f %12.3f %12.3f %12.3f"
+            % (
+                res["targets"],
+                res["unpickle"] * 1000,
+                res["merge"] * 1000,
+                res["metrics"] * 1000,
+                res["total"] * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -80,6 +80,57 @@ VALID_OPTS = immutabletypes.freeze(
         "job_cleanup_after": int,
         # The replacement of blank value of mods to prevent passing to Prometheus
         "set_highstate_mods_in_metrics": str,
+        # The upper bounds of the buckets for the job response time histograms
+        "job_response_buckets": list,
+        # The rules to set the group label of the minions by minion ID regex
+        "minion_groups": dict,
+        # The quantiles of the state durations (enabled, quantiles, accuracy, max_bins)
+        "state_duration_quantiles": dict,
+        # The tracking of the slowest and most failing states (enabled, size, capacity)
+        "top_states": dict,
+        # The limits of the number of series per metric name or "*" (limit, policy)
+        "metrics_limits": dict,
+        # The time in seconds to keep not updated series per metric name or "*"
+        "metrics_ttl": dict,
+        # The interval of removing the expired metrics series
+        "metrics_expire_interval": int,
+        # Share the rendered metrics with the REST API processes via memory mapped file
+        "metrics_shared_buffer": bool,
+        # The lists of metric names by the scrape groups served on /metrics/<group>
+        "metrics_groups": dict,
+        # The exposition formats served besides the text one: openmetrics, protobuf.
+        # The counters without _total suffix get it in the OpenMetrics format,
+        # so the series scraped are renamed, salt_events_tags to
+        # salt_events_tags_total for example, and the dashboards need the new names
+        "metrics_formats": list,
+        # The exemplars of the state results with the jid and the minion
+        # (enabled, policy of the duration exemplars: max or latest, max_age)
+        "exemplars": dict,
+        # The rollups of the state results to maintain: sls, fun and status
+        "state_results_rollups": list,
+        # Maintain the state results metrics with all the labels
+        "state_results_detailed": bool,
+        # The rolling 1m, 5m and 15m rates of the events by tags and functions
+        # maintained as gauges (enabled, capacity of the series per metric)
+        "metrics_rates": dict,
+        # The saline_internal_* metrics of the pipeline stages sampled on each
+        # Nth event or once per interval (enabled, sample_every, sample_interval)
+        "internal_metrics": dict,
+        # The saline_process_* metrics of the resource usage reported
+        # by each of the Saline processes (enabled, interval)
+        "process_metrics": dict,
+        # The journal of the filtered events written to the rotated compressed
+        # segments (enabled, path, segment_size, segments, queue_size)
+        "events_journal": dict,
+        # The snapshot of the merged data written periodically and on stopping
+        # to restore it on start (enabled, path, interval)
+        "state_snapshot": dict,
+        # The history of the completed state jobs moved from the memory
+        # to the SQLite database (enabled, path, retention, queue_size)
+        "jobs_history": dict,
+        # The JSON API of the minions and the jobs answered by the Data Manager
+        # (enabled, max_limit, cache_size, timeout)
+        "query_api": dict,
         # Tell the loader to attempt to import *.pyx cython files if cython is available
         "cython_enable": bool,
     }
@@ -121,6 +172,50 @@ DEFAULT_SALINE_OPTS = immutabletypes.freeze(
         "job_metrics_update_interval": 3,
         "job_cleanup_after": 1200,
         "set_highstate_mods_in_metrics": "",
+        "job_response_buckets": [],
+        "minion_groups": {},
+        "state_duration_quantiles": {"enabled": False},
+        "top_states": {"enabled": False},
+        "metrics_limits": {},
+        "metrics_ttl": {},
+        "metrics_expire_interval": 60,
+        "metrics_shared_buffer": False,
+        "metrics_groups": {},
+        "metrics_formats": [],
+        "exemplars": {"enabled": False},
+        "state_results_rollups": [],
+        "state_results_detailed": True,
+        "metrics_rates": {"enabled": False},
+        "internal_metrics": {
+            "enabled": True,
+            "sample_every": 100,
+            "sample_interval": 1,
+        },
+        "process_metrics": {"enabled": True, "interval": 10},
+        "events_journal": {
+            "enabled": False,
+            "path": os.path.join(salt.syspaths.CACHE_DIR, "saline", "journal"),
+            "segment_size": 67108864,
+            "segments": 16,
+            "queue_size": 10000,
+        },
+        "state_snapshot": {
+            "enabled": False,
+            "path": os.path.join(salt.syspaths.CACHE_DIR, "saline", "state.snapshot"),
+            "interval": 300,
+        },
+        "jobs_history": {
+            "enabled": False,
+            "path": os.path.join(salt.syspaths.CACHE_DIR, "saline", "jobs.sqlite"),
+            "retention": 604800,
+            "queue_size": 10000,
+        },
+        "query_api": {
+            "enabled": False,
+            "max_limit": 1000,
+            "cache_size": 1000,
+            "timeout": 10,
+        },
         "cython_enable": False,
     }
 )
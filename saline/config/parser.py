@@ -1,11 +1,27 @@
 from saline import config
 
 from salt.features import setup_features
-from salt.utils.parsers import MasterOptionParser, OptionParserMeta
+from salt.utils.parsers import MasterOptionParser, MixInMeta, OptionParserMeta
+
+
+class ReplayMixIn(metaclass=MixInMeta):
+    _mixin_prio_ = 100
+
+    def _mixin_setup(self):
+        self.add_option(
+            "--replay",
+            default=None,
+            metavar="PATH",
+            help=(
+                "Replay the events journal directory or segment file "
+                "without connecting to the Salt Master, print the resulting "
+                "metrics and exit."
+            ),
+        )
 
 
 class SalineOptionParser(
-    MasterOptionParser, metaclass=OptionParserMeta
+    MasterOptionParser, ReplayMixIn, metaclass=OptionParserMeta
 ):  # pylint: disable=no-init
 
     description = "The Saline reads events from the Salt Master event bus"
@@ -26,6 +26,10 @@ class Saline(SalineOptionParser, DaemonsMixin):
     def prepare(self):
         super().prepare()
 
+        if self.options.replay:
+            # Nothing is required to be set up to replay the events journal
+            return
+
         try:
             if self.config["verify_env"]:
                 confd = self.config.get("default_include")
@@ -115,6 +119,12 @@ class Saline(SalineOptionParser, DaemonsMixin):
 
         super().start()
 
+        if self.options.replay:
+            import saline.journal
+
+            saline.journal.replay_journal(self.config, self.options.replay)
+            self.exit(0)
+
         if check_user(self.config["user"]):
             self.start_log_info()
             self.verify_hash_type()
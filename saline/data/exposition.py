@@ -0,0 +1,388 @@
+import logging
+import struct
+
+from saline.data.metrics import (
+    METRICS,
+    TYPE_LABELS,
+    Metrics,
+    histogram_lines,
+    render_labels,
+    summary_lines,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+FORMAT_TEXT = 0
+FORMAT_OPENMETRICS = 1
+FORMAT_PROTOBUF = 2
+
+
+FORMAT_NAMES = {
+    FORMAT_TEXT: "text",
+    FORMAT_OPENMETRICS: "openmetrics",
+    FORMAT_PROTOBUF: "protobuf",
+}
+
+
+CONTENT_TYPES = {
+    FORMAT_TEXT: "text/plain;version=0.0.4;charset=utf-8",
+    FORMAT_OPENMETRICS: "application/openmetrics-text;version=1.0.0;charset=utf-8",
+    FORMAT_PROTOBUF: (
+        "application/vnd.google.protobuf;"
+        "proto=io.prometheus.client.MetricFamily;encoding=delimited"
+    ),
+}
+
+
+# The metric types of io.prometheus.client.MetricFamily
+PROTOBUF_TYPES = {
+    Metrics.TYPE_COUNTER: 0,
+    Metrics.TYPE_GAUGE: 1,
+    Metrics.TYPE_SUMMARY: 2,
+    Metrics.TYPE_HISTOGRAM: 4,
+}
+
+
+# The prefixes of Metric.counter and Metric.gauge with the only value field
+PROTOBUF_COUNTER_VALUE = b"\x1a\x09\x09"
+PROTOBUF_GAUGE_VALUE = b"\x12\x09\x09"
+
+
+DOUBLE = struct.Struct("<d")
+
+
+# The encoded varints of the small values
+VARINTS = [bytes((i,)) for i in range(0x80)]
+
+
+def get_metrics_formats(names=None):
+    """
+    Get the set of the exposition formats enabled with the format names,
+    the text format is always enabled as the fallback
+
+    :param list names: The names of the formats to serve
+    """
+
+    format_ids = {name: fmt for fmt, name in FORMAT_NAMES.items()}
+    formats = {FORMAT_TEXT}
+    for name in names or ():
+        if name in format_ids:
+            formats.add(format_ids[name])
+        else:
+            log.warning("Unknown metrics exposition format '%s'", name)
+    return frozenset(formats)
+
+
+def negotiate_format(accept, formats=None):
+    """
+    Get the exposition format with the highest quality in the Accept header
+    out of the enabled formats or any of them if not specified
+    """
+
+    fmt = FORMAT_TEXT
+    best_q = -1.0
+    for media_range in (accept or "").split(","):
+        media_type, *params = media_range.split(";")
+        media_type = media_type.strip().lower()
+        params = dict(
+            (k.strip().lower(), v.strip())
+            for k, _, v in (p.partition("=") for p in params)
+        )
+        try:
+            q = float(params.get("q", 1))
+        except ValueError:
+            continue
+        if media_type == "application/vnd.google.protobuf":
+            if (
+                params.get("proto") != "io.prometheus.client.MetricFamily"
+                or params.get("encoding") != "delimited"
+            ):
+                continue
+            range_fmt = FORMAT_PROTOBUF
+        elif media_type == "application/openmetrics-text":
+            range_fmt = FORMAT_OPENMETRICS
+        elif media_type in ("text/plain", "text/*", "*/*"):
+            range_fmt = FORMAT_TEXT
+        else:
+            continue
+        if formats is not None and range_fmt not in formats:
+            continue
+        if q > best_q:
+            fmt, best_q = range_fmt, q
+    return fmt
+
+
+def _pb_varint(value):
+    if value < 0x80:
+        return VARINTS[value]
+    b = bytearray()
+    while value > 0x7F:
+        b.append((value & 0x7F) | 0x80)
+        value >>= 7
+    b.append(value)
+    return bytes(b)
+
+
+def _pb_field_varint(field, value):
+    return _pb_varint(field << 3) + _pb_varint(value)
+
+
+def _pb_field_double(field, value):
+    return _pb_varint(field << 3 | 1) + DOUBLE.pack(value)
+
+
+def _pb_field_bytes(field, value):
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(value)) + value
+
+
+class MetricsFamily:
+    """
+    The family of the series of the metric with the rendered lines cached
+    per exposition format until the series are changed
+    """
+
+    def __init__(self, label, family):
+        self.label = label
+        self.mtype, self.doc, self.labels_names, self.params = family
+        if self.mtype == Metrics.TYPE_COUNTER:
+            # OpenMetrics counters have _total suffix in the samples names only
+            self.om_label = label[:-6] if label.endswith("_total") else label
+        else:
+            self.om_label = label
+        # The encoded name fields of io.prometheus.client.LabelPair
+        self.pb_labels_names = [
+            _pb_field_bytes(1, ln.encode()) for ln in self.labels_names
+        ]
+        # The lists of the label values, the value, the exemplar and
+        # the rendered lines by the exposition formats by the label values
+        self.series = {}
+        self.blocks = {}
+
+    def set_series(self, series):
+        for labels, value, *exemplar in series:
+            self.series[tuple(labels)] = [
+                labels,
+                value,
+                exemplar[0] if exemplar else None,
+                None,
+                None,
+                None,
+            ]
+        self.blocks = {}
+
+    def del_series(self, series):
+        for labels in series:
+            self.series.pop(tuple(labels), None)
+        self.blocks = {}
+
+    def _render_text(self, name, labels, value):
+        labels = render_labels(self.labels_names, labels)
+        if self.mtype == Metrics.TYPE_HISTOGRAM:
+            return "\n".join(histogram_lines(self.label, labels, self.params, *value))
+        if self.mtype == Metrics.TYPE_SUMMARY:
+            return "\n".join(summary_lines(self.label, labels, self.params, *value))
+        v = "%.3f" % value if isinstance(value, float) else value
+        if labels:
+            return f"{name}{{{labels}}} {v}"
+        return f"{name} {v}"
+
+    def _render_exemplar(self, exemplar):
+        labels, value, ts = exemplar
+        # The length of the exemplar labels is limited with 128 characters
+        ls = []
+        length = 0
+        for ln, lv in labels:
+            lv = lv[: max(128 - length - len(ln), 0)]
+            length += len(ln) + len(lv)
+            ls.append((ln, lv))
+        return " # {%s} %s %.3f" % (
+            render_labels([ln for ln, _ in ls], [lv for _, lv in ls]),
+            value,
+            ts,
+        )
+
+    def _render_protobuf_exemplar(self, exemplar):
+        labels, value, ts = exemplar
+        b = [
+            _pb_field_bytes(
+                1,
+                _pb_field_bytes(1, ln.encode()) + _pb_field_bytes(2, lv.encode()),
+            )
+            for ln, lv in labels
+        ]
+        b.append(_pb_field_double(2, value))
+        seconds = int(ts)
+        b.append(
+            _pb_field_bytes(
+                3,
+                _pb_field_varint(1, seconds)
+                + _pb_field_varint(2, int((ts - seconds) * 1e9)),
+            )
+        )
+        return b"".join(b)
+
+    def _render_protobuf(self, labels, value, exemplar):
+        b = [
+            _pb_field_bytes(1, ln + _pb_field_bytes(2, lv.encode()))
+            for ln, lv in zip(self.pb_labels_names, labels)
+        ]
+        if self.mtype == Metrics.TYPE_HISTOGRAM:
+            counts, count, total = value
+            h = [_pb_field_varint(1, count), _pb_field_double(2, total)]
+            cnt = 0
+            for le, c in zip(self.params, counts):
+                cnt += c
+                h.append(
+                    _pb_field_bytes(
+                        3, _pb_field_varint(1, cnt) + _pb_field_double(2, le)
+                    )
+                )
+            b.append(_pb_field_bytes(7, b"".join(h)))
+        elif self.mtype == Metrics.TYPE_SUMMARY:
+            values, count, total = value
+            s = [_pb_field_varint(1, count), _pb_field_double(2, total)]
+            for q, v in zip(self.params, values):
+                s.append(
+                    _pb_field_bytes(
+                        3,
+                        _pb_field_double(1, q)
+                        + _pb_field_double(2, float("nan") if v is None else v),
+                    )
+                )
+            b.append(_pb_field_bytes(4, b"".join(s)))
+        elif exemplar is not None and self.mtype == Metrics.TYPE_COUNTER:
+            b.append(
+                _pb_field_bytes(
+                    3,
+                    _pb_field_double(1, value)
+                    + _pb_field_bytes(2, self._render_protobuf_exemplar(exemplar)),
+                )
+            )
+        else:
+            if self.mtype == Metrics.TYPE_COUNTER:
+                b.append(PROTOBUF_COUNTER_VALUE)
+            else:
+                b.append(PROTOBUF_GAUGE_VALUE)
+            b.append(DOUBLE.pack(value))
+        return _pb_field_bytes(4, b"".join(b))
+
+    def _get_line(self, series, fmt):
+        line = series[3 + fmt]
+        if line is None:
+            if fmt == FORMAT_PROTOBUF:
+                line = self._render_protobuf(*series[:3])
+            elif fmt == FORMAT_OPENMETRICS and self.mtype == Metrics.TYPE_COUNTER:
+                line = self._render_text(self.om_label + "_total", *series[:2])
+                if series[2] is not None:
+                    line += self._render_exemplar(series[2])
+            else:
+                line = self._render_text(self.label, *series[:2])
+            series[3 + fmt] = line
+        return line
+
+    def get_block(self, fmt):
+        if fmt not in self.blocks:
+            if fmt == FORMAT_PROTOBUF:
+                self.blocks[fmt] = self._render_protobuf_block()
+            else:
+                label = self.om_label if fmt == FORMAT_OPENMETRICS else self.label
+                b = [
+                    "# HELP %s %s\n# TYPE %s %s"
+                    % (label, self.doc, label, TYPE_LABELS[self.mtype])
+                ]
+                b.extend(self._get_line(series, fmt) for series in self.series.values())
+                b.append("")
+                self.blocks[fmt] = "\n".join(b)
+        return self.blocks[fmt]
+
+    def _render_protobuf_block(self):
+        if not self.series:
+            return b""
+        family = b"".join(
+            [
+                _pb_field_bytes(1, self.label.encode()),
+                _pb_field_bytes(2, self.doc.encode()),
+                _pb_field_varint(3, PROTOBUF_TYPES[self.mtype]),
+                *(
+                    self._get_line(series, FORMAT_PROTOBUF)
+                    for series in self.series.values()
+                ),
+            ]
+        )
+        return _pb_varint(len(family)) + family
+
+
+class MetricsTable:
+    """
+    The table of the series maintained from the snapshots and deltas
+    and rendered to the exposition formats
+    """
+
+    def __init__(self, groups=None):
+        self.seq = None
+        self._families = {}
+        # The metric names by the scrape groups
+        self._groups = {
+            group: frozenset(METRICS[metric][1] for metric in metrics)
+            for group, metrics in (groups or {}).items()
+        }
+        # The buffers cached per scrape group and exposition format,
+        # the ETags cached per scrape group, None stands for all the metrics
+        self._bufs = {}
+        self._etags = {}
+
+    def _changed(self, labels, etag):
+        for group in (None, *self._groups):
+            if group is None or not labels.isdisjoint(self._groups[group]):
+                for fmt in FORMAT_NAMES:
+                    self._bufs.pop((group, fmt), None)
+                self._etags[group] = etag
+
+    def apply_snapshot(self, seq, snapshot, etag=None):
+        self.seq = seq
+        self._families = {}
+        for label, family in snapshot.items():
+            self._families[label] = MetricsFamily(label, family["family"])
+            self._families[label].set_series(family["series"])
+        self._bufs = {}
+        self._etags = dict.fromkeys((None, *self._groups), etag)
+
+    def apply_delta(self, seq, delta, etag=None):
+        """
+        Apply the delta if it follows the last applied sequence number
+        """
+
+        if self.seq is None or seq != self.seq + 1:
+            return False
+        self.seq = seq
+        for label, me_delta in delta.items():
+            if label not in self._families:
+                self._families[label] = MetricsFamily(label, me_delta["family"])
+            family = self._families[label]
+            family.del_series(me_delta["del"])
+            family.set_series(me_delta["set"])
+        if delta:
+            self._changed(delta.keys(), etag)
+        return True
+
+    def get_buf(self, group=None, fmt=FORMAT_TEXT):
+        key = (group, fmt)
+        if key not in self._bufs:
+            labels = None if group is None else self._groups[group]
+            blocks = [
+                family.get_block(fmt)
+                for label, family in self._families.items()
+                if labels is None or label in labels
+            ]
+            if fmt == FORMAT_PROTOBUF:
+                self._bufs[key] = b"".join(blocks)
+            elif fmt == FORMAT_OPENMETRICS:
+                self._bufs[key] = "".join(blocks) + "# EOF\n"
+            else:
+                self._bufs[key] = "".join(blocks)
+        return self._bufs[key]
+
+    def get_etag(self, group=None):
+        return self._etags.get(group)
@@ -1,24 +1,143 @@
 import logging
+import re
 
-from time import time
+from sys import intern
+from time import perf_counter, time
 
-from saline.data.metrics import Metrics, MetricsCollection
+from saline.data.metrics import (
+    EXEMPLAR_POLICIES,
+    LIMIT_POLICIES,
+    METRICS,
+    METRICS_PARAMS,
+    Metrics,
+    MetricsCollection,
+)
 from saline.data.minion import MinionsCollection
 from saline.data.parser import EventTags, STATE_FUNCS
+from saline.data.rates import RollingRates
+from saline.data.size import get_deep_size
+from saline.data.sketch import SpaceSaving
 from saline.data.smart import MergeWrapper
-from saline.data.state import StateJobCollection, JobStatus
+from saline.data.state import (
+    JobStatus,
+    NamesIndex,
+    StateJobCollection,
+    dump_jid,
+    load_jid,
+)
 
 
 log = logging.getLogger(__name__)
 
 
+# The rollups of the state results with the results and duration metrics
+# and the indexes of the labels of the detailed metrics to keep
+STATE_ROLLUPS = {
+    "sls": (
+        Metrics.SALT_STATE_RESULTS_BY_SLS,
+        Metrics.SALT_STATE_DURATION_BY_SLS,
+        (0, 3),
+    ),
+    "fun": (
+        Metrics.SALT_STATE_RESULTS_BY_FUN,
+        Metrics.SALT_STATE_DURATION_BY_FUN,
+        (2, 3),
+    ),
+    "status": (
+        Metrics.SALT_STATE_RESULTS_BY_STATUS,
+        Metrics.SALT_STATE_DURATION_BY_STATUS,
+        (3,),
+    ),
+}
+
+
+# The windows of the rolling rates in seconds
+RATES_WINDOWS = (60, 300, 900)
+
+
+# The rate metrics by the windows of the counted metrics
+RATES_METRICS = {
+    Metrics.SALT_EVENTS_TAGS: (
+        Metrics.SALT_EVENTS_TAGS_RATE_1M,
+        Metrics.SALT_EVENTS_TAGS_RATE_5M,
+        Metrics.SALT_EVENTS_TAGS_RATE_15M,
+    ),
+    Metrics.SALT_EVENTS_TAGS_FUNCS: (
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_1M,
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_5M,
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_15M,
+    ),
+}
+
+
+# The key of the pipeline stats added to the parsed events by the readers,
+# the "stats" key is taken by the stats of the master events
+PIPELINE_STATS = "_saline_stats"
+
+
+# The process metrics by the keys of the stats reported by the processes
+PROCESS_METRICS = {
+    "rss": Metrics.SALINE_PROCESS_RESIDENT_MEMORY_BYTES,
+    "cpu": Metrics.SALINE_PROCESS_CPU_SECONDS_TOTAL,
+    "threads": Metrics.SALINE_PROCESS_THREADS,
+    "gc_collections": Metrics.SALINE_PROCESS_GC_COLLECTIONS_TOTAL,
+    "gc_pause": Metrics.SALINE_PROCESS_GC_PAUSE_SECONDS_TOTAL,
+    "loop_lag": Metrics.SALINE_PROCESS_LOOP_LAG_SECONDS,
+}
+
+
 class DataMerger:
     def __init__(self, opts):
         self.opts = opts
-        self.metrics = MetricsCollection()
-        self.minions = MinionsCollection()
-        self.jobs = StateJobCollection(self.minions)
+        self._state_duration_quantiles_enabled = self.opts.get(
+            "state_duration_quantiles", {}
+        ).get("enabled", False)
+        self._exemplars_enabled = self.opts.get("exemplars", {}).get("enabled", False)
+        self.metrics = MetricsCollection(
+            params=self._get_metrics_params(),
+            limits=self._get_metrics_limits(),
+            ttls=self._get_metrics_ttls(),
+            exemplars=self._get_metrics_exemplars(),
+        )
+        top_states = self.opts.get("top_states", {})
+        self._top_states = None
+        self._top_states_size = top_states.get("size", 200)
+        if top_states.get("enabled", False):
+            capacity = max(top_states.get("capacity", 1000), self._top_states_size)
+            self._top_states = {
+                Metrics.SALT_STATE_TOP_DURATION: SpaceSaving(capacity),
+                Metrics.SALT_STATE_TOP_FAILED: SpaceSaving(capacity),
+                Metrics.SALT_STATE_TOP_WARNINGS: SpaceSaving(capacity),
+            }
+        metrics_rates = self.opts.get("metrics_rates", {})
+        self._rates = None
+        if metrics_rates.get("enabled", False):
+            self._rates = {
+                metric: RollingRates(
+                    RATES_WINDOWS, metrics_rates.get("capacity", 1000)
+                )
+                for metric in RATES_METRICS
+            }
+        self._state_rollups = []
+        for rollup in self.opts.get("state_results_rollups", []):
+            if rollup not in STATE_ROLLUPS:
+                log.warning("Unknown state results rollup '%s'", rollup)
+                continue
+            self._state_rollups.append(STATE_ROLLUPS[rollup])
+        self._state_results_detailed = self.opts.get("state_results_detailed", True)
+        # The number of events merged since the last pipeline stats were added
+        self._merged = 0
+        self.minions = MinionsCollection(
+            groups=[
+                (re.compile(k), v)
+                for k, v in self.opts.get("minion_groups", {}).items()
+            ]
+        )
+        self.jobs = StateJobCollection(self.minions, on_completed=self._job_completed)
         self.states_mods = {}
+        self._jids_requests = {}
+        # The history the completed state jobs are moved to on completion
+        self.history = None
         self._state_statuses = (
             "succeeded",
             "failed",
@@ -38,20 +157,123 @@ class DataMerger:
             merge_callback=self._merge_sls,
         )
 
+    def _get_metrics_params(self):
+        metrics_params = {}
+        if self.opts.get("job_response_buckets"):
+            metrics_params[Metrics.SALT_JOB_RESPONSE_SECONDS] = {
+                "buckets": self.opts["job_response_buckets"]
+            }
+        metrics_params[Metrics.SALT_STATE_DURATION_QUANTILES] = {
+            k: v
+            for k, v in self.opts.get("state_duration_quantiles", {}).items()
+            if k != "enabled"
+        }
+        # The unknown parameters would fail the values of the histograms
+        # and the summaries on the first observation
+        for metric, params in metrics_params.items():
+            for key in list(params):
+                if key not in METRICS_PARAMS[metric]:
+                    log.warning(
+                        "Unknown parameter '%s' of '%s' is ignored",
+                        key,
+                        METRICS[metric][1],
+                    )
+                    del params[key]
+        # The sketch of the quantiles is not usable with the parameters out of range
+        sketch_params = metrics_params[Metrics.SALT_STATE_DURATION_QUANTILES]
+        for key, valid in (
+            ("accuracy", lambda v: 0 < v < 1),
+            ("max_bins", lambda v: v >= 1),
+        ):
+            if key not in sketch_params:
+                continue
+            try:
+                is_valid = valid(sketch_params[key])
+            except TypeError:
+                is_valid = False
+            if not is_valid:
+                log.warning(
+                    "Invalid value of '%s' of '%s': %s, using %s instead",
+                    key,
+                    METRICS[Metrics.SALT_STATE_DURATION_QUANTILES][1],
+                    sketch_params[key],
+                    METRICS_PARAMS[Metrics.SALT_STATE_DURATION_QUANTILES][key],
+                )
+                del sketch_params[key]
+        return metrics_params
+
+    def _get_metrics_limits(self):
+        metrics_limits = self.opts.get("metrics_limits", {})
+        default_limit = metrics_limits.get("*")
+        limits = {}
+        for metric, (_, label, _, labels_defs) in METRICS.items():
+            # The internal metrics are not limited
+            if labels_defs is None or label.startswith("saline_internal_"):
+                continue
+            limit = metrics_limits.get(label, default_limit)
+            if not limit or not limit.get("limit"):
+                continue
+            policy = limit.get("policy", "hard")
+            if policy not in LIMIT_POLICIES:
+                log.warning(
+                    "Unknown series limit policy '%s' for '%s', using 'hard' instead",
+                    policy,
+                    label,
+                )
+                policy = "hard"
+            limits[metric] = (int(limit["limit"]), LIMIT_POLICIES[policy])
+        return limits
+
+    def _get_metrics_ttls(self):
+        metrics_ttl = self.opts.get("metrics_ttl", {})
+        default_ttl = metrics_ttl.get("*")
+        ttls = {}
+        for metric, (_, label, _, labels_defs) in METRICS.items():
+            if labels_defs is None:
+                continue
+            ttl = metrics_ttl.get(label, default_ttl)
+            if ttl:
+                ttls[metric] = int(ttl)
+        return ttls
+
+    def _get_metrics_exemplars(self):
+        exemplars = self.opts.get("exemplars", {})
+        if not self._exemplars_enabled:
+            return {}
+        policy = exemplars.get("policy", "max")
+        if policy not in EXEMPLAR_POLICIES:
+            log.warning(
+                "Unknown exemplars policy '%s', using 'max' instead",
+                policy,
+            )
+            policy = "max"
+        duration_policy = (EXEMPLAR_POLICIES[policy], exemplars.get("max_age", 3600))
+        metrics_exemplars = {}
+        for results, duration, _ in (
+            (Metrics.SALT_STATE_RESULTS, Metrics.SALT_STATE_DURATION, None),
+            *STATE_ROLLUPS.values(),
+        ):
+            metrics_exemplars[results] = (Metrics.EXEMPLAR_LATEST, None)
+            metrics_exemplars[duration] = duration_policy
+        return metrics_exemplars
+
+    def _new_sid_wrapper(self, sls):
+        return MergeWrapper(
+            {},
+            self.opts.get("merge_rules", {})
+            .get("sid", {})
+            .get("start_merging_on", 150),
+            new_rules_callback=self._new_merge_rules,
+            new_rules_callback_opts=("sid",),
+            merge_callback=self._merge_sls_sid,
+            merge_callback_opts=(sls,),
+        )
+
     def _get_sls_id_fun_status(self, sls, sid, fun, status):
         (sls, sid, fun) = (str(sls), str(sid), str(fun))
         sls = self._sls_id_fun.get_wrapped(sls)
         if sls not in self._sls_id_fun:
-            self._sls_id_fun[sls] = MergeWrapper(
-                {},
-                self.opts.get("merge_rules", {})
-                .get("sid", {})
-                .get("start_merging_on", 150),
-                new_rules_callback=self._new_merge_rules,
-                new_rules_callback_opts=("sid",),
-                merge_callback=self._merge_sls_sid,
-                merge_callback_opts=(sls,),
-            )
+            self._sls_id_fun[sls] = self._new_sid_wrapper(sls)
             sls = self._sls_id_fun.get_wrapped(sls)
         sid = self._sls_id_fun[sls].get_wrapped(sid)
         if sid not in self._sls_id_fun[sls]:
@@ -77,14 +299,24 @@ class DataMerger:
             (
                 Metrics.SALT_STATE_RESULTS,
                 Metrics.SALT_STATE_DURATION,
+                Metrics.SALT_STATE_DURATION_QUANTILES,
             ),
             src_labels,
             dst_labels,
         )
 
     def _merge_sls(self, src_sls, dst_sls):
+        statuses = set()
         for sid in list(self._sls_id_fun[src_sls].keys()):
+            for fun_statuses in self._sls_id_fun[src_sls][sid].values():
+                statuses.update(fun_statuses)
             self._merge_sls_sid(sid, sid, src_sls, dst_sls)
+        for status in statuses:
+            self.metrics.move(
+                (Metrics.SALT_STATE_RESULTS_BY_SLS, Metrics.SALT_STATE_DURATION_BY_SLS),
+                (src_sls, status),
+                (dst_sls, status),
+            )
         self._sls_id_fun.pop(src_sls, None)
         return True
 
@@ -93,16 +325,7 @@ class DataMerger:
             dst_sls = src_sls
         else:
             if dst_sls not in self._sls_id_fun:
-                self._sls_id_fun[dst_sls] = MergeWrapper(
-                    {},
-                    self.opts.get("merge_rules", {})
-                    .get("sid", {})
-                    .get("start_merging_on", 150),
-                    new_rules_callback=self._new_merge_rules,
-                    new_rules_callback_opts=("sid",),
-                    merge_callback=self._merge_sls_sid,
-                    merge_callback_opts=(dst_sls,),
-                )
+                self._sls_id_fun[dst_sls] = self._new_sid_wrapper(dst_sls)
         if dst_sid not in self._sls_id_fun[dst_sls]:
             self._sls_id_fun[dst_sls][dst_sid] = {}
         for fun in self._sls_id_fun[src_sls][src_sid]:
@@ -112,6 +335,10 @@ class DataMerger:
                 self._move_metrics(
                     (src_sls, src_sid, fun, status), (dst_sls, dst_sid, fun, status)
                 )
+            if self._top_states is not None:
+                # The merged states are tracked by the merged labels from now on
+                for top_states in self._top_states.values():
+                    top_states.move((src_sls, src_sid, fun), (dst_sls, dst_sid, fun))
             self._sls_id_fun[dst_sls][dst_sid][fun] = list(
                 set(
                     [
@@ -127,8 +354,50 @@ class DataMerger:
         if state_fun_args is None:
             log.warning("Ignoring state data for %s from jid: %s", minions, jid)
             return
-        job = self.jobs.get(state_fun_args)
-        job.update(minions, status, jid, ts)
+        self.jobs.update(state_fun_args, minions, status, jid, ts)
+
+    def _add_state_result(self, sls_id_fun_status, duration, jid=None, minion=None):
+        results_exemplar = None
+        duration_exemplar = None
+        if self._exemplars_enabled and jid is not None:
+            # The exemplars link the series to the job and the minion
+            labels = (("jid", str(jid)),)
+            if minion is not None:
+                labels += (("minion", str(minion)),)
+            ts = time()
+            results_exemplar = (labels, 1, ts)
+            duration_exemplar = (labels, duration, ts)
+        if self._state_results_detailed:
+            self.metrics.inc(
+                Metrics.SALT_STATE_RESULTS,
+                sls_id_fun_status,
+                exemplar=results_exemplar,
+            )
+            self.metrics.inc(
+                Metrics.SALT_STATE_DURATION,
+                sls_id_fun_status,
+                inc_by=duration,
+                exemplar=duration_exemplar,
+            )
+        for results, duration_metric, idxs in self._state_rollups:
+            labels = tuple(sls_id_fun_status[i] for i in idxs)
+            self.metrics.inc(results, labels, exemplar=results_exemplar)
+            self.metrics.inc(
+                duration_metric, labels, inc_by=duration, exemplar=duration_exemplar
+            )
+        if self._state_duration_quantiles_enabled:
+            self.metrics.observe(
+                Metrics.SALT_STATE_DURATION_QUANTILES,
+                sls_id_fun_status,
+                duration,
+            )
+        if self._top_states is not None:
+            sls_id_fun, status = sls_id_fun_status[:3], sls_id_fun_status[3]
+            self._top_states[Metrics.SALT_STATE_TOP_DURATION].add(sls_id_fun, duration)
+            if status.startswith("failed"):
+                self._top_states[Metrics.SALT_STATE_TOP_FAILED].add(sls_id_fun)
+            if status.endswith("_with_warning"):
+                self._top_states[Metrics.SALT_STATE_TOP_WARNINGS].add(sls_id_fun)
 
     def _add_state(self, data, tag_sub, ts):
         minions = []
@@ -137,6 +406,7 @@ class DataMerger:
         elif "id" in data:
             minions = [data["id"]]
         jid = data.get("jid")
+        minion = minions[0] if len(minions) == 1 else None
         if len(minions) == 0:
             log.warning(
                 "Neither 'minions' nor 'id' is specified in event '%s' with jid: %s",
@@ -167,15 +437,7 @@ class DataMerger:
                     sls_id_fun_status = self._get_sls_id_fun_status(
                         ret.get("__sls__"), ret.get("__id__"), ret.get("fun"), "notrun"
                     )
-                    self.metrics.inc(
-                        Metrics.SALT_STATE_RESULTS,
-                        sls_id_fun_status,
-                    )
-                    self.metrics.inc(
-                        Metrics.SALT_STATE_DURATION,
-                        sls_id_fun_status,
-                        inc_by=duration,
-                    )
+                    self._add_state_result(sls_id_fun_status, duration, jid, minion)
             state_status = JobStatus.SUCCEEDED
         else:
             for s in self._state_statuses:
@@ -195,15 +457,7 @@ class DataMerger:
                     sls_id_fun_status = self._get_sls_id_fun_status(
                         ret.get("__sls__"), ret.get("__id__"), ret.get("fun"), status
                     )
-                    self.metrics.inc(
-                        Metrics.SALT_STATE_RESULTS,
-                        sls_id_fun_status,
-                    )
-                    self.metrics.inc(
-                        Metrics.SALT_STATE_DURATION,
-                        sls_id_fun_status,
-                        inc_by=duration,
-                    )
+                    self._add_state_result(sls_id_fun_status, duration, jid, minion)
             if state_status != JobStatus.FAILED:
                 state_status = JobStatus.SUCCEEDED
         self._store_per_minion_state_data(
@@ -214,7 +468,84 @@ class DataMerger:
             data.get("state_fun_args"),
         )
 
+    def _add_job_response(self, data, fun, jid, ts):
+        req_ts = self._jids_requests.get(jid)
+        if req_ts is None or "id" not in data:
+            return
+        self.metrics.observe(
+            Metrics.SALT_JOB_RESPONSE_SECONDS,
+            (fun, self.minions.get(data["id"]).group()),
+            max(ts - req_ts, 0.0),
+        )
+
+    def add_process_stats(self, name, stats):
+        """
+        Add the resource usage stats reported by the Saline process
+        """
+
+        for key, metric in PROCESS_METRICS.items():
+            if key in stats:
+                self.metrics.set(metric, (name,), stats[key])
+
+    def _add_pipeline_stats(self, stats, ts=None):
+        """
+        Add the stats of the pipeline stages sampled by the upstream processes
+        """
+
+        if "process" in stats:
+            self.add_process_stats(*stats["process"])
+        if "depth" not in stats:
+            return
+        cur_time = time()
+        for queue, depth in stats.get("depth", {}).items():
+            if depth is not None:
+                self.metrics.set(Metrics.SALINE_INTERNAL_QUEUE_DEPTH, (queue,), depth)
+        counts = stats.get("counts", {})
+        counts["merged"], self._merged = self._merged, 0
+        for stage, count in counts.items():
+            if count:
+                self.metrics.inc(
+                    Metrics.SALINE_INTERNAL_STAGE_EVENTS_TOTAL, (stage,), inc_by=count
+                )
+        for stage in ("parse", "merge"):
+            if stage in stats:
+                self.metrics.observe(
+                    Metrics.SALINE_INTERNAL_STAGE_SECONDS, (stage,), stats[stage]
+                )
+        if "put" in stats:
+            # The time spent in the queues between the processes
+            self.metrics.observe(
+                Metrics.SALINE_INTERNAL_STAGE_SECONDS,
+                ("queue",),
+                max(
+                    cur_time
+                    - stats["put"]
+                    - stats.get("parse", 0.0)
+                    - stats.get("merge", 0.0),
+                    0.0,
+                ),
+            )
+        if ts is not None:
+            self.metrics.observe(
+                Metrics.SALINE_INTERNAL_EVENT_LAG_SECONDS, value=max(cur_time - ts, 0.0)
+            )
+
     def add(self, data):
+        stats = data.get(PIPELINE_STATS)
+        if stats is None:
+            self._add_event(data)
+            return
+        if "tag" not in data:
+            # The stats are sent without the event if no event was sampled
+            self._add_pipeline_stats(stats)
+            return
+        start = perf_counter()
+        self._add_event(data)
+        stats["merge"] = perf_counter() - start
+        self._add_pipeline_stats(stats, data.get("ts"))
+
+    def _add_event(self, data):
+        self._merged += 1
         rix = data.get("rix")
         if rix is not None:
             self.metrics.inc(Metrics.SALINE_INTERNAL_RIX_TOTAL, (rix,))
@@ -226,12 +557,20 @@ class DataMerger:
         tag_mask = data.get("tag_mask")
         self.metrics.inc(Metrics.SALT_EVENTS_TAGS, (tag_mask,))
         fun = data.get("fun")
+        if self._rates is not None:
+            self._rates[Metrics.SALT_EVENTS_TAGS].add((tag_mask,))
+            self._rates[Metrics.SALT_EVENTS_TAGS_FUNCS].add((tag_mask, fun or "-"))
         if fun:
             self.metrics.inc(Metrics.SALT_EVENTS_TAGS_FUNCS, (tag_mask, fun))
             if (
                 tag_main == EventTags.SALT_JOB
                 and tag_sub in (EventTags.SALT_JOB_NEW, EventTags.SALT_JOB_RET)
             ):
+                if tag_sub == EventTags.SALT_JOB_NEW:
+                    if jid is not None and ts is not None:
+                        self._jids_requests.setdefault(jid, ts)
+                elif data.get("offline", False) is False:
+                    self._add_job_response(data, fun, jid, ts)
                 if fun in STATE_FUNCS and data.get("offline", False) is False:
                     self._add_state(data, tag_sub, ts)
                 else:
@@ -305,12 +644,98 @@ class DataMerger:
             self.metrics.inc(Metrics.SALT_EVENTS_TRIMMED_COUNT)
             self.metrics.inc(Metrics.SALT_EVENTS_TRIMMED_TOTAL, inc_by=len(trimmed))
 
-    def get_metrics(self):
-        return self.metrics.get_buf()
+    def get_metrics(self, metrics=None, reset_changes=False):
+        return self.metrics.get_buf(metrics=metrics, reset_changes=reset_changes)
+
+    def get_metrics_snapshot(self):
+        return self.metrics.get_snapshot()
+
+    def get_metrics_delta(self):
+        return self.metrics.get_delta()
 
     def get_metrics_epoch(self):
         return self.metrics.get_epoch()
 
+    def get_metrics_version(self, metrics=None):
+        return self.metrics.get_version(metrics=metrics)
+
+    def get_memory_stats(self):
+        """
+        Get the approximate memory usage of the data structures
+        """
+
+        sls_id_fun = self._sls_id_fun.get_memory_stats()
+        sls_id_fun["levels"] = dict(zip(("sls", "sid"), sls_id_fun["levels"]))
+        size, objects = get_deep_size(self._jids_requests)
+        return {
+            "minions": self.minions.get_memory_stats(),
+            "state_jobs": self.jobs.get_memory_stats(),
+            "metrics": self.metrics.get_memory_stats(),
+            "sls_id_fun": sls_id_fun,
+            "jids_requests": {
+                "jids": len(self._jids_requests),
+                "objects": objects,
+                "bytes": size,
+            },
+        }
+
+    def get_state(self):
+        """
+        Get the state of the merged data to restore it with after restart,
+        the data is expected not to be changed while getting the state
+        """
+
+        names = NamesIndex()
+        return {
+            "metrics": self.metrics.get_state(),
+            # The jobs of the minions are referred with the indexes
+            # of the state jobs in the same order as the state jobs are got
+            "minions": self.minions.get_state(names, list(self.jobs.jobs())),
+            "state_jobs": self.jobs.get_state(names),
+            "names": list(names),
+            "sls_id_fun": [
+                self._sls_id_fun.get_rules(),
+                [
+                    [
+                        sls,
+                        sids.get_rules(),
+                        {
+                            sid: {fun: list(statuses) for fun, statuses in funs.items()}
+                            for sid, funs in sids.items()
+                        },
+                    ]
+                    for sls, sids in self._sls_id_fun.items()
+                ],
+            ],
+            "jids_requests": [
+                [dump_jid(jid), ts] for jid, ts in self._jids_requests.items()
+            ],
+        }
+
+    def set_state(self, state):
+        """
+        Restore the merged data got with get_state
+        """
+
+        self.metrics.set_state(state["metrics"])
+        names = [
+            intern(name) if isinstance(name, str) else name for name in state["names"]
+        ]
+        jobs = self.jobs.set_state(state["state_jobs"], names)
+        self.minions.set_state(state["minions"], names, jobs)
+        rules, sls_sids = state["sls_id_fun"]
+        self._sls_id_fun.set_rules(rules)
+        for sls, rules, sids in sls_sids:
+            wrapper = self._new_sid_wrapper(sls)
+            wrapper.set_rules(rules)
+            # The data is updated directly as it was already merged
+            wrapper.update(sids)
+            self._sls_id_fun.update({sls: wrapper})
+        self._jids_requests.update(
+            (load_jid(jid), ts) for jid, ts in state["jids_requests"]
+        )
+        self.jobs_metrics_update()
+
     def jobs_metrics_update(self):
         ts = time()
 
@@ -335,7 +760,46 @@ class DataMerger:
                     val,
                 )
 
+        if self._top_states is not None:
+            for metric, top_states in self._top_states.items():
+                self.metrics.set_all(
+                    metric,
+                    {
+                        sls_id_fun: count
+                        for sls_id_fun, count, _ in top_states.top(
+                            self._top_states_size
+                        )
+                    },
+                )
+
+        if self._rates is not None:
+            for metric, rates in self._rates.items():
+                for rate_metric, values in zip(RATES_METRICS[metric], rates.rates(ts)):
+                    self.metrics.set_all(rate_metric, values)
+
+    def expire_metrics(self):
+        expired = self.metrics.expire()
+        if expired:
+            log.debug("Removed %d expired metrics series", expired)
+
+    def _job_completed(self, state_job, job, completed_ts):
+        # The completed jobs are kept in the memory until cleaning up
+        # only if there is no history to move them to
+        if self.history is None:
+            return False
+        self.history.add(state_job.state_fun_args, job, completed_ts)
+        return True
+
     def cleanup_job_jids(self):
         ts = time()
-        for job in self.jobs.jobs():
-            job.cleanup_jids(self.opts.get("job_cleanup_after", 1200), ts)
+        cleanup_after = self.opts.get("job_cleanup_after", 1200)
+        for job, salt_job, completed_ts in self.jobs.cleanup_jids(cleanup_after, ts):
+            if self.history is not None:
+                self.history.add(job.state_fun_args, salt_job, completed_ts)
+        self.minions.cleanup_completed(ts - cleanup_after)
+        # The responses received after the job timeout are not considered
+        # in the response time metrics
+        requests_before = ts - self.opts.get("job_timeout", 1200)
+        for jid, req_ts in list(self._jids_requests.items()):
+            if req_ts < requests_before:
+                self._jids_requests.pop(jid, None)
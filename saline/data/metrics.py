@@ -1,10 +1,25 @@
+import logging
+import re
+
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
 from threading import Lock
+from time import time
+
+from saline.data.size import get_deep_size
+from saline.data.sketch import DDSketch
+
+
+log = logging.getLogger(__name__)
 
 
 class Metrics:
     # Define Metric types
     TYPE_COUNTER = 1
     TYPE_GAUGE = 2
+    TYPE_HISTOGRAM = 3
+    TYPE_SUMMARY = 4
     # Define Metric IDs
     SALT_EVENTS_TOTAL = 1
     SALT_EVENTS_TAGS = 2
@@ -20,8 +35,37 @@ class Metrics:
     SALT_STATS_RUNS = 12
     SALT_STATS_MEAN = 13
     SALT_STATS_TOTAL = 14
+    SALT_JOB_RESPONSE_SECONDS = 15
+    SALT_STATE_DURATION_QUANTILES = 16
+    SALT_STATE_TOP_DURATION = 17
+    SALT_STATE_TOP_FAILED = 18
+    SALT_STATE_TOP_WARNINGS = 19
+    SALT_STATE_RESULTS_BY_SLS = 20
+    SALT_STATE_DURATION_BY_SLS = 21
+    SALT_STATE_RESULTS_BY_FUN = 22
+    SALT_STATE_DURATION_BY_FUN = 23
+    SALT_STATE_RESULTS_BY_STATUS = 24
+    SALT_STATE_DURATION_BY_STATUS = 25
+    SALT_EVENTS_TAGS_RATE_1M = 26
+    SALT_EVENTS_TAGS_RATE_5M = 27
+    SALT_EVENTS_TAGS_RATE_15M = 28
+    SALT_EVENTS_TAGS_FUNCS_RATE_1M = 29
+    SALT_EVENTS_TAGS_FUNCS_RATE_5M = 30
+    SALT_EVENTS_TAGS_FUNCS_RATE_15M = 31
     # IDs for internal metrics
     SALINE_INTERNAL_RIX_TOTAL = 100
+    SALINE_INTERNAL_SERIES_DROPPED_TOTAL = 101
+    SALINE_INTERNAL_QUEUE_DEPTH = 102
+    SALINE_INTERNAL_STAGE_EVENTS_TOTAL = 103
+    SALINE_INTERNAL_STAGE_SECONDS = 104
+    SALINE_INTERNAL_EVENT_LAG_SECONDS = 105
+    # IDs for the metrics of the Saline processes
+    SALINE_PROCESS_RESIDENT_MEMORY_BYTES = 110
+    SALINE_PROCESS_CPU_SECONDS_TOTAL = 111
+    SALINE_PROCESS_THREADS = 112
+    SALINE_PROCESS_GC_COLLECTIONS_TOTAL = 113
+    SALINE_PROCESS_GC_PAUSE_SECONDS_TOTAL = 114
+    SALINE_PROCESS_LOOP_LAG_SECONDS = 115
     # Metric labels definitions
     LABEL_TAG = 1
     LABEL_FUN = 2
@@ -30,14 +74,43 @@ class Metrics:
     LABEL_STATUS = 5
     LABEL_MODS = 6
     LABEL_TEST = 7
+    LABEL_GROUP = 8
     LABEL_MASTER_CMD = 50
     # IDs for labels of internal metrics
     LABEL_RIX = 100
+    LABEL_METRIC = 101
+    LABEL_QUEUE = 102
+    LABEL_STAGE = 103
+    LABEL_PROCESS = 104
+    # Define the policies of limiting the number of series
+    LIMIT_HARD = 1
+    LIMIT_LRU = 2
+    # Define the policies of keeping the exemplars of the series
+    EXEMPLAR_LATEST = 1
+    EXEMPLAR_MAX = 2
+
+
+LIMIT_POLICIES = {
+    "hard": Metrics.LIMIT_HARD,
+    "lru": Metrics.LIMIT_LRU,
+}
+
+
+EXEMPLAR_POLICIES = {
+    "latest": Metrics.EXEMPLAR_LATEST,
+    "max": Metrics.EXEMPLAR_MAX,
+}
+
+
+# The label value of the series collecting the values over the limit
+OVERFLOW_LABEL = "__overflow__"
 
 
 TYPE_LABELS = {
     Metrics.TYPE_COUNTER: "counter",
     Metrics.TYPE_GAUGE: "gauge",
+    Metrics.TYPE_HISTOGRAM: "histogram",
+    Metrics.TYPE_SUMMARY: "summary",
 }
 
 
@@ -52,6 +125,13 @@ LABELS_SLS_SID_FUN_STATUS = (
 )
 
 
+LABELS_SLS_SID_FUN = (
+    (Metrics.LABEL_SLS, "sls"),
+    (Metrics.LABEL_SID, "sid"),
+    (Metrics.LABEL_FUN, "fun"),
+)
+
+
 LABELS_FUN_MODS_TEST_STATUS = (
     (Metrics.LABEL_FUN, "fun"),
     (Metrics.LABEL_MODS, "mods"),
@@ -65,6 +145,36 @@ LABELS_SALT_STATS = (
 )
 
 
+LABELS_SLS_STATUS = (
+    (Metrics.LABEL_SLS, "sls"),
+    (Metrics.LABEL_STATUS, "status"),
+)
+
+
+LABELS_FUN_STATUS = (
+    (Metrics.LABEL_FUN, "fun"),
+    (Metrics.LABEL_STATUS, "status"),
+)
+
+
+LABELS_TAG = ((Metrics.LABEL_TAG, "tag"),)
+
+
+LABELS_TAG_FUN = (
+    (Metrics.LABEL_TAG, "tag"),
+    (Metrics.LABEL_FUN, "fun"),
+)
+
+
+LABELS_PROCESS = ((Metrics.LABEL_PROCESS, "process"),)
+
+
+LABELS_FUN_GROUP = (
+    (Metrics.LABEL_FUN, "fun"),
+    (Metrics.LABEL_GROUP, "group"),
+)
+
+
 METRICS = {
     Metrics.SALT_EVENTS_TOTAL: (
         Metrics.TYPE_COUNTER,
@@ -132,6 +242,72 @@ METRICS = {
         "Total number of events processed by specific reader",
         ((Metrics.LABEL_RIX, "rix"),),
     ),
+    Metrics.SALINE_INTERNAL_SERIES_DROPPED_TOTAL: (
+        Metrics.TYPE_COUNTER,
+        "saline_internal_series_dropped_total",
+        "Total number of updates with new labels over the limit of series",
+        ((Metrics.LABEL_METRIC, "metric"),),
+    ),
+    Metrics.SALINE_INTERNAL_QUEUE_DEPTH: (
+        Metrics.TYPE_GAUGE,
+        "saline_internal_queue_depth",
+        "Number of events waiting in the queues of the pipeline",
+        ((Metrics.LABEL_QUEUE, "queue"),),
+    ),
+    Metrics.SALINE_INTERNAL_STAGE_EVENTS_TOTAL: (
+        Metrics.TYPE_COUNTER,
+        "saline_internal_stage_events_total",
+        "Total number of events passed, filtered or dropped by the pipeline stages",
+        ((Metrics.LABEL_STAGE, "stage"),),
+    ),
+    Metrics.SALINE_INTERNAL_STAGE_SECONDS: (
+        Metrics.TYPE_HISTOGRAM,
+        "saline_internal_stage_seconds",
+        "Time spent by the sampled events in the pipeline stages",
+        ((Metrics.LABEL_STAGE, "stage"),),
+    ),
+    Metrics.SALINE_INTERNAL_EVENT_LAG_SECONDS: (
+        Metrics.TYPE_HISTOGRAM,
+        "saline_internal_event_lag_seconds",
+        "Time between firing and merging of the sampled events",
+        None,
+    ),
+    Metrics.SALINE_PROCESS_RESIDENT_MEMORY_BYTES: (
+        Metrics.TYPE_GAUGE,
+        "saline_process_resident_memory_bytes",
+        "Resident memory size of the Saline process in bytes",
+        LABELS_PROCESS,
+    ),
+    Metrics.SALINE_PROCESS_CPU_SECONDS_TOTAL: (
+        Metrics.TYPE_COUNTER,
+        "saline_process_cpu_seconds_total",
+        "Total user and system CPU time of the Saline process in seconds",
+        LABELS_PROCESS,
+    ),
+    Metrics.SALINE_PROCESS_THREADS: (
+        Metrics.TYPE_GAUGE,
+        "saline_process_threads",
+        "Number of threads of the Saline process",
+        LABELS_PROCESS,
+    ),
+    Metrics.SALINE_PROCESS_GC_COLLECTIONS_TOTAL: (
+        Metrics.TYPE_COUNTER,
+        "saline_process_gc_collections_total",
+        "Total number of garbage collections in the Saline process",
+        LABELS_PROCESS,
+    ),
+    Metrics.SALINE_PROCESS_GC_PAUSE_SECONDS_TOTAL: (
+        Metrics.TYPE_COUNTER,
+        "saline_process_gc_pause_seconds_total",
+        "Total time of garbage collections in the Saline process in seconds",
+        LABELS_PROCESS,
+    ),
+    Metrics.SALINE_PROCESS_LOOP_LAG_SECONDS: (
+        Metrics.TYPE_GAUGE,
+        "saline_process_loop_lag_seconds",
+        "Max event loop lag of the Saline process since the last report",
+        LABELS_PROCESS,
+    ),
     Metrics.SALT_MINIONS: (
         Metrics.TYPE_GAUGE,
         "salt_minions",
@@ -156,25 +332,382 @@ METRICS = {
         "Total time of execution of salt master internal cmd calls",
         LABELS_SALT_STATS,
     ),
+    Metrics.SALT_JOB_RESPONSE_SECONDS: (
+        Metrics.TYPE_HISTOGRAM,
+        "salt_job_response_seconds",
+        "Time between the job request and the response from the minion",
+        LABELS_FUN_GROUP,
+    ),
+    Metrics.SALT_STATE_DURATION_QUANTILES: (
+        Metrics.TYPE_SUMMARY,
+        "salt_state_duration_quantiles",
+        "Quantiles of state apply duration",
+        LABELS_SLS_SID_FUN_STATUS,
+    ),
+    Metrics.SALT_STATE_TOP_DURATION: (
+        Metrics.TYPE_GAUGE,
+        "salt_state_top_duration",
+        "Total time of state apply duration of the slowest states",
+        LABELS_SLS_SID_FUN,
+    ),
+    Metrics.SALT_STATE_TOP_FAILED: (
+        Metrics.TYPE_GAUGE,
+        "salt_state_top_failed",
+        "Total number of failed results of the most failing states",
+        LABELS_SLS_SID_FUN,
+    ),
+    Metrics.SALT_STATE_TOP_WARNINGS: (
+        Metrics.TYPE_GAUGE,
+        "salt_state_top_warnings",
+        "Total number of results with warnings of the most warning states",
+        LABELS_SLS_SID_FUN,
+    ),
+    Metrics.SALT_STATE_RESULTS_BY_SLS: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_results_by_sls",
+        "Total number of state apply results by SLS",
+        LABELS_SLS_STATUS,
+    ),
+    Metrics.SALT_STATE_DURATION_BY_SLS: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_duration_by_sls",
+        "Total time of state apply duration by SLS",
+        LABELS_SLS_STATUS,
+    ),
+    Metrics.SALT_STATE_RESULTS_BY_FUN: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_results_by_fun",
+        "Total number of state apply results by state function",
+        LABELS_FUN_STATUS,
+    ),
+    Metrics.SALT_STATE_DURATION_BY_FUN: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_duration_by_fun",
+        "Total time of state apply duration by state function",
+        LABELS_FUN_STATUS,
+    ),
+    Metrics.SALT_STATE_RESULTS_BY_STATUS: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_results_by_status",
+        "Total number of state apply results by status",
+        LABELS_STATUS,
+    ),
+    Metrics.SALT_STATE_DURATION_BY_STATUS: (
+        Metrics.TYPE_COUNTER,
+        "salt_state_duration_by_status",
+        "Total time of state apply duration by status",
+        LABELS_STATUS,
+    ),
+    Metrics.SALT_EVENTS_TAGS_RATE_1M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_rate_1m",
+        "Rate of events per second over the last minute by tag masks",
+        LABELS_TAG,
+    ),
+    Metrics.SALT_EVENTS_TAGS_RATE_5M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_rate_5m",
+        "Rate of events per second over the last 5 minutes by tag masks",
+        LABELS_TAG,
+    ),
+    Metrics.SALT_EVENTS_TAGS_RATE_15M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_rate_15m",
+        "Rate of events per second over the last 15 minutes by tag masks",
+        LABELS_TAG,
+    ),
+    Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_1M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_funcs_rate_1m",
+        "Rate of events per second over the last minute by tag masks and functions",
+        LABELS_TAG_FUN,
+    ),
+    Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_5M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_funcs_rate_5m",
+        "Rate of events per second over the last 5 minutes by tag masks and functions",
+        LABELS_TAG_FUN,
+    ),
+    Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_15M: (
+        Metrics.TYPE_GAUGE,
+        "salt_events_tags_funcs_rate_15m",
+        "Rate of events per second over the last 15 minutes by tag masks and functions",
+        LABELS_TAG_FUN,
+    ),
+}
+
+
+# The default parameters of the histograms and summaries
+METRICS_PARAMS = {
+    Metrics.SALT_JOB_RESPONSE_SECONDS: {
+        "buckets": (
+            0.1,
+            0.25,
+            0.5,
+            1,
+            2.5,
+            5,
+            10,
+            30,
+            60,
+            120,
+            300,
+            600,
+            1200,
+        ),
+    },
+    Metrics.SALT_STATE_DURATION_QUANTILES: {
+        "quantiles": (0.5, 0.9, 0.95, 0.99),
+        "accuracy": 0.05,
+        "max_bins": 128,
+    },
+    Metrics.SALINE_INTERNAL_STAGE_SECONDS: {
+        "buckets": (
+            0.0001,
+            0.00025,
+            0.0005,
+            0.001,
+            0.0025,
+            0.005,
+            0.01,
+            0.025,
+            0.05,
+            0.1,
+            0.25,
+            0.5,
+            1,
+            5,
+        ),
+    },
+    Metrics.SALINE_INTERNAL_EVENT_LAG_SECONDS: {
+        "buckets": (
+            0.01,
+            0.05,
+            0.1,
+            0.25,
+            0.5,
+            1,
+            2.5,
+            5,
+            10,
+            30,
+            60,
+            300,
+        ),
+    },
+}
+
+
+# The default scrape groups of the metrics served on /metrics/<group>
+METRICS_GROUPS = {
+    "events": (
+        Metrics.SALT_EVENTS_TOTAL,
+        Metrics.SALT_EVENTS_TAGS,
+        Metrics.SALT_EVENTS_TAGS_FUNCS,
+        Metrics.SALT_EVENTS_TRIMMED_COUNT,
+        Metrics.SALT_EVENTS_TRIMMED_TOTAL,
+        Metrics.SALT_STATS_RUNS,
+        Metrics.SALT_STATS_MEAN,
+        Metrics.SALT_STATS_TOTAL,
+        Metrics.SALT_EVENTS_TAGS_RATE_1M,
+        Metrics.SALT_EVENTS_TAGS_RATE_5M,
+        Metrics.SALT_EVENTS_TAGS_RATE_15M,
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_1M,
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_5M,
+        Metrics.SALT_EVENTS_TAGS_FUNCS_RATE_15M,
+    ),
+    "minions": (
+        Metrics.SALT_MINIONS,
+        Metrics.SALT_JOB_RESPONSE_SECONDS,
+    ),
+    "state_jobs": (
+        Metrics.SALT_STATE_APPLIES,
+        Metrics.SALT_STATE_APPLIES_STATUS,
+        Metrics.SALT_STATE_JOBS,
+    ),
+    "state_results": (
+        Metrics.SALT_STATE_RESULTS,
+        Metrics.SALT_STATE_DURATION,
+        Metrics.SALT_STATE_DURATION_QUANTILES,
+        Metrics.SALT_STATE_TOP_DURATION,
+        Metrics.SALT_STATE_TOP_FAILED,
+        Metrics.SALT_STATE_TOP_WARNINGS,
+    ),
+    "state_rollups": (
+        Metrics.SALT_STATE_RESULTS_BY_SLS,
+        Metrics.SALT_STATE_DURATION_BY_SLS,
+        Metrics.SALT_STATE_RESULTS_BY_FUN,
+        Metrics.SALT_STATE_DURATION_BY_FUN,
+        Metrics.SALT_STATE_RESULTS_BY_STATUS,
+        Metrics.SALT_STATE_DURATION_BY_STATUS,
+    ),
+    "internal": (
+        Metrics.SALINE_INTERNAL_RIX_TOTAL,
+        Metrics.SALINE_INTERNAL_SERIES_DROPPED_TOTAL,
+        Metrics.SALINE_INTERNAL_QUEUE_DEPTH,
+        Metrics.SALINE_INTERNAL_STAGE_EVENTS_TOTAL,
+        Metrics.SALINE_INTERNAL_STAGE_SECONDS,
+        Metrics.SALINE_INTERNAL_EVENT_LAG_SECONDS,
+    ),
+    "process": (
+        Metrics.SALINE_PROCESS_RESIDENT_MEMORY_BYTES,
+        Metrics.SALINE_PROCESS_CPU_SECONDS_TOTAL,
+        Metrics.SALINE_PROCESS_THREADS,
+        Metrics.SALINE_PROCESS_GC_COLLECTIONS_TOTAL,
+        Metrics.SALINE_PROCESS_GC_PAUSE_SECONDS_TOTAL,
+        Metrics.SALINE_PROCESS_LOOP_LAG_SECONDS,
+    ),
+}
+
+
+def get_metrics_groups(groups=None):
+    """
+    Get the sets of metric IDs by the scrape group names
+
+    :param dict groups: The lists of the metric names by the group names
+                        to add to the default groups or to replace them
+    """
+
+    metric_ids = {label: metric for metric, (_, label, _, _) in METRICS.items()}
+    metrics_groups = {
+        group: frozenset(metrics) for group, metrics in METRICS_GROUPS.items()
+    }
+    for group, labels in (groups or {}).items():
+        if not re.match(r"^\w+$", group):
+            log.warning("Invalid metrics group name '%s'", group)
+            continue
+        metrics = set()
+        for label in labels:
+            if label in metric_ids:
+                metrics.add(metric_ids[label])
+            else:
+                log.warning("Unknown metric '%s' in the group '%s'", label, group)
+        metrics_groups[group] = frozenset(metrics)
+    return metrics_groups
+
+
+def render_labels(labels_names, labels):
+    return ",".join(
+        '%s="%s"' % (ln, str(lv).replace('"', '\\"'))
+        for ln, lv in zip(labels_names, labels)
+    )
+
+
+def histogram_lines(name, labels, buckets, counts, count, total):
+    if labels:
+        labels = "%s," % labels
+    b = []
+    cnt = 0
+    for le, c in zip(buckets, counts):
+        cnt += c
+        b.append(f'{name}_bucket{{{labels}le="{le:g}"}} {cnt}')
+    b.append(f'{name}_bucket{{{labels}le="+Inf"}} {count}')
+    labels = "{%s}" % labels[:-1] if labels else ""
+    b.append(f"{name}_sum{labels} {total:.3f}")
+    b.append(f"{name}_count{labels} {count}")
+    return b
+
+
+def summary_lines(name, labels, quantiles, values, count, total):
+    if labels:
+        labels = "%s," % labels
+    b = []
+    for q, v in zip(quantiles, values):
+        v = "NaN" if v is None else "%.3f" % v
+        b.append(f'{name}{{{labels}quantile="{q:g}"}} {v}')
+    labels = "{%s}" % labels[:-1] if labels else ""
+    b.append(f"{name}_sum{labels} {total:.3f}")
+    b.append(f"{name}_count{labels} {count}")
+    return b
+
+
+class MetricsHistogram:
+    def __init__(self, buckets):
+        # The bucket bounds are shared between all the histograms of the metric
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def lines(self, name, labels):
+        return histogram_lines(
+            name, labels, self.buckets, self.counts, self.count, self.sum
+        )
+
+    def export(self):
+        return [list(self.counts), self.count, self.sum]
+
+    def get_state(self):
+        return self.export()
+
+    def set_state(self, state):
+        counts, count, total = state
+        # The counts are not restored if the buckets were changed
+        if len(counts) != len(self.counts):
+            return False
+        self.counts = list(counts)
+        self.count = count
+        self.sum = total
+        return True
+
+
+class MetricsSummary:
+    def __init__(self, quantiles, accuracy, max_bins):
+        # The quantiles are shared between all the summaries of the metric
+        self.quantiles = quantiles
+        self.sketch = DDSketch(accuracy=accuracy, max_bins=max_bins)
+
+    def observe(self, value):
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+    def lines(self, name, labels):
+        return summary_lines(name, labels, self.quantiles, *self.export())
+
+    def export(self):
+        return [
+            [self.sketch.quantile(q) for q in self.quantiles],
+            self.sketch.count,
+            self.sketch.sum,
+        ]
+
+    def get_state(self):
+        return self.sketch.get_state()
+
+    def set_state(self, state):
+        return self.sketch.set_state(state)
+
+
+VALUE_TYPES = {
+    Metrics.TYPE_HISTOGRAM: MetricsHistogram,
+    Metrics.TYPE_SUMMARY: MetricsSummary,
 }
 
 
 class MetricsLabeledEntry:
-    def __init__(self, labels_defs, labels, lock):
-        self.value = 0
+    def __init__(self, labels_defs, labels, lock, new_value=None):
+        self.value = 0 if new_value is None else new_value()
+        self.updated = time()
+        # The rendered line is cached until the value is changed
+        self.line = None
         self._lock = lock
-        ls = []
-        i = 0
-        for li, lv in labels_defs:
-            ls.append(
-                '%s="%s"'
-                % (
-                    lv,
-                    str(labels[i]).replace('"', '\\"'),
-                )
-            )
-            i += 1
-        self.labels = ",".join(ls)
+        # The only exemplar of the series as (labels pairs, value, timestamp)
+        self.exemplar = None
+        self.label_values = labels
+        self.labels = render_labels([ln for _, ln in labels_defs], labels)
 
     def inc(self, inc_by=1):
         return self.set(inc_by=inc_by)
@@ -185,54 +718,335 @@ class MetricsLabeledEntry:
             self.value = value
         elif inc_by is not None:
             self.value += inc_by
+        if self.value != old_value:
+            self.line = None
         return old_value
 
+    def observe(self, value):
+        self.value.observe(value)
+        self.line = None
+
+    def set_exemplar(self, exemplar, policy):
+        policy, max_age = policy
+        if (
+            policy == Metrics.EXEMPLAR_MAX
+            and self.exemplar is not None
+            and self.exemplar[1] >= exemplar[1]
+            and (max_age is None or exemplar[2] - self.exemplar[2] < max_age)
+        ):
+            return
+        self.exemplar = exemplar
+
 
 class MetricsEntry:
-    def __init__(self, metric, lock):
+    def __init__(
+        self,
+        metric,
+        lock,
+        params=None,
+        limit=None,
+        on_drop=None,
+        exemplar=None,
+        expires=False,
+    ):
         self.mtype, self.label, self.doc, self._labels_defs = METRICS[metric]
         self._lock = lock
+        # The update times of the series are tracked for the metrics with TTL only
+        self._expires = expires
+        # The limit of the number of labeled series and the policy to apply
+        self._limit, self._limit_policy = limit if limit else (None, None)
+        self._on_drop = on_drop
+        # The policy and the max age of the exemplars to keep if enabled
+        self._exemplar_policy = exemplar
+        # The factory of the values for histograms and summaries
+        self._new_value = None
+        if self.mtype in VALUE_TYPES:
+            params = {**METRICS_PARAMS[metric], **(params or {})}
+            if "buckets" in params:
+                params["buckets"] = tuple(sorted(params["buckets"]))
+            if "quantiles" in params:
+                params["quantiles"] = tuple(params["quantiles"])
+            self._new_value = partial(VALUE_TYPES[self.mtype], **params)
+        # The rendered block is cached until any of the series is changed
+        self._block = None
+        # The counter of the changes of the series to tell if the metric
+        # is changed since it was rendered last time
+        self._version = 1
+        # The series changed and removed since the last delta was taken
+        self._changed = set()
+        self._removed = set()
         self.value = None
         # The entries with None in the value are labeled
         if self._labels_defs is None:
             # If there is no labels definitions set it as non labeled
-            self.value = 0
+            self.value = 0 if self._new_value is None else self._new_value()
         else:
-            self._labels = {}
+            if self._limit_policy == Metrics.LIMIT_LRU:
+                self._labels = OrderedDict()
+            else:
+                self._labels = {}
+            self._overflow_labels = (OVERFLOW_LABEL,) * len(self._labels_defs)
+
+    def _render_value(self, value, labels):
+        if self._new_value is not None:
+            return "\n".join(value.lines(self.label, labels))
+        v = "%.3f" % value if isinstance(value, float) else value
+        if labels:
+            return f"{self.label}{{{labels}}} {v}"
+        return f"{self.label} {v}"
+
+    def _render_header(self):
+        return "# HELP %s %s\n# TYPE %s %s" % (
+            self.label,
+            self.doc,
+            self.label,
+            TYPE_LABELS[self.mtype],
+        )
+
+    def _export_value(self, value):
+        if self._new_value is not None:
+            return value.export()
+        return value
+
+    def _get_value_state(self, value):
+        if self._new_value is not None:
+            return value.get_state()
+        return value
+
+    def _export_series(self, le):
+        # None stands for the value of the metric without labels
+        if le is None:
+            return [[], self._export_value(self.value)]
+        series = [[str(lv) for lv in le.label_values], self._export_value(le.value)]
+        if le.exemplar is not None:
+            labels, value, ts = le.exemplar
+            series.append([[list(label) for label in labels], value, ts])
+        return series
+
+    def get_state(self):
+        """
+        Get the label values, the values, the update times and the exemplars
+        of the series in the order of the LRU eviction to restore them with,
+        the lock is expected to be held by the caller
+        """
+
+        if self.value is not None:
+            return [[None, self._get_value_state(self.value), None, None]]
+        return [
+            [
+                list(le.label_values),
+                self._get_value_state(le.value),
+                le.updated,
+                le.exemplar,
+            ]
+            for le in self._labels.values()
+        ]
+
+    def set_state(self, series):
+        """
+        Restore the series got with get_state, the series not fitting
+        the current limit or parameters of the metric are skipped,
+        the lock is expected to be held by the caller
+        """
+
+        if self.value is None and self._limit:
+            series = series[-self._limit :]
+        for label_values, value, updated, exemplar in series:
+            if self._new_value is not None:
+                new_value = self._new_value()
+                if not new_value.set_state(value):
+                    continue
+                value = new_value
+            if label_values is None:
+                if self.value is not None:
+                    self.value = value
+                    self._changed.add(None)
+                continue
+            if self.value is not None:
+                continue
+            labels = tuple(label_values)
+            le = MetricsLabeledEntry(self._labels_defs, labels, self._lock)
+            le.value = value
+            le.updated = updated
+            if exemplar is not None and self._exemplar_policy is not None:
+                exemplar_labels, exemplar_value, exemplar_ts = exemplar
+                le.exemplar = (
+                    tuple(tuple(label) for label in exemplar_labels),
+                    exemplar_value,
+                    exemplar_ts,
+                )
+            self._labels[labels] = le
+            self._changed.add(le)
+        self._block = None
+        self._version += 1
+
+    def get_family(self):
+        """
+        Get the type, the description, the label names and the parameters
+        of the histogram buckets or the summary quantiles of the metric
+        """
+
+        params = None
+        if self._new_value is not None:
+            params = self._new_value.keywords.get(
+                "buckets", self._new_value.keywords.get("quantiles")
+            )
+            params = list(params)
+        labels_names = [ln for _, ln in self._labels_defs or ()]
+        return [self.mtype, self.doc, labels_names, params]
+
+    def _get_line(self, le):
+        if le.line is None:
+            le.line = self._render_value(le.value, le.labels)
+        return le.line
 
     def __str__(self):
-        b = []
-        b.append(f"# HELP {self.label} {self.doc}")
-        b.append(f"# TYPE {self.label} {TYPE_LABELS[self.mtype]}")
+        # Only the series changed since the last rendering are rendered again,
+        # the lock is expected to be held by the caller
+        if self._block is None:
+            b = [self._render_header()]
+            if self.value is None:
+                for le in self._labels.values():
+                    b.append(self._get_line(le))
+            else:
+                b.append(self._render_value(self.value, ""))
+            b.append("")
+            self._block = "\n".join(b)
+        return self._block
+
+    def get_series(self):
+        """
+        Get the list of the label values and the values of all the series
+        keeping the changes tracked for the next delta,
+        the lock is expected to be held by the caller
+        """
+
         if self.value is None:
-            for le in self._labels.values():
-                v = "%.3f" % le.value if isinstance(le.value, float) else le.value
-                b.append(f"{self.label}{{{le.labels}}} {v}")
+            return [self._export_series(le) for le in self._labels.values()]
+        return [self._export_series(None)]
+
+    def get_memory_stats(self):
+        """
+        Get the number of the series and the approximate size of the metric
+        """
+
+        size, objects = get_deep_size(self)
+        return {
+            "series": 1 if self.value is not None else len(self._labels),
+            "objects": objects,
+            "bytes": size,
+        }
+
+    def get_delta(self):
+        """
+        Get the series changed and removed since the last delta was taken,
+        the lock is expected to be held by the caller
+        """
+
+        if not self._changed and not self._removed:
+            return None
+        delta = {
+            "family": self.get_family(),
+            "set": [self._export_series(le) for le in self._changed],
+            "del": [list(labels) for labels in self._removed],
+        }
+        self._changed.clear()
+        self._removed.clear()
+        return delta
+
+    def _changed_labeled(self, le):
+        # The lock is expected to be held by the caller
+        le.line = None
+        self._block = None
+        self._version += 1
+        self._changed.add(le)
+
+    def _remove_labeled(self, labels):
+        # The lock is expected to be held by the caller
+        le = self._labels.pop(labels)
+        self._block = None
+        self._version += 1
+        self._changed.discard(le)
+        self._removed.add(tuple(str(lv) for lv in le.label_values))
+        return le
+
+    def _get_labeled(self, labels):
+        # The lock is expected to be held by the caller
+        dropped = False
+        if labels in self._labels:
+            le = self._labels[labels]
+            if self._limit_policy == Metrics.LIMIT_LRU:
+                self._labels.move_to_end(labels)
         else:
-            v = "%.3f" % self.value if isinstance(self.value, float) else self.value
-            b.append(f"{self.label} {v}")
-        b.append("")
-        return "\n".join(b)
+            # The overflow series of the hard limit is kept within the limit
+            if self._limit and len(self._labels) >= self._limit - (
+                self._limit_policy == Metrics.LIMIT_HARD
+                and self._overflow_labels not in self._labels
+            ):
+                dropped = True
+                if self._limit_policy == Metrics.LIMIT_LRU:
+                    self._remove_labeled(next(iter(self._labels)))
+                else:
+                    labels = self._overflow_labels
+            le = self._labels.get(labels)
+            if le is None:
+                le = MetricsLabeledEntry(
+                    self._labels_defs, labels, self._lock, self._new_value
+                )
+                self._labels[labels] = le
+                self._changed_labeled(le)
+        return le, dropped
+
+    def _dropped(self, dropped):
+        if dropped and self._on_drop is not None:
+            self._on_drop(self.label)
 
-    def _set_labeled(self, labels, value=None, inc_by=None):
+    def _set_labeled(self, labels, value=None, inc_by=None, exemplar=None):
         with self._lock:
-            if labels in self._labels:
-                le = self._labels[labels]
-            else:
-                le = MetricsLabeledEntry(self._labels_defs, labels, self._lock)
-                self._labels[labels] = le
-        return le.set(value, inc_by)
+            le, dropped = self._get_labeled(labels)
+            old_value = le.set(value, inc_by)
+            if self._expires:
+                le.updated = time()
+            if exemplar is not None and self._exemplar_policy is not None:
+                le.set_exemplar(exemplar, self._exemplar_policy)
+                self._changed_labeled(le)
+            elif le.value != old_value:
+                self._changed_labeled(le)
+        self._dropped(dropped)
+        return old_value
+
+    def observe(self, labels, value):
+        dropped = False
+        if self.value is None:
+            # The entries with None in the value are labeled
+            if labels is None:
+                raise KeyError
+            with self._lock:
+                le, dropped = self._get_labeled(labels)
+                le.observe(value)
+                if self._expires:
+                    le.updated = time()
+                self._changed_labeled(le)
+        else:
+            if labels is not None:
+                raise KeyError
+            with self._lock:
+                self.value.observe(value)
+                self._block = None
+                self._version += 1
+                self._changed.add(None)
+        self._dropped(dropped)
 
-    def inc(self, labels, inc_by):
-        return self.set(labels, inc_by=inc_by)
+    def inc(self, labels, inc_by, exemplar=None):
+        return self.set(labels, inc_by=inc_by, exemplar=exemplar)
 
-    def set(self, labels, value=None, inc_by=None):
+    def set(self, labels, value=None, inc_by=None, exemplar=None):
         old_value = None
         if self.value is None:
             # The entries with None in the value are labeled
             if labels is None:
                 raise KeyError
-            old_value = self._set_labeled(labels, value, inc_by)
+            old_value = self._set_labeled(labels, value, inc_by, exemplar)
         else:
             if labels is not None:
                 raise KeyError
@@ -242,49 +1056,163 @@ class MetricsEntry:
                     self.value = value
                 elif inc_by is not None:
                     self.value += inc_by
+                if self.value != old_value:
+                    self._block = None
+                    self._version += 1
+                    self._changed.add(None)
         return old_value
 
+    def set_all(self, values):
+        if self.value is not None:
+            raise KeyError
+        changed = False
+        dropped = 0
+        with self._lock:
+            for labels in list(self._labels.keys()):
+                if labels not in values and labels != self._overflow_labels:
+                    self._remove_labeled(labels)
+                    changed = True
+            # The new series are admitted within the limit of the series
+            # and the values over the hard limit are summed in the overflow one
+            new_values = {}
+            for labels, value in values.items():
+                known = labels in self._labels
+                overflow = self._labels.get(self._overflow_labels)
+                le, le_dropped = self._get_labeled(labels)
+                if not known and le is not overflow:
+                    changed = True
+                dropped += le_dropped
+                new_values[le] = new_values.get(le, 0) + value
+            if (
+                self._overflow_labels in self._labels
+                and self._labels[self._overflow_labels] not in new_values
+            ):
+                self._remove_labeled(self._overflow_labels)
+                changed = True
+            for le, value in new_values.items():
+                if self._labels.get(le.label_values) is not le:
+                    # Evicted by the series set after it
+                    continue
+                if le.value != value:
+                    le.value = value
+                    self._changed_labeled(le)
+                    changed = True
+                if self._expires:
+                    le.updated = time()
+        for _ in range(dropped):
+            self._dropped(True)
+        return changed
+
+    def expire(self, before):
+        if self.value is not None:
+            return 0
+        with self._lock:
+            expired = [
+                labels for labels, le in self._labels.items() if le.updated < before
+            ]
+            for labels in expired:
+                self._remove_labeled(labels)
+        return len(expired)
+
     def move(self, src_labels, dst_labels):
         if self.value is not None:
             return
         value = None
         with self._lock:
             if src_labels in self._labels:
-                value = self._labels.pop(src_labels).value
+                le = self._remove_labeled(src_labels)
+                value, exemplar = le.value, le.exemplar
         if value is None:
             return
-        self._set_labeled(dst_labels, inc_by=value)
+        if self._new_value is not None:
+            with self._lock:
+                le, dropped = self._get_labeled(dst_labels)
+                le.value.merge(value)
+                self._changed_labeled(le)
+            self._dropped(dropped)
+            return
+        self._set_labeled(dst_labels, inc_by=value, exemplar=exemplar)
 
 
 class MetricsCollection:
-    def __init__(self):
+    def __init__(self, params=None, limits=None, ttls=None, exemplars=None):
         self._epoch = 0
         self._lock = Lock()
+        # The parameters of the histograms and summaries to override the defaults
+        self._params = {} if params is None else params
+        # The limits of the number of series as (limit, policy) per metric
+        self._limits = {} if limits is None else limits
+        # The time in seconds to keep the series not updated per metric
+        self._ttls = {} if ttls is None else ttls
+        # The policies and the max ages of the exemplars per metric
+        self._exemplars = {} if exemplars is None else exemplars
         self.metrics = {}
 
     def get_epoch(self):
         return self._epoch
 
-    def inc(self, metric, labels=None, inc_by=1):
-        return self.set(metric, labels, inc_by=inc_by)
-
-    def set(self, metric, labels=None, value=None, inc_by=None):
+    def _get_entry(self, metric):
         with self._lock:
             if metric in self.metrics:
                 me = self.metrics[metric]
             else:
-                me = MetricsEntry(metric, self._lock)
+                me = MetricsEntry(
+                    metric,
+                    self._lock,
+                    self._params.get(metric),
+                    self._limits.get(metric),
+                    self._series_dropped,
+                    self._exemplars.get(metric),
+                    metric in self._ttls,
+                )
                 self.metrics[metric] = me
+        return me
+
+    def _series_dropped(self, label):
+        self.inc(Metrics.SALINE_INTERNAL_SERIES_DROPPED_TOTAL, (label,))
+
+    def inc(self, metric, labels=None, inc_by=1, exemplar=None):
+        return self.set(metric, labels, inc_by=inc_by, exemplar=exemplar)
+
+    def observe(self, metric, labels=None, value=0):
+        self._get_entry(metric).observe(labels, value)
+        self._epoch += 1
+
+    def set(self, metric, labels=None, value=None, inc_by=None, exemplar=None):
+        me = self._get_entry(metric)
         if value is not None:
-            old_value = me.set(labels, value)
-            if old_value != value:
+            old_value = me.set(labels, value, exemplar=exemplar)
+            if old_value != value or exemplar is not None:
                 self._epoch += 1
             return old_value
         elif inc_by is not None:
-            old_value = me.inc(labels, inc_by)
+            old_value = me.inc(labels, inc_by, exemplar=exemplar)
             self._epoch += 1
             return old_value
 
+    def set_all(self, metric, values):
+        """
+        Replace all the labeled values of the metric with the values specified
+        """
+
+        if self._get_entry(metric).set_all(values):
+            self._epoch += 1
+
+    def expire(self, ts=None):
+        """
+        Remove the labeled series not updated for longer than the metric TTL
+        """
+
+        if ts is None:
+            ts = time()
+        expired = 0
+        for metric, ttl in self._ttls.items():
+            if metric in self.metrics:
+                expired += self.metrics[metric].expire(ts - ttl)
+        if expired:
+            self._epoch += 1
+        return expired
+
     def move(self, metrics, src_labels, dst_labels):
         if not isinstance(metrics, (list, tuple)):
             metrics = [metrics]
@@ -293,8 +1221,92 @@ class MetricsCollection:
                 continue
             self.metrics[metric].move(src_labels, dst_labels)
 
-    def get_buf(self):
+    def get_buf(self, metrics=None, reset_changes=False):
         buf = ""
         with self._lock:
-            buf = "".join(map(str, self.metrics.values()))
+            if metrics is None:
+                buf = "".join(map(str, self.metrics.values()))
+            else:
+                buf = "".join(
+                    str(me) for metric, me in self.metrics.items() if metric in metrics
+                )
+            if reset_changes:
+                # The changes are not tracked if the deltas are not taken
+                for me in self.metrics.values():
+                    me._changed.clear()
+                    me._removed.clear()
         return buf
+
+    def get_version(self, metrics=None):
+        """
+        Get the number changed on any change of the metrics specified
+        or of all the metrics, the number is not changed on rendering them
+        """
+
+        with self._lock:
+            return sum(
+                me._version
+                for metric, me in self.metrics.items()
+                if metrics is None or metric in metrics
+            )
+
+    def get_memory_stats(self):
+        """
+        Get the memory stats of each metric by the metric names
+        """
+
+        return {me.label: me.get_memory_stats() for me in list(self.metrics.values())}
+
+    def get_snapshot(self):
+        """
+        Get all the metrics families and series, the changes tracking
+        is not reset, so the next delta still has the series changed
+        since the last delta for the subscribers not taking the snapshot
+        """
+
+        with self._lock:
+            return {
+                me.label: {
+                    "family": me.get_family(),
+                    "series": me.get_series(),
+                }
+                for me in self.metrics.values()
+            }
+
+    def get_state(self):
+        """
+        Get the series of all the metrics by the metric names to restore
+        the collection with after restart
+        """
+
+        with self._lock:
+            return {me.label: me.get_state() for me in self.metrics.values()}
+
+    def set_state(self, state):
+        """
+        Restore the series of the metrics got with get_state,
+        the metrics unknown to the current version are skipped
+        """
+
+        metric_ids = {label: metric for metric, (_, label, _, _) in METRICS.items()}
+        for label, series in state.items():
+            if label not in metric_ids:
+                log.warning("Unable to restore the unknown metric '%s'", label)
+                continue
+            me = self._get_entry(metric_ids[label])
+            with self._lock:
+                me.set_state(series)
+        self._epoch += 1
+
+    def get_delta(self):
+        """
+        Get the series changed and removed since the last delta or snapshot
+        """
+
+        delta = {}
+        with self._lock:
+            for me in self.metrics.values():
+                me_delta = me.get_delta()
+                if me_delta is not None:
+                    delta[me.label] = me_delta
+        return delta
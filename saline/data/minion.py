@@ -1,18 +1,22 @@
 import logging
 
+from collections import OrderedDict
+from itertools import chain, islice, takewhile
 from threading import Lock
 from time import time
 
 from saline.data.parser import EventTags
-from saline.data.state import JobStatus
+from saline.data.size import get_deep_size
+from saline.data.state import JobStatus, SaltJob, StateJob, dump_jid, load_jid
 
 
 log = logging.getLogger(__name__)
 
 
 class Minion:
-    def __init__(self, name, lock):
+    def __init__(self, name, lock, group="-"):
         self._name = name
+        self._group = group
         if lock is None:
             lock = Lock()
         self._lock = lock
@@ -32,16 +36,27 @@ class Minion:
     def name(self):
         return self._name
 
+    def group(self):
+        return self._group
+
+    def _add_request(self, ts, jid, pending):
+        # The lock is expected to be held by the caller
+        self._request_last = max(ts, self._request_last)
+        self._request_count += 1
+        if pending is not None and jid not in self._pending_jobs:
+            self._pending_jobs[jid] = pending
+        self._updates += 1
+
     def update(self, ts, status, jid=None, job=None):
         if ts is None:
             ts = time()
         if status == JobStatus.NEW:
-            self._request_last = max(ts, self._request_last)
-            self._request_count += 1
+            pending = None
             if jid is not None and job is not None:
-                with self._lock:
-                    if jid not in self._pending_jobs:
-                        self._pending_jobs[jid] = (job, ts)
+                pending = (job, ts)
+            with self._lock:
+                self._add_request(ts, jid, pending)
+            return
         elif status in (JobStatus.SUCCEEDED, JobStatus.FAILED):
             with self._lock:
                 self._seen_last = max(ts, self._seen_last)
@@ -82,6 +97,17 @@ class Minion:
         self._pending_jobs.pop(jid, None)
         self._offline_jobs.pop(jid, None)
 
+    def cleanup_completed(self, before):
+        """
+        Remove the completed jobs not cleaned up with their state jobs,
+        the lock is expected to be held by the caller
+        """
+
+        expired = [jid for jid, (_, ts) in self._completed_jobs.items() if ts < before]
+        for jid in expired:
+            del self._completed_jobs[jid]
+        return len(expired)
+
     def is_offline(self):
         return (
             True
@@ -92,6 +118,123 @@ class Minion:
             else False
         )
 
+    @staticmethod
+    def _get_jobs_state(jobs, pending):
+        # The entries shared by the minions are stored once
+        # in the table of the pending jobs and referred with the indexes
+        state = []
+        for entry in jobs.values():
+            if id(entry) not in pending:
+                pending[id(entry)] = (len(pending), entry)
+            state.append(pending[id(entry)][0])
+        return state
+
+    @staticmethod
+    def _set_jobs_state(jobs_state, pending):
+        return dict(pending[idx] for idx in jobs_state if pending[idx] is not None)
+
+    def get_state(self, names, pending):
+        """
+        Get the state of the minion as the list of the plain values,
+        the lock is expected to be held by the caller
+        """
+
+        return [
+            names[self._name],
+            self._request_last,
+            self._request_count,
+            self._response_last,
+            self._response_count,
+            self._offline_last,
+            self._offline_count,
+            self._seen_last,
+            self._seen_count,
+            self._updates,
+            self._get_jobs_state(self._pending_jobs, pending),
+            [
+                [dump_jid(jid), count, ts]
+                for jid, (count, ts) in self._completed_jobs.items()
+            ],
+            self._get_jobs_state(self._offline_jobs, pending),
+        ]
+
+    def set_state(self, state, pending):
+        """
+        Restore the state got with get_state,
+        the lock is expected to be held by the caller
+        """
+
+        (
+            _,
+            self._request_last,
+            self._request_count,
+            self._response_last,
+            self._response_count,
+            self._offline_last,
+            self._offline_count,
+            self._seen_last,
+            self._seen_count,
+            self._updates,
+            pending_jobs,
+            completed_jobs,
+            offline_jobs,
+        ) = state
+        self._pending_jobs = self._set_jobs_state(pending_jobs, pending)
+        self._completed_jobs = {
+            load_jid(jid): [count, ts] for jid, count, ts in completed_jobs
+        }
+        self._offline_jobs = self._set_jobs_state(offline_jobs, pending)
+
+    def get_status(self):
+        """
+        Get the status of the minion, the lock is expected to be held
+        """
+
+        if self.is_offline():
+            return "offline"
+        if self._pending_jobs:
+            return "pending"
+        return "online"
+
+    def get_info(self, details=False):
+        """
+        Get the summary of the minion with the jobs it's tracked with
+        on the details requested, the lock is expected to be held
+        """
+
+        info = {
+            "id": self._name,
+            "group": self._group,
+            "status": self.get_status(),
+            "seen_last": self._seen_last or None,
+            "request_last": self._request_last or None,
+            "response_last": self._response_last or None,
+            "offline_last": self._offline_last,
+            "pending_jobs": len(self._pending_jobs),
+        }
+        if details:
+            info.update(
+                {
+                    "seen_count": self._seen_count,
+                    "request_count": self._request_count,
+                    "response_count": self._response_count,
+                    "offline_count": self._offline_count,
+                    "pending_jobs": [
+                        {"jid": dump_jid(jid), "req_ts": ts}
+                        for jid, (_, ts) in self._pending_jobs.items()
+                    ],
+                    "offline_jobs": [
+                        {"jid": dump_jid(jid), "req_ts": ts}
+                        for jid, (_, ts) in self._offline_jobs.items()
+                    ],
+                    "completed_jobs": [
+                        {"jid": dump_jid(jid), "returns": count, "ts": ts}
+                        for jid, (count, ts) in self._completed_jobs.items()
+                    ],
+                }
+            )
+        return info
+
     def update_last_seen_time(self, ts):
         with self._lock:
             self._seen_last = max(ts, self._seen_last)
@@ -102,20 +245,57 @@ class Minion:
 
 
 class MinionsCollection:
-    def __init__(self):
+    def __init__(self, groups=None):
         self._minions = {}
         self._lock = Lock()
+        self._groups = [] if groups is None else groups
+        # The minions in the order of updating their last seen time,
+        # the most recently seen ones are at the end
+        self._seen_order = OrderedDict()
+        # The indexes of the minions by the statuses except the online one
+        self._statuses = {"offline": set(), "pending": set()}
+
+    def _new_minion(self, name):
+        # The lock is expected to be held by the caller
+        group = "-"
+        for pattern, group_name in self._groups:
+            if pattern.match(str(name)):
+                group = group_name
+                break
+        minion = Minion(name, self._lock, group)
+        self._minions[name] = minion
+        return minion
 
     def get(self, name):
         with self._lock:
             if name not in self._minions:
-                self._minions[name] = Minion(name, self._lock)
+                self._new_minion(name)
         return self._minions[name]
 
+    def _update_indexes(self, minions, seen_ts=None):
+        # The lock is expected to be held by the caller
+        offline = self._statuses["offline"]
+        pending = self._statuses["pending"]
+        for name in minions:
+            minion = self._minions[name]
+            if minion.is_offline():
+                offline.add(name)
+            else:
+                offline.discard(name)
+            if minion._pending_jobs:
+                pending.add(name)
+            else:
+                pending.discard(name)
+            if seen_ts is not None and minion._seen_last <= seen_ts:
+                if name in self._seen_order:
+                    self._seen_order.move_to_end(name)
+                else:
+                    self._seen_order[name] = None
+
     def update(self, minions, ts=None, **kwargs):
         if ts is None:
             ts = time()
-        if not isinstance(minions, (list, tuple)):
+        if not isinstance(minions, (list, tuple, set, frozenset)):
             minions = [minions]
         with_tag = kwargs.pop("with_tag", None)
         if with_tag in (
@@ -125,21 +305,198 @@ class MinionsCollection:
         ):
             for minion in minions:
                 self.get(minion).update_last_seen_time(ts)
+            with self._lock:
+                self._update_indexes(minions, ts)
+            return
+        if kwargs.get("status") == JobStatus.NEW:
+            self.update_targets(minions, ts, kwargs.get("jid"), kwargs.get("job"))
             return
         for minion in minions:
             self.get(minion).update(ts, **kwargs)
+        with self._lock:
+            self._update_indexes(minions, ts)
+
+    def update_targets(self, minions, ts, jid=None, job=None):
+        """
+        Register the job request for the whole target list at once
+
+        The lock is acquired only once for the whole list
+        and the same pending job entry is shared by all the minions
+        """
+
+        pending = None
+        if jid is not None and job is not None:
+            pending = (job, ts)
+        with self._lock:
+            for name in minions:
+                minion = self._minions.get(name)
+                if minion is None:
+                    minion = self._new_minion(name)
+                minion._add_request(ts, jid, pending)
+            if pending is not None:
+                self._statuses["pending"].update(minions)
 
     def offline(self, minions, ts=None):
         if ts is None:
             ts = time()
-        if not isinstance(minions, (list, tuple)):
+        if not isinstance(minions, (list, tuple, set, frozenset)):
             minions = [minions]
         for minion in minions:
             self.get(minion).offline(ts)
+        with self._lock:
+            self._update_indexes(minions)
+
+    def cleanup_jid(self, minions, jid):
+        """
+        Remove the jid from the jobs of the minions targeted by it
+        """
+
+        with self._lock:
+            for name in minions:
+                minion = self._minions.get(name)
+                if minion is not None:
+                    minion.cleanup_jid(jid)
+                    if not minion._pending_jobs:
+                        self._statuses["pending"].discard(name)
 
     def get_count(self):
         return len(self._minions)
 
+    def cleanup_completed(self, before):
+        """
+        Remove the completed jobs of the minions completed before the time,
+        the jobs not tracked with the state jobs are never cleaned up otherwise
+        """
+
+        expired = 0
+        with self._lock:
+            for minion in self._minions.values():
+                if minion._completed_jobs:
+                    expired += minion.cleanup_completed(before)
+        return expired
+
+    def get_state(self, names, jobs):
+        """
+        Get the states of all the minions with the table of the pending jobs
+        referring the state jobs with the indexes in the list specified
+        """
+
+        jobs_ids = {id(job): idx for idx, job in enumerate(jobs)}
+        pending = {}
+        with self._lock:
+            minions = [
+                minion.get_state(names, pending) for minion in self._minions.values()
+            ]
+        return [
+            [
+                [dump_jid(job.get_jid()), jobs_ids.get(id(job.get_parent())), ts]
+                for _, (job, ts) in pending.values()
+            ],
+            minions,
+        ]
+
+    def set_state(self, state, names, jobs):
+        """
+        Restore the minions got with get_state
+        with the list of the state jobs restored
+        """
+
+        pending_state, minions_state = state
+        # The pending jobs entries are shared by the minions as on the requests
+        pending = []
+        for jid, idx, ts in pending_state:
+            jid = load_jid(jid)
+            job = None if idx is None else jobs[idx].get_salt_job(jid)
+            pending.append(None if job is None else (jid, (job, ts)))
+        with self._lock:
+            for minion_state in minions_state:
+                name = names[minion_state[0]]
+                minion = self._minions.get(name)
+                if minion is None:
+                    minion = self._new_minion(name)
+                minion.set_state(minion_state, pending)
+            self._update_indexes(self._minions)
+            self._seen_order = OrderedDict(
+                (minion.name(), None)
+                for minion in sorted(
+                    self._minions.values(), key=lambda x: x.get_last_seen_time()
+                )
+                if minion.get_last_seen_time()
+            )
+
+    def get_info(self, name):
+        """
+        Get the details of the minion or None if the minion is unknown
+        """
+
+        with self._lock:
+            minion = self._minions.get(name)
+            if minion is None:
+                return None
+            return minion.get_info(details=True)
+
+    def query(self, status=None, group=None, seen_after=None, offset=0, limit=100):
+        """
+        Get the page of the minions filtered by the status, the group and
+        the last seen time starting from the most recently seen ones,
+        and whether there are more minions after the page
+
+        The minions are taken in the order of the updates of the last seen
+        time filtered by the index of the status, so the collection is never
+        sorted while the lock is held.
+        """
+
+        with self._lock:
+            names = reversed(self._seen_order)
+            if status in self._statuses:
+                # The index keeps no order, so the members are taken
+                # in the order of the last seen time without sorting it
+                indexed = self._statuses[status]
+                names = (name for name in names if name in indexed)
+                never_seen = (
+                    name for name in indexed if not self._minions[name]._seen_last
+                )
+            else:
+                never_seen = (
+                    name
+                    for name, minion in self._minions.items()
+                    if not minion._seen_last
+                )
+            if seen_after is None:
+                # The minions never seen are at the end
+                names = chain(names, never_seen)
+            minions = map(self._minions.__getitem__, names)
+            if seen_after is not None:
+                minions = takewhile(lambda x: x._seen_last >= seen_after, minions)
+            if group is not None:
+                minions = (minion for minion in minions if minion._group == group)
+            if status is not None and status not in self._statuses:
+                minions = (
+                    minion for minion in minions if minion.get_status() == status
+                )
+            page = [
+                minion.get_info()
+                for minion in islice(minions, offset, offset + limit + 1)
+            ]
+        return page[:limit], len(page) > limit
+
+    def get_memory_stats(self):
+        """
+        Get the numbers of the minions and their jobs and the approximate size
+        of them without the jobs referred by the minions
+        """
+
+        minions = list(self._minions.values())
+        size, objects = get_deep_size(self._minions, skip=(SaltJob, StateJob))
+        return {
+            "minions": len(minions),
+            "pending_jobs": sum(len(minion._pending_jobs) for minion in minions),
+            "completed_jobs": sum(len(minion._completed_jobs) for minion in minions),
+            "offline_jobs": sum(len(minion._offline_jobs) for minion in minions),
+            "objects": objects,
+            "bytes": size,
+        }
+
     def get_stats(self, ts=None):
         if ts is None:
             ts = time()
@@ -0,0 +1,83 @@
+from array import array
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class RollingRates:
+    """
+    Rolling window rates of the keys counted in the ring buffers
+    of per second bins
+
+    Each key has the ring of the bins covering the longest window
+    and the running sums per window, so the memory used per key is constant
+    and the rates are taken without summing the bins. The number of keys
+    is limited with capacity, the least recently counted key is evicted
+    on adding a new key to the full tracker.
+    """
+
+    def __init__(self, windows=(60, 300, 900), capacity=1000):
+        self.windows = tuple(sorted(windows))
+        self._size = self.windows[-1]
+        self._capacity = capacity
+        self._lock = Lock()
+        # The bins, the running sums per window and the second of the last bin
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _advance(self, entry, sec):
+        bins, sums, last = entry
+        if sec <= last:
+            return
+        if sec - last >= self._size:
+            for i in range(self._size):
+                bins[i] = 0
+            for i in range(len(sums)):
+                sums[i] = 0
+        else:
+            for s in range(last + 1, sec + 1):
+                # The bin of the second leaving the window is subtracted
+                # before the bin is reused for the new second
+                for i, window in enumerate(self.windows):
+                    sums[i] -= bins[(s - window) % self._size]
+                bins[s % self._size] = 0
+        entry[2] = sec
+
+    def add(self, key, count=1, ts=None):
+        sec = int(time() if ts is None else ts)
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                if len(self._keys) >= self._capacity:
+                    self._keys.popitem(last=False)
+                entry = [array("L", [0]) * self._size, [0] * len(self.windows), sec]
+                self._keys[key] = entry
+            else:
+                self._keys.move_to_end(key)
+                self._advance(entry, sec)
+            bins, sums, last = entry
+            # The events with the timestamps in the past are counted in the last bin
+            bins[last % self._size] += count
+            for i in range(len(sums)):
+                sums[i] += count
+
+    def rates(self, ts=None):
+        """
+        Get the list of the rates per second by the keys for each window,
+        the keys not counted within the longest window are removed
+        """
+
+        sec = int(time() if ts is None else ts)
+        rates = [{} for _ in self.windows]
+        with self._lock:
+            for key, entry in list(self._keys.items()):
+                self._advance(entry, sec)
+                sums = entry[1]
+                if not sums[-1]:
+                    del self._keys[key]
+                    continue
+                for i, window in enumerate(self.windows):
+                    rates[i][key] = sums[i] / window
+        return rates
@@ -0,0 +1,69 @@
+import sys
+
+from collections import deque
+from threading import Lock
+from types import (
+    BuiltinFunctionType,
+    FunctionType,
+    MethodType,
+    ModuleType,
+)
+
+
+# The objects not owned by the data structures referring to them
+SKIP_TYPES = (
+    type,
+    ModuleType,
+    FunctionType,
+    BuiltinFunctionType,
+    MethodType,
+    type(Lock()),
+)
+
+
+def get_deep_size(obj, skip=(), seen=None):
+    """
+    Get the approximate size in bytes and the number of the objects
+    reachable from the object
+
+    The objects of the skip types referred from the object are not counted,
+    the objects in the seen set of IDs are not counted and it's updated,
+    so it can be shared to count the objects shared by the structures once.
+    The containers are copied before iterating as the copying is atomic
+    while they can be changed by the other threads.
+    """
+
+    if seen is None:
+        seen = set()
+    size = 0
+    count = 0
+    stack = [obj]
+    root = True
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIP_TYPES):
+            continue
+        if not root and skip and isinstance(obj, skip):
+            continue
+        root = False
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        count += 1
+        if isinstance(obj, dict):
+            for key, value in list(obj.items()):
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(list(obj))
+        elif not isinstance(obj, (str, bytes, int, float)):
+            try:
+                # Avoid the lookup of the attribute with __getattr__
+                stack.append(object.__getattribute__(obj, "__dict__"))
+            except AttributeError:
+                pass
+            for cls in type(obj).__mro__:
+                slots = cls.__dict__.get("__slots__", ())
+                for slot in (slots,) if isinstance(slots, str) else slots:
+                    if slot not in ("__dict__", "__weakref__") and hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+    return size, count
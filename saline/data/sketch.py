@@ -0,0 +1,196 @@
+from heapq import heapify, heappop, heappush, heapreplace
+from math import ceil, log
+
+
+class DDSketch:
+    """
+    Quantiles sketch with the relative accuracy guarantee
+
+    The number of bins is limited with max_bins, the lowest bins are collapsed
+    on reaching the limit, so the memory used by the sketch stays constant
+    while the accuracy of the upper quantiles is preserved.
+    """
+
+    __slots__ = (
+        "_gamma",
+        "_log_gamma",
+        "_max_bins",
+        "_min_key",
+        "_bins",
+        "zero",
+        "count",
+        "sum",
+    )
+
+    # The values below are counted in the zero bin
+    MIN_VALUE = 1e-9
+
+    def __init__(self, accuracy=0.05, max_bins=128):
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = log(self._gamma)
+        self._max_bins = max_bins
+        self._min_key = None
+        self._bins = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def _key(self, value):
+        key = ceil(log(value) / self._log_gamma)
+        if self._min_key is not None and key < self._min_key:
+            return self._min_key
+        return key
+
+    def _collapse(self):
+        keys = sorted(self._bins.keys())
+        collapse_count = len(keys) - self._max_bins
+        if collapse_count <= 0:
+            return
+        dst_key = keys[collapse_count]
+        for key in keys[:collapse_count]:
+            self._bins[dst_key] += self._bins.pop(key)
+        self._min_key = dst_key
+
+    def add(self, value, count=1):
+        self.count += count
+        self.sum += value * count
+        if value <= self.MIN_VALUE:
+            self.zero += count
+            return
+        key = self._key(value)
+        if key in self._bins:
+            self._bins[key] += count
+        else:
+            self._bins[key] = count
+            if len(self._bins) > self._max_bins:
+                self._collapse()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.zero += other.zero
+        if other._min_key is not None and (
+            self._min_key is None or other._min_key > self._min_key
+        ):
+            self._min_key = other._min_key
+            for key in [k for k in self._bins if k < self._min_key]:
+                self._bins[self._min_key] = self._bins.get(
+                    self._min_key, 0
+                ) + self._bins.pop(key)
+        for key, count in other._bins.items():
+            key = key if self._min_key is None else max(key, self._min_key)
+            self._bins[key] = self._bins.get(key, 0) + count
+        self._collapse()
+
+    def get_state(self):
+        return [
+            self._gamma,
+            self._min_key,
+            [[key, count] for key, count in self._bins.items()],
+            self.zero,
+            self.count,
+            self.sum,
+        ]
+
+    def set_state(self, state):
+        """
+        Restore the state got with get_state,
+        the state of the sketch with the different accuracy is not restored
+        """
+
+        gamma, min_key, bins, zero, count, total = state
+        if gamma != self._gamma:
+            return False
+        self._min_key = min_key
+        self._bins = dict(bins)
+        self.zero = zero
+        self.count = count
+        self.sum = total
+        self._collapse()
+        return True
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        cnt = self.zero
+        if cnt > rank:
+            return 0.0
+        for key in sorted(self._bins.keys()):
+            cnt += self._bins[key]
+            if cnt > rank:
+                return 2 * self._gamma**key / (self._gamma + 1)
+        return 2 * self._gamma**key / (self._gamma + 1)
+
+
+class SpaceSaving:
+    """
+    Heavy hitters tracker with the fixed number of counters
+
+    On adding a new key to the full tracker the key with the lowest count
+    is replaced with the new one inheriting its count as the error.
+    """
+
+    def __init__(self, capacity=1000):
+        self._capacity = capacity
+        self._counters = {}
+        # Each key tracked has an entry in the heap, the counts in the heap
+        # are refreshed lazily on eviction and the entries of the keys
+        # moved out are skipped
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counters)
+
+    def add(self, key, weight=1):
+        counter = self._counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self._counters) < self._capacity:
+            self._counters[key] = [weight, 0]
+            heappush(self._heap, (weight, key))
+            return
+        while True:
+            count, min_key = self._heap[0]
+            counter = self._counters.get(min_key)
+            if counter is None:
+                heappop(self._heap)
+                continue
+            if counter[0] == count:
+                break
+            heapreplace(self._heap, (counter[0], min_key))
+        heappop(self._heap)
+        self._counters.pop(min_key)
+        self._counters[key] = [count + weight, count]
+        heappush(self._heap, (count + weight, key))
+
+    def move(self, src_key, dst_key):
+        """
+        Move the count of the key to the other one,
+        the counts and the errors are summed if both keys are tracked
+        """
+
+        if src_key == dst_key or src_key not in self._counters:
+            return
+        counter = self._counters.pop(src_key)
+        dst_counter = self._counters.get(dst_key)
+        if dst_counter is not None:
+            dst_counter[0] += counter[0]
+            dst_counter[1] += counter[1]
+            return
+        self._counters[dst_key] = counter
+        heappush(self._heap, (counter[0], dst_key))
+        if len(self._heap) > 2 * self._capacity:
+            # The heap is rebuilt without the entries of the keys moved out
+            self._heap = [(c[0], k) for k, c in self._counters.items()]
+            heapify(self._heap)
+
+    def top(self, size=None):
+        """
+        Get the list of (key, count, error) with the highest counts
+        """
+
+        items = list(self._counters.items())
+        items.sort(key=lambda x: x[1][0], reverse=True)
+        return [(k, c, e) for k, (c, e) in items[:size]]
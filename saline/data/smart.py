@@ -2,6 +2,8 @@ import re
 
 from difflib import SequenceMatcher
 
+from saline.data.size import get_deep_size
+
 
 class SmartMerger:
     def __init__(
@@ -46,6 +48,24 @@ class SmartMerger:
                 return r
         return value
 
+    def get_rules(self):
+        """
+        Get the merging rules as the pairs of the pattern and the replacement
+        """
+
+        return [[pattern.pattern, replacement] for pattern, replacement in self._rules]
+
+    def set_rules(self, rules):
+        """
+        Restore the merging rules got with get_rules
+        """
+
+        self._rules = [
+            (re.compile(pattern), replacement) for pattern, replacement in rules
+        ]
+        self._patterns = [pattern for pattern, _ in self._rules]
+        self._replacements = [replacement for _, replacement in self._rules]
+
     def in_replacements(self, value):
         return True if value in self._replacements else False
 
@@ -224,3 +244,34 @@ class MergeWrapper:
 
     def get_wrapped(self, value):
         return self._sm.get(value)
+
+    def get_rules(self):
+        return self._sm.get_rules()
+
+    def set_rules(self, rules):
+        self._sm.set_rules(rules)
+
+    def get_memory_stats(self):
+        """
+        Get the numbers of the keys and the merge rules on each level
+        of the tree of the wrappers and the approximate size of the tree
+        """
+
+        size, objects = get_deep_size(self)
+        levels = []
+        wrappers = [self]
+        while wrappers:
+            levels.append(
+                {
+                    "keys": sum(len(wrapper._data) for wrapper in wrappers),
+                    "rules": sum(len(wrapper._sm._rules) for wrapper in wrappers),
+                }
+            )
+            wrappers = [
+                value
+                for wrapper in wrappers
+                if isinstance(wrapper._data, dict)
+                for value in list(wrapper._data.values())
+                if isinstance(value, MergeWrapper)
+            ]
+        return {"levels": levels, "objects": objects, "bytes": size}
@@ -1,8 +1,13 @@
 import logging
 
+from functools import lru_cache
+from itertools import chain, islice
+from sys import intern
 from threading import Lock
 from time import time
 
+from saline.data.size import get_deep_size
+
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +18,66 @@ class JobStatus:
     FAILED = 2
 
 
+def get_targets(minions):
+    """
+    Get the target list as a frozen set of interned minion IDs
+
+    The set is shared by reference between the structures tracking the job,
+    so the minion names are not copied for each of them
+    """
+
+    if isinstance(minions, frozenset):
+        return minions
+    if not isinstance(minions, (list, tuple, set)):
+        minions = (minions,)
+    return frozenset(intern(x) if isinstance(x, str) else x for x in minions)
+
+
+@lru_cache(maxsize=1024)
+def dump_jid(jid):
+    """
+    Get the jid to store in the state snapshot,
+    the numeric jids don't fit the 64-bit integers of msgpack
+    """
+
+    return str(jid) if isinstance(jid, int) else jid
+
+
+@lru_cache(maxsize=1024)
+def load_jid(jid):
+    """
+    Get the jid from the state snapshot converted the same way as on parsing
+    """
+
+    try:
+        return int(jid)
+    except (TypeError, ValueError):
+        return jid
+
+
+class NamesIndex(dict):
+    """
+    The indexes of the minion names referred in the state snapshot,
+    so each name is stored and restored only once
+    """
+
+    def __missing__(self, name):
+        idx = self[name] = len(self)
+        return idx
+
+    def get_indexes(self, names):
+        return list(map(self.__getitem__, names))
+
+
+def get_names_dict(names, indexes, values):
+    """
+    Get the dict by the minion names from the indexes of the names
+    and the values got with the NamesIndex
+    """
+
+    return dict(zip(map(names.__getitem__, indexes), values))
+
+
 class SaltJob:
     def __init__(self, jid, parent, lock):
         self._jid = jid
@@ -20,27 +85,190 @@ class SaltJob:
         self._lock = lock
         self._req_ts = None
         self._last_resp_ts = None
-        self._minions = set()
+        self._minions = frozenset()
         self._minions_done = {}
         self._minions_timeout = {}
+        # The minions responded with the failure, the rest of done succeeded
+        self._minions_failed = set()
         self._completed = None
 
     def update(self, minions, ts, status):
+        minions = get_targets(minions)
         with self._lock:
-            self._minions.update(minions)
+            if not minions.issubset(self._minions):
+                # The minions targeted are pending until they respond
+                self._parent.add_pending(self._jid, minions.difference(self._minions))
+                if self._minions:
+                    self._minions = self._minions.union(minions)
+                else:
+                    self._minions = minions
         if status == JobStatus.NEW:
             self._req_ts = ts
         else:
             self._last_resp_ts = ts
             with self._lock:
+                self._parent.remove_pending(
+                    self._jid,
+                    [
+                        minion
+                        for minion in minions
+                        if minion not in self._minions_done
+                        and minion not in self._minions_timeout
+                    ],
+                )
                 for minion in minions:
                     self._minions_timeout.pop(minion, None)
                     self._minions_done[minion] = ts
+                if status == JobStatus.FAILED:
+                    self._minions_failed.update(minions)
+                else:
+                    self._minions_failed.difference_update(minions)
             if self._set_completed():
                 self._parent.completed_jid(self._jid, ts)
 
     def get_minions(self):
-        return self._minions.copy()
+        return self._minions
+
+    def get_pending_minions(self):
+        """
+        Get the minions not responded yet, the lock is expected to be held
+        """
+
+        return self._minions.difference(self._minions_done, self._minions_timeout)
+
+    def get_jid(self):
+        return self._jid
+
+    def get_request_time(self):
+        return self._req_ts
+
+    def get_results(self):
+        """
+        Get the results of the minions as (minion, status, ts) tuples
+        """
+
+        with self._lock:
+            results = [
+                (
+                    minion,
+                    "failed" if minion in self._minions_failed else "succeeded",
+                    ts,
+                )
+                for minion, ts in self._minions_done.items()
+            ]
+            results.extend(
+                (minion, "timedout", ts) for minion, ts in self._minions_timeout.items()
+            )
+        return results
+
+    def get_parent(self):
+        return self._parent
+
+    def get_info(self):
+        """
+        Get the summary of the job with the numbers of the minions by the results
+        """
+
+        with self._lock:
+            minions = len(self._minions)
+            done = len(self._minions_done)
+            failed = len(self._minions_failed)
+            timedout = len(self._minions_timeout)
+            completed = self._completed
+        return {
+            "jid": dump_jid(self._jid),
+            "status": "completed" if completed else "pending",
+            "req_ts": self._req_ts,
+            "last_resp_ts": self._last_resp_ts,
+            "completed_ts": self.completed() if completed else None,
+            "minions": minions,
+            "pending": minions - done - timedout,
+            "succeeded": done - failed,
+            "failed": failed,
+            "timedout": timedout,
+        }
+
+    def _get_minion_result(self, minion):
+        # The lock is expected to be held by the caller
+        if minion in self._minions_done:
+            status = "failed" if minion in self._minions_failed else "succeeded"
+            return minion, status, self._minions_done[minion]
+        if minion in self._minions_timeout:
+            return minion, "timedout", self._minions_timeout[minion]
+        return minion, "pending", None
+
+    def get_minions_results(self, status=None, minion=None, offset=0, limit=100):
+        """
+        Get the page of the results of the minions as (minion, status, ts)
+        tuples with the pending minions having no time of the result,
+        and whether there are more results after the page
+
+        The results are taken from the targets or from the results
+        with the status without sorting them, so the cost depends
+        on the size of the page and the offset.
+        """
+
+        with self._lock:
+            if minion is not None:
+                minions = (minion,) if minion in self._minions else ()
+            elif status == "succeeded":
+                minions = self._minions_done
+            elif status == "failed":
+                minions = self._minions_failed
+            elif status == "timedout":
+                minions = self._minions_timeout
+            else:
+                minions = self._minions
+            results = map(self._get_minion_result, minions)
+            if status is not None:
+                results = (result for result in results if result[1] == status)
+            page = list(islice(results, offset, offset + limit + 1))
+        return page[:limit], len(page) > limit
+
+    def get_state(self, names):
+        """
+        Get the state of the job as the list of the plain values,
+        the lock is expected to be held by the caller
+        """
+
+        return [
+            dump_jid(self._jid),
+            self._req_ts,
+            self._last_resp_ts,
+            names.get_indexes(self._minions),
+            names.get_indexes(self._minions_done),
+            list(self._minions_done.values()),
+            names.get_indexes(self._minions_timeout),
+            list(self._minions_timeout.values()),
+            names.get_indexes(self._minions_failed),
+            self._completed,
+        ]
+
+    def set_state(self, state, names, targets):
+        """
+        Restore the state got with get_state, the target lists are shared
+        with the jobs restored before with the same targets
+        """
+
+        (
+            _,
+            self._req_ts,
+            self._last_resp_ts,
+            minions,
+            minions_done,
+            minions_done_ts,
+            minions_timeout,
+            minions_timeout_ts,
+            minions_failed,
+            self._completed,
+        ) = state
+        minions = frozenset(map(names.__getitem__, minions))
+        self._minions = targets.setdefault(minions, minions)
+        self._minions_done = get_names_dict(names, minions_done, minions_done_ts)
+        self._minions_timeout = get_names_dict(
+            names, minions_timeout, minions_timeout_ts
+        )
+        self._minions_failed = set(map(names.__getitem__, minions_failed))
 
     def _set_completed(self):
         with self._lock:
@@ -60,6 +288,8 @@ class SaltJob:
         with self._lock:
             if minion in self._minions_done:
                 return
+            if minion in self._minions and minion not in self._minions_timeout:
+                self._parent.remove_pending(self._jid, (minion,))
             self._minions_timeout[minion] = ts
         self._parent.timeout_jid_minion(self._jid, minion, ts)
         if self._set_completed():
@@ -74,17 +304,17 @@ class SaltJob:
             return
         pending_minions = set()
         with self._lock:
-            pending_minions = self._minions.copy()
-            pending_minions.difference_update(self._minions_done.keys())
-            pending_minions.difference_update(set(self._minions_timeout.keys()))
+            pending_minions = self.get_pending_minions()
         for minion in pending_minions:
             self.timeout_minion(minion, ts)
 
 
 class StateJob:
-    def __init__(self, state_fun_args, minions=None):
+    def __init__(self, state_fun_args, minions=None, on_completed=None):
         self._lock = Lock()
         self.state_fun_args = state_fun_args
+        # Called with the completed jobs to take them out of the memory
+        self._on_completed = on_completed
         self._jids = {}
         self._completed_jids = {}
         self._completed_jids_cout = 0
@@ -96,22 +326,23 @@ class StateJob:
         self._minions_ever_succeeded = set()
         self._minions_ever_failed = set()
         self._minions_ever_timeout = set()
+        # The numbers of the pending jids by the minions pending with them
         self._minions_pending = {}
 
-    def update(self, minions, status, jid, ts):
-        if not isinstance(minions, (list, tuple)):
-            minions = [minions]
+    def update(self, minions, status, jid, ts, track=True):
+        minions = get_targets(minions)
         job = None
         with self._lock:
             if jid in self._completed_jids:
                 job = self._completed_jids[jid][0]
             elif jid in self._jids:
                 job = self._jids[jid]
-            else:
+            elif track:
                 job = SaltJob(jid, self, self._lock)
                 self._jids[jid] = job
         self._minions.update(minions, ts=ts, status=status, jid=jid, job=job)
-        self._minions_targets.update(minions)
+        with self._lock:
+            self._minions_targets.update(minions)
         if job is not None:
             job.update(minions, ts=ts, status=status)
         if status == JobStatus.SUCCEEDED:
@@ -128,30 +359,32 @@ class StateJob:
                     self._minions_succeeded.pop(minion, None)
                     self._minions_timeout.pop(minion, None)
                 self._minions_ever_failed.update(minions)
-        elif status == JobStatus.NEW:
-            for minion in minions:
-                with self._lock:
-                    if minion not in self._minions_pending:
-                        self._minions_pending[minion] = set([jid])
-                    self._minions_pending[minion].add(jid)
-        if status != JobStatus.NEW:
-            for minion in minions:
-                with self._lock:
-                    if minion in self._minions_pending:
-                        self._minions_pending[minion].discard(jid)
-                        if len(self._minions_pending[minion]) == 0:
-                            self._minions_pending.pop(minion)
 
     def timeout_jid_minion(self, jid, minion, ts):
         with self._lock:
             self._minions_timeout[minion] = ts
-            if minion in self._minions_pending:
-                self._minions_pending[minion].discard(jid)
-                if len(self._minions_pending[minion]) == 0:
-                    self._minions_pending.pop(minion)
-                self._minions_succeeded.pop(minion, None)
-                self._minions_failed.pop(minion, None)
-            self._minions_ever_timeout.update([minion])
+            self._minions_succeeded.pop(minion, None)
+            self._minions_failed.pop(minion, None)
+            self._minions_ever_timeout.add(minion)
+
+    def add_pending(self, jid, minions):
+        # The minions of the completed jids are not counted as pending,
+        # the lock is expected to be held
+        if jid not in self._jids:
+            return
+        pending = self._minions_pending
+        for minion in minions:
+            pending[minion] = pending.get(minion, 0) + 1
+
+    def remove_pending(self, jid, minions):
+        # The lock is expected to be held
+        if jid not in self._jids:
+            return
+        pending = self._minions_pending
+        for minion in minions:
+            count = pending.pop(minion, 0) - 1
+            if count > 0:
+                pending[minion] = count
 
     def completed_jid(self, jid, ts):
         with self._lock:
@@ -159,7 +392,15 @@ class StateJob:
             if completed_job is not None:
                 completed_job = completed_job[0]
             job = self._jids.pop(jid, completed_job)
-            self._completed_jids[jid] = (job, ts)
+            if self._on_completed is None or completed_job is not None:
+                self._completed_jids[jid] = (job, ts)
+                return
+        if self._on_completed(self, job, ts):
+            with self._lock:
+                self._completed_jids_cout += 1
+        else:
+            with self._lock:
+                self._completed_jids[jid] = (job, ts)
 
     def complete_with_timeout(self, timeout=1200, ts=None, before=None):
         if ts is None:
@@ -173,6 +414,11 @@ class StateJob:
                 job.complete_with_timeout(timeout=timeout, ts=ts, before=before)
 
     def cleanup_jids(self, cleanup_interval, ts=None):
+        """
+        Remove the completed jids and get the jobs removed
+        as (job, completed time) tuples
+        """
+
         if ts is None:
             ts = time()
 
@@ -186,14 +432,137 @@ class StateJob:
                 if job_ts <= ts:
                     jids_to_cleanup.add(jid)
 
+        cleaned_up = []
         for jid in jids_to_cleanup:
             job_data = self._completed_jids.pop(jid, None)
             if job_data is not None:
                 job = job_data[0]
                 self._completed_jids_cout += 1
                 if self._minions is not None:
-                    for minion in job.get_minions():
-                        self._minions.get(minion).cleanup_jid(jid)
+                    self._minions.cleanup_jid(job.get_minions(), jid)
+                cleaned_up.append(job_data)
+        return cleaned_up
+
+    def get_salt_job(self, jid):
+        with self._lock:
+            if jid in self._jids:
+                return self._jids[jid]
+            if jid in self._completed_jids:
+                return self._completed_jids[jid][0]
+        return None
+
+    def _get_jobs_info(self, jobs):
+        state_fun, state_mods, state_test = self.state_fun_args
+        state_mods = ", ".join(state_mods)
+        infos = []
+        for job in jobs:
+            info = job.get_info()
+            info.update(fun=state_fun, mods=state_mods, test=state_test)
+            infos.append(info)
+        return infos
+
+    def get_state(self, names):
+        """
+        Get the state of the state job with its jids as the list
+        of the plain values
+        """
+
+        state_fun, state_mods, state_test = self.state_fun_args
+        with self._lock:
+            return [
+                [state_fun, list(state_mods), state_test],
+                [job.get_state(names) for job in self._jids.values()],
+                [
+                    [job.get_state(names), ts]
+                    for job, ts in self._completed_jids.values()
+                    if job is not None
+                ],
+                self._completed_jids_cout,
+                names.get_indexes(self._minions_targets),
+                names.get_indexes(self._minions_succeeded),
+                list(self._minions_succeeded.values()),
+                names.get_indexes(self._minions_failed),
+                list(self._minions_failed.values()),
+                names.get_indexes(self._minions_timeout),
+                list(self._minions_timeout.values()),
+                names.get_indexes(self._minions_ever_succeeded),
+                names.get_indexes(self._minions_ever_failed),
+                names.get_indexes(self._minions_ever_timeout),
+            ]
+
+    def set_state(self, state, names, targets):
+        """
+        Restore the state got with get_state
+        """
+
+        (
+            _,
+            jids,
+            completed_jids,
+            completed_jids_count,
+            minions_targets,
+            minions_succeeded,
+            minions_succeeded_ts,
+            minions_failed,
+            minions_failed_ts,
+            minions_timeout,
+            minions_timeout_ts,
+            minions_ever_succeeded,
+            minions_ever_failed,
+            minions_ever_timeout,
+        ) = state
+        with self._lock:
+            for job_state in jids:
+                job = SaltJob(load_jid(job_state[0]), self, self._lock)
+                job.set_state(job_state, names, targets)
+                self._jids[job._jid] = job
+            for job_state, ts in completed_jids:
+                job = SaltJob(load_jid(job_state[0]), self, self._lock)
+                job.set_state(job_state, names, targets)
+                self._completed_jids[job._jid] = (job, ts)
+            self._completed_jids_cout = completed_jids_count
+            self._minions_targets = set(map(names.__getitem__, minions_targets))
+            self._minions_succeeded = get_names_dict(
+                names, minions_succeeded, minions_succeeded_ts
+            )
+            self._minions_failed = get_names_dict(
+                names, minions_failed, minions_failed_ts
+            )
+            self._minions_timeout = get_names_dict(
+                names, minions_timeout, minions_timeout_ts
+            )
+            self._minions_ever_succeeded = set(
+                map(names.__getitem__, minions_ever_succeeded)
+            )
+            self._minions_ever_failed = set(map(names.__getitem__, minions_ever_failed))
+            self._minions_ever_timeout = set(
+                map(names.__getitem__, minions_ever_timeout)
+            )
+            self._minions_pending = {}
+            for job in self._jids.values():
+                self.add_pending(job._jid, job.get_pending_minions())
+
+    def get_memory_stats(self, seen=None):
+        """
+        Get the numbers of the jids and the targeted minions and
+        the approximate size of the state job without the minions collection
+        """
+
+        if seen is None:
+            seen = set()
+        seen.add(id(self._minions))
+        size, objects = get_deep_size(self, seen=seen)
+        state_fun, state_mods, state_test = self.state_fun_args
+        return {
+            "fun": state_fun,
+            "mods": ", ".join(state_mods),
+            "test": state_test,
+            "jids": len(self._jids),
+            "completed_jids": len(self._completed_jids),
+            "minions": len(self._minions_targets),
+            "objects": objects,
+            "bytes": size,
+        }
 
     def get_stats(self):
         stats = {}
@@ -228,28 +597,189 @@ class StateJob:
 
 
 class StateJobCollection:
-    def __init__(self, minions):
+    def __init__(self, minions, on_completed=None):
         self._state_jobs = {}
         self._minions = minions
         self._lock = Lock()
+        # The index of the state jobs by the jids tracked with them
+        self._jids = {}
+        # Called with the completed jobs, the jobs taken by it are removed
+        # from the memory right away instead of on cleaning up
+        self._on_completed = on_completed
+        # The completion times of the jids taken out of the memory,
+        # the late responses to them are not tracked as the new jids
+        self._taken_jids = {}
 
-    def get(self, state_fun_args):
-        job = None
+    def _completed(self, state_job, job, ts):
+        if not self._on_completed(state_job, job, ts):
+            return False
+        jid = job.get_jid()
         with self._lock:
-            if state_fun_args in self._state_jobs:
-                job = self._state_jobs[state_fun_args]
-            else:
-                job = StateJob(
-                    state_fun_args, self._minions
-                )
-                self._state_jobs[state_fun_args] = job
+            self._jids.pop(jid, None)
+            self._taken_jids[jid] = ts
+        if self._minions is not None:
+            self._minions.cleanup_jid(job.get_minions(), jid)
+        return True
+
+    def _get(self, state_fun_args):
+        # The lock is expected to be held by the caller
+        job = self._state_jobs.get(state_fun_args)
+        if job is None:
+            job = StateJob(
+                state_fun_args,
+                self._minions,
+                self._completed if self._on_completed is not None else None,
+            )
+            self._state_jobs[state_fun_args] = job
         return job
 
+    def get(self, state_fun_args):
+        with self._lock:
+            return self._get(state_fun_args)
+
+    def update(self, state_fun_args, minions, status, jid, ts):
+        """
+        Update the state job with the jid indexing the jid
+        """
+
+        with self._lock:
+            job = self._get(state_fun_args)
+            track = jid not in self._taken_jids
+            if track and jid not in self._jids:
+                self._jids[jid] = job
+        job.update(minions, status, jid, ts, track=track)
+
+    def get_job_info(self, jid):
+        """
+        Get the summary and the job of the jid if it's tracked
+        """
+
+        with self._lock:
+            state_job = self._jids.get(jid)
+        if state_job is None:
+            return None
+        job = state_job.get_salt_job(jid)
+        if job is None:
+            return None
+        return state_job._get_jobs_info((job,))[0], job
+
+    def cleanup_jids(self, cleanup_interval, ts=None):
+        """
+        Remove the completed jids of all the state jobs and get the jobs removed
+        as (state job, job, completed time) tuples
+        """
+
+        if ts is None:
+            ts = time()
+        cleaned_up = []
+        for state_job in self.jobs():
+            for job, completed_ts in state_job.cleanup_jids(cleanup_interval, ts):
+                cleaned_up.append((state_job, job, completed_ts))
+        with self._lock:
+            for _, job, _ in cleaned_up:
+                self._jids.pop(job.get_jid(), None)
+            # The jids are taken out in the order of completion
+            cleanup_before = ts - cleanup_interval
+            for jid, completed_ts in list(self._taken_jids.items()):
+                if completed_ts >= cleanup_before:
+                    break
+                del self._taken_jids[jid]
+        return cleaned_up
+
+    def query(
+        self,
+        fun=None,
+        mods=None,
+        test=None,
+        status=None,
+        since=None,
+        minion=None,
+        offset=0,
+        limit=100,
+    ):
+        """
+        Get the page of the summaries of the jids of the state jobs filtered
+        by the state function, the mods, the test flag, the status,
+        the request time and the targeted minion starting from the most
+        recently tracked ones, and whether there are more jids after the page
+
+        The jids are taken from the index in the reverse order of tracking them
+        with the filters applied lazily, so the cost depends on the size
+        of the page and the offset, not the number of the jids.
+        """
+
+        with self._lock:
+            state_jobs = {
+                job
+                for (state_fun, state_mods, state_test), job in self._state_jobs.items()
+                if (fun is None or state_fun == fun)
+                and (mods is None or ", ".join(state_mods) == mods)
+                and (test is None or state_test == test)
+            }
+            jobs = (
+                (state_job, state_job.get_salt_job(jid))
+                for jid, state_job in reversed(self._jids.items())
+                if state_job in state_jobs
+            )
+            jobs = ((state_job, job) for state_job, job in jobs if job is not None)
+            if status is not None:
+                completed = status == "completed"
+                jobs = (x for x in jobs if bool(x[1].completed()) == completed)
+            if since is not None:
+                jobs = (x for x in jobs if (x[1].get_request_time() or 0) >= since)
+            if minion is not None:
+                jobs = (x for x in jobs if minion in x[1].get_minions())
+            page = list(islice(jobs, offset, offset + limit + 1))
+        infos = [state_job._get_jobs_info((job,))[0] for state_job, job in page[:limit]]
+        return infos, len(page) > limit
+
     def jobs(self):
         with self._lock:
             for job in self._state_jobs.values():
                 yield job
 
+    def get_state(self, names):
+        """
+        Get the states of the state jobs in the order of jobs()
+        """
+
+        return [job.get_state(names) for job in self.jobs()]
+
+    def set_state(self, state, names):
+        """
+        Restore the state jobs got with get_state
+        and get the list of them in the same order
+        """
+
+        # The equal target lists of the jobs are restored as the shared ones
+        targets = {}
+        jobs = []
+        for job_state in state:
+            state_fun, state_mods, state_test = job_state[0]
+            job = self.get((state_fun, tuple(state_mods), state_test))
+            job.set_state(job_state, names, targets)
+            jobs.append(job)
+            with self._lock:
+                for jid in chain(job._jids, job._completed_jids):
+                    self._jids[jid] = job
+        with self._lock:
+            # The jids of all the state jobs are indexed in the order of requests
+            self._jids = dict(
+                sorted(
+                    self._jids.items(),
+                    key=lambda x: x[1].get_salt_job(x[0]).get_request_time() or 0,
+                )
+            )
+        return jobs
+
+    def get_memory_stats(self):
+        """
+        Get the memory stats of each state job
+        """
+
+        seen = set()
+        return [job.get_memory_stats(seen) for job in list(self._state_jobs.values())]
+
     def complete_with_timeout(self, timeout=1200, ts=None, before=None):
         if ts is None:
             ts = time()
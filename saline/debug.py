@@ -0,0 +1,378 @@
+"""
+On demand diagnostics of the running Saline processes
+
+Each process registers its PID with its start time in the sock_dir,
+so the PID reused by another process is never signalled, and handles SIGUSR2
+by running the actions requested with the request files in the sock_dir,
+the result of the action is written to the result file read by
+the REST API process. Nothing is running in the processes while idle.
+"""
+
+import gc
+import glob
+import json
+import logging
+import multiprocessing.util
+import os
+import re
+import signal
+import sys
+import threading
+import tracemalloc
+import uuid
+
+from collections import Counter
+from time import perf_counter, sleep
+
+import salt.utils.files
+
+
+log = logging.getLogger(__name__)
+
+
+# The max duration of the profiling in seconds
+PROFILE_MAX_SECONDS = 300
+
+
+PROFILE_FORMATS = ("collapsed", "top")
+
+
+def _get_path(opts, *parts):
+    return os.path.join(opts["sock_dir"], "debug.%s" % ".".join(parts))
+
+
+def _get_start_time(pid):
+    """
+    Get the start time of the process in the clock ticks since the boot
+    or None if it can't be taken
+    """
+
+    try:
+        with open("/proc/%d/stat" % pid) as fh:
+            stat = fh.read()
+        # The process name in the parentheses can contain spaces
+        return int(stat.rsplit(")", 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _write_file(path, data):
+    # The file is renamed to be never read partially written
+    tmp_path = "%s.tmp" % path
+    with salt.utils.files.set_umask(0o177):
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh)
+    os.rename(tmp_path, path)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler sampling the stacks of all the threads
+    of the process with the fixed interval
+
+    Unlike cProfile it covers all the threads and adds no overhead
+    to the function calls, the cost is limited with the sampling interval.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._labels = {}
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = "%s (%s:%d)" % (
+                code.co_name,
+                code.co_filename,
+                code.co_firstlineno,
+            )
+            self._labels[code] = label
+        return label
+
+    def run(self, seconds):
+        own_ident = threading.get_ident()
+        end = perf_counter() + seconds
+        while perf_counter() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                self._stacks[tuple(stack)] += 1
+            self.samples += 1
+            sleep(self.interval)
+
+    def collapsed(self):
+        """
+        Get the stacks in the collapsed format of the flame graph tools
+        """
+
+        return "".join(
+            "%s %d\n" % (";".join(stack), count)
+            for stack, count in self._stacks.most_common()
+        )
+
+    def top(self, limit=50):
+        """
+        Get the functions with the most samples on top of the stacks
+        and with the most samples in the stacks
+        """
+
+        own = Counter()
+        total = Counter()
+        for stack, count in self._stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                total[label] += count
+        samples = max(sum(self._stacks.values()), 1)
+        lines = [
+            "%d samples of %d threads stacks every %.3f sec."
+            % (self.samples, samples, self.interval),
+            "",
+            "%8s %8s  %s" % ("own%", "total%", "function"),
+        ]
+        for label, count in own.most_common(limit):
+            lines.append(
+                "%8.2f %8.2f  %s"
+                % (100.0 * count / samples, 100.0 * total[label] / samples, label)
+            )
+        lines.append("")
+        return "\n".join(lines)
+
+
+def profile_action(params):
+    try:
+        seconds = min(float(params.get("seconds", 10)), PROFILE_MAX_SECONDS)
+        interval = max(float(params.get("interval", 0.01)), 0.001)
+    except (TypeError, ValueError):
+        return {"error": "Invalid profiling parameters"}
+    fmt = params.get("format", "collapsed")
+    if fmt not in PROFILE_FORMATS:
+        return {"error": "Unknown profile format '%s'" % fmt}
+    profiler = SamplingProfiler(interval=interval)
+    profiler.run(seconds)
+    if fmt == "top":
+        return {"output": profiler.top()}
+    return {"output": profiler.collapsed()}
+
+
+def get_tracemalloc_top(limit=20, seconds=10):
+    """
+    Get the source lines allocated the most of the memory traced,
+    if tracemalloc is not tracing it's traced for the seconds specified only
+    """
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+        sleep(seconds)
+    try:
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    return {
+        "traced_seconds": seconds if started else None,
+        "top": [
+            {
+                "file": stat.traceback[0].filename,
+                "line": stat.traceback[0].lineno,
+                "bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:limit]
+        ],
+    }
+
+
+def memory_action(params, get_memory_stats=None):
+    try:
+        limit = int(params.get("tracemalloc", 0))
+        seconds = min(float(params.get("seconds", 10)), PROFILE_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return {"error": "Invalid memory parameters"}
+    res = {
+        "gc": {
+            "counts": gc.get_count(),
+            "objects": len(gc.get_objects()),
+        },
+    }
+    if get_memory_stats is not None:
+        res.update(get_memory_stats())
+    if limit > 0:
+        res["tracemalloc"] = get_tracemalloc_top(limit, seconds)
+    return {"output": json.dumps(res)}
+
+
+DEBUG_ACTIONS = {
+    "profile": profile_action,
+    "memory": memory_action,
+}
+
+
+class DebugControl:
+    """
+    The handler of the diagnostic actions requested for the process
+    """
+
+    def __init__(self, opts, name):
+        self.opts = opts
+        self.name = name
+        self.actions = dict(DEBUG_ACTIONS)
+        self._lock = threading.Lock()
+
+    def install(self):
+        """
+        Register the PID of the process and install the signal handler
+        """
+
+        signal.signal(signal.SIGUSR2, self._handle_signal)
+        pid = os.getpid()
+        try:
+            _write_file(
+                _get_path(self.opts, self.name, "pid"),
+                {"pid": pid, "start": _get_start_time(pid)},
+            )
+        except OSError as exc:
+            log.error("Unable to register the process %s: %s", self.name, exc)
+            return
+        # The finalizers run on exit of the main and the child processes
+        multiprocessing.util.Finalize(None, self.uninstall, exitpriority=10)
+
+    def uninstall(self):
+        """
+        Remove the PID file of the process if it's not replaced by the other one
+        """
+
+        pid_path = _get_path(self.opts, self.name, "pid")
+        try:
+            with open(pid_path) as fh:
+                if json.load(fh).get("pid") != os.getpid():
+                    return
+            os.unlink(pid_path)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def _handle_signal(self, signum, sigframe):  # pylint: disable=unused-argument
+        # The requests are handled in the separate thread
+        # to keep the signal handler short
+        threading.Thread(target=self._handle_requests, daemon=True).start()
+
+    def _handle_requests(self):
+        req_pattern = _get_path(self.opts, self.name, "*", "req")
+        # The requests are checked again after releasing the lock
+        # as the new ones could be skipped by the thread running the previous
+        while glob.glob(req_pattern):
+            if not self._lock.acquire(blocking=False):
+                return
+            try:
+                for req_path in glob.glob(req_pattern):
+                    self._handle_request(req_path)
+            finally:
+                self._lock.release()
+
+    def _handle_request(self, req_path):
+        try:
+            with open(req_path) as fh:
+                req = json.load(fh)
+            os.unlink(req_path)
+        except (OSError, ValueError) as exc:
+            log.error("Unable to read the debug request %s: %s", req_path, exc)
+            try:
+                os.unlink(req_path)
+            except OSError:
+                pass
+            return
+        action = self.actions.get(req.get("action"))
+        log.info("Running the debug action %s: %s", req.get("action"), req)
+        if action is None:
+            res = {"error": "Unknown debug action '%s'" % req.get("action")}
+        else:
+            try:
+                res = action(req.get("params", {}))
+            except Exception as exc:  # pylint: disable=broad-except
+                log.exception("Unable to run the debug action: %s", req)
+                res = {"error": str(exc)}
+        try:
+            _write_file(_get_path(self.opts, req["id"], "out"), res)
+        except OSError as exc:
+            log.error("Unable to write the debug result: %s", exc)
+
+
+def install_debug_control(opts, name):
+    """
+    Install the handler of the diagnostic actions to the current process
+    """
+
+    debug_control = DebugControl(opts, name)
+    debug_control.install()
+    return debug_control
+
+
+def request_debug(opts, name, action, params=None):
+    """
+    Request the diagnostic action of the process
+    and get the ID to get the result with
+    """
+
+    if not re.match(r"^[\w-]+$", name):
+        return None
+    try:
+        with open(_get_path(opts, name, "pid")) as fh:
+            registered = json.load(fh)
+        pid = int(registered["pid"])
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    if _get_start_time(pid) != registered.get("start"):
+        # The process is gone and the PID could be reused by another one
+        return None
+    req_id = uuid.uuid4().hex
+    req_path = _get_path(opts, name, req_id, "req")
+    _write_file(req_path, {"id": req_id, "action": action, "params": params or {}})
+    try:
+        os.kill(pid, signal.SIGUSR2)
+    except OSError:
+        os.unlink(req_path)
+        return None
+    return req_id
+
+
+def get_debug_result(opts, req_id):
+    """
+    Get the result of the diagnostic action if it's ready
+    """
+
+    res_path = _get_path(opts, req_id, "out")
+    try:
+        with open(res_path) as fh:
+            res = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    os.unlink(res_path)
+    return res
+
+
+def cancel_debug(opts, name, req_id):
+    """
+    Remove the request or the result of the diagnostic action
+    not waited for anymore
+    """
+
+    for path in (
+        _get_path(opts, name, req_id, "req"),
+        _get_path(opts, req_id, "out"),
+    ):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,292 @@
+"""
+The history of the completed state jobs kept on the disk
+
+The state jobs are moved out of the memory of the Data Manager on completion
+and written to the SQLite database with the results of each minion,
+so the memory holds the jobs in flight and only the jids of the completed
+ones until cleaning up, to ignore the late responses to them, while
+the history of the jobs is kept for the retention time and can be queried
+by jid, minion and state function. The jobs are written in batches by the background thread,
+the jobs are dropped if the writer can't keep up with them.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from time import time
+
+import salt.syspaths
+
+
+log = logging.getLogger(__name__)
+
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        jid TEXT NOT NULL,
+        fun TEXT NOT NULL,
+        mods TEXT NOT NULL,
+        test INTEGER NOT NULL,
+        req_ts REAL,
+        completed_ts REAL NOT NULL,
+        minions INTEGER NOT NULL,
+        succeeded INTEGER NOT NULL,
+        failed INTEGER NOT NULL,
+        timedout INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS jobs_jid ON jobs (jid)",
+    "CREATE INDEX IF NOT EXISTS jobs_fun ON jobs (fun, mods, completed_ts)",
+    "CREATE INDEX IF NOT EXISTS jobs_completed ON jobs (completed_ts)",
+    """
+    CREATE TABLE IF NOT EXISTS job_minions (
+        jid TEXT NOT NULL,
+        minion TEXT NOT NULL,
+        status TEXT NOT NULL,
+        ts REAL,
+        completed_ts REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS job_minions_jid ON job_minions (jid, minion)",
+    "CREATE INDEX IF NOT EXISTS job_minions_minion ON job_minions (minion, ts)",
+    "CREATE INDEX IF NOT EXISTS job_minions_completed ON job_minions (completed_ts)",
+)
+
+# The columns of the jobs with the time of the last response of the minions
+JOB_COLUMNS = (
+    "jobs.*, (SELECT MAX(ts) FROM job_minions"
+    " WHERE job_minions.jid = jobs.jid AND status != 'timedout') AS last_resp_ts"
+)
+
+# The max time in seconds to keep the jobs in the queue before writing
+FLUSH_INTERVAL = 5
+
+# The max number of the jobs written in one transaction
+BATCH_SIZE = 100
+
+# The interval of removing the jobs older than the retention time
+EXPIRE_INTERVAL = 600
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=10)
+    # The readers are not blocked by the writer with the write-ahead log
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class JobsHistory:
+    """
+    The writer of the completed state jobs to the history database
+    """
+
+    def __init__(self, path, retention=7 * 86400, queue_size=10000):
+        self.path = path
+        self.retention = retention
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def start(self):
+        """
+        Create the database and start the writer thread
+        """
+
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o750, exist_ok=True)
+            conn = _connect(self.path)
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            conn.close()
+        except (OSError, sqlite3.Error) as exc:
+            log.error("Unable to open the jobs history %s: %s", self.path, exc)
+            return False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        return True
+
+    def add(self, state_fun_args, job, completed_ts):
+        """
+        Add the completed job to the history without waiting for writing it,
+        the job is expected to be not changed after it was completed
+        """
+
+        try:
+            self._queue.put_nowait((state_fun_args, job, completed_ts))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write the pending jobs and stop the writer thread
+        """
+
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+        self._thread = None
+
+    def _write_jobs(self, conn, jobs):
+        jobs_rows = []
+        minions_rows = []
+        for (fun, mods, test), job, completed_ts in jobs:
+            jid = str(job.get_jid())
+            counts = {"succeeded": 0, "failed": 0, "timedout": 0}
+            for minion, status, ts in job.get_results():
+                counts[status] += 1
+                minions_rows.append((jid, minion, status, ts, completed_ts))
+            jobs_rows.append(
+                (
+                    jid,
+                    fun,
+                    ", ".join(mods),
+                    test,
+                    job.get_request_time(),
+                    completed_ts,
+                    len(job.get_minions()),
+                    counts["succeeded"],
+                    counts["failed"],
+                    counts["timedout"],
+                )
+            )
+        with conn:
+            conn.executemany(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", jobs_rows
+            )
+            conn.executemany(
+                "INSERT INTO job_minions VALUES (?, ?, ?, ?, ?)", minions_rows
+            )
+
+    def _expire(self, conn):
+        before = time() - self.retention
+        with conn:
+            jobs = conn.execute("DELETE FROM jobs WHERE completed_ts < ?", (before,))
+            conn.execute("DELETE FROM job_minions WHERE completed_ts < ?", (before,))
+        if jobs.rowcount:
+            log.debug("Removed %d expired jobs from the history", jobs.rowcount)
+
+    def _writer(self):
+        conn = _connect(self.path)
+        expire_after = 0
+        dropped = 0
+        stop = False
+        while not stop:
+            jobs = []
+            flush_after = time() + FLUSH_INTERVAL
+            while len(jobs) < BATCH_SIZE:
+                try:
+                    job = self._queue.get(timeout=max(flush_after - time(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            try:
+                if jobs:
+                    self._write_jobs(conn, jobs)
+                if self.retention and time() > expire_after:
+                    expire_after = time() + EXPIRE_INTERVAL
+                    self._expire(conn)
+            except sqlite3.Error as exc:
+                log.error("Unable to write the jobs history: %s", exc)
+            if self.dropped != dropped:
+                log.warning(
+                    "Dropped %d jobs not fitting the jobs history queue",
+                    self.dropped - dropped,
+                )
+                dropped = self.dropped
+        conn.close()
+
+    def get_jobs(
+        self, fun=None, mods=None, minion=None, since=None, limit=100, offset=0
+    ):
+        """
+        Get the latest jobs from the history filtered
+        by the state function and the mods, by the targeted minion
+        and by the time of completion
+        """
+
+        query = "SELECT %s FROM jobs" % JOB_COLUMNS
+        where = []
+        params = []
+        if minion is not None:
+            where.append("jid IN (SELECT jid FROM job_minions WHERE minion = ?)")
+            params.append(minion)
+        if fun is not None:
+            where.append("fun = ?")
+            params.append(fun)
+        if mods is not None:
+            where.append("mods = ?")
+            params.append(mods)
+        if since is not None:
+            where.append("completed_ts >= ?")
+            params.append(since)
+        if where:
+            query += " WHERE %s" % " AND ".join(where)
+        query += " ORDER BY completed_ts DESC LIMIT ? OFFSET ?"
+        params.extend((limit, offset))
+        return self._query(query, params)
+
+    def get_job(self, jid):
+        """
+        Get the job from the history or None if it's not there
+        """
+
+        jobs = self._query(
+            "SELECT %s FROM jobs WHERE jid = ? LIMIT 1" % JOB_COLUMNS, [str(jid)]
+        )
+        return jobs[0] if jobs else None
+
+    def get_job_results(self, jid, minion=None, status=None, limit=-1, offset=0):
+        """
+        Get the results of the minions targeted by the job
+        sorted by the minion names
+        """
+
+        query = "SELECT minion, status, ts FROM job_minions WHERE jid = ?"
+        params = [str(jid)]
+        if minion is not None:
+            query += " AND minion = ?"
+            params.append(minion)
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY minion LIMIT ? OFFSET ?"
+        params.extend((limit, offset))
+        return self._query(query, params)
+
+    def _query(self, query, params):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in conn.execute(query, params)]
+        finally:
+            conn.close()
+
+
+def get_jobs_history(opts):
+    """
+    Get the started jobs history if it's enabled
+    """
+
+    history_opts = opts.get("jobs_history", {})
+    if not history_opts.get("enabled", False):
+        return None
+    history = JobsHistory(
+        history_opts.get(
+            "path", os.path.join(salt.syspaths.CACHE_DIR, "saline", "jobs.sqlite")
+        ),
+        retention=history_opts.get("retention", 7 * 86400),
+        queue_size=history_opts.get("queue_size", 10000),
+    )
+    if not history.start():
+        return None
+    return history
@@ -0,0 +1,245 @@
+"""
+The journal of the events captured from the Salt Event Bus
+
+The events passed through the filters of the Events Manager are written
+to the segment files as the length prefixed msgpack records compressed
+with gzip. The segments are rotated on reaching the size and the oldest ones
+are removed. The events are written by the background thread, so the events
+processing is never blocked on the disk, the events are dropped
+if the writer can't keep up with the events stream.
+"""
+
+import glob
+import gzip
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+from time import perf_counter, time
+
+import msgpack
+import salt.syspaths
+
+from saline.data.event import EventParser
+from saline.data.merger import DataMerger
+
+
+log = logging.getLogger(__name__)
+
+
+SEGMENT_PATTERN = "events.*.mpk.gz"
+
+# The length prefix of the records
+RECORD_HEADER = struct.Struct(">I")
+
+# The interval of flushing the compressed data to the segment file
+FLUSH_INTERVAL = 1
+
+
+def get_segments(path):
+    """
+    Get the list of the segment files of the journal from the oldest one
+    """
+
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(os.path.join(path, SEGMENT_PATTERN)))
+
+
+class EventsJournal:
+    """
+    The writer of the events to the rotated segments of the journal
+    """
+
+    def __init__(
+        self,
+        path,
+        segment_size=64 * 1024 * 1024,
+        segments=16,
+        queue_size=10000,
+    ):
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = segments
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._fh = None
+        self._gz = None
+        self._last_flush = 0
+
+    def start(self):
+        """
+        Start the writer thread if the journal directory can be used
+        """
+
+        try:
+            os.makedirs(self.path, mode=0o750, exist_ok=True)
+        except OSError as exc:
+            log.error("Unable to create the events journal %s: %s", self.path, exc)
+            return False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        return True
+
+    def write(self, tag, data):
+        """
+        Add the event to the journal without waiting for writing it
+        """
+
+        try:
+            self._queue.put_nowait((time(), tag, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write the pending events and close the current segment
+        """
+
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        self._thread = None
+
+    def _open_segment(self):
+        self._close_segment()
+        segment = os.path.join(
+            self.path, SEGMENT_PATTERN.replace("*", "%020d" % (time() * 1000000))
+        )
+        self._fh = open(segment, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._fh, mode="wb")
+        for old_segment in get_segments(self.path)[: -self.segments]:
+            try:
+                os.unlink(old_segment)
+            except OSError as exc:
+                log.warning("Unable to remove the journal segment: %s", exc)
+
+    def _close_segment(self):
+        if self._gz is not None:
+            self._gz.close()
+            self._fh.close()
+            self._gz = None
+            self._fh = None
+
+    def _write_event(self, event):
+        try:
+            record = msgpack.packb(event, use_bin_type=True, default=str)
+        except (TypeError, ValueError) as exc:
+            log.warning(
+                "Unable to write the event %s to the journal: %s", event[1], exc
+            )
+            return
+        if self._gz is None or self._fh.tell() >= self.segment_size:
+            self._open_segment()
+        self._gz.write(RECORD_HEADER.pack(len(record)))
+        self._gz.write(record)
+
+    def _writer(self):
+        dropped = 0
+        dropped_logged = time()
+        while True:
+            try:
+                event = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                event = False
+            try:
+                if event is None:
+                    self._close_segment()
+                    return
+                if event:
+                    self._write_event(event)
+                if self._gz is not None and time() - self._last_flush >= FLUSH_INTERVAL:
+                    # The records flushed can be read while the segment is written
+                    self._gz.flush(zlib.Z_SYNC_FLUSH)
+                    self._last_flush = time()
+            except OSError as exc:
+                log.error("Unable to write the events journal: %s", exc)
+                try:
+                    self._close_segment()
+                except OSError:
+                    self._gz = None
+                    self._fh = None
+            if self.dropped != dropped and time() - dropped_logged >= FLUSH_INTERVAL:
+                log.warning(
+                    "Dropped %d events not fitting the events journal queue",
+                    self.dropped - dropped,
+                )
+                dropped = self.dropped
+                dropped_logged = time()
+
+
+def get_events_journal(opts):
+    """
+    Get the started events journal if it's enabled
+    """
+
+    journal_opts = opts.get("events_journal", {})
+    if not journal_opts.get("enabled", False):
+        return None
+    journal = EventsJournal(
+        journal_opts.get(
+            "path", os.path.join(salt.syspaths.CACHE_DIR, "saline", "journal")
+        ),
+        segment_size=journal_opts.get("segment_size", 64 * 1024 * 1024),
+        segments=journal_opts.get("segments", 16),
+        queue_size=journal_opts.get("queue_size", 10000),
+    )
+    if not journal.start():
+        return None
+    return journal
+
+
+def read_journal(path):
+    """
+    Read the events from the journal segments as (ts, tag, data) tuples,
+    the records partially written at the end of the segment are skipped
+    """
+
+    for segment in get_segments(path):
+        try:
+            with gzip.open(segment, "rb") as fh:
+                while True:
+                    header = fh.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    size = RECORD_HEADER.unpack(header)[0]
+                    record = fh.read(size)
+                    if len(record) < size:
+                        break
+                    yield tuple(msgpack.unpackb(record, raw=False))
+        except (EOFError, OSError, zlib.error) as exc:
+            # The segment is still written or was not closed properly
+            log.debug("The journal segment %s is incomplete: %s", segment, exc)
+
+
+def replay_journal(opts, path, out=None):
+    """
+    Pass the events from the journal through the parser and the merger
+    as fast as possible and write the resulting metrics
+    """
+
+    if out is None:
+        out = sys.stdout
+    parser = EventParser(opts)
+    datamerger = DataMerger(opts)
+    count = 0
+    start = perf_counter()
+    for _, tag, data in read_journal(path):
+        count += 1
+        parsed = parser.parse(tag, data)
+        if parsed is not None:
+            datamerger.add(parsed)
+    datamerger.jobs_metrics_update()
+    elapsed = perf_counter() - start
+    out.write(datamerger.get_metrics())
+    sys.stderr.write(
+        "Replayed %d events in %.3f sec. (%.1f events/s)\n"
+        % (count, elapsed, count / elapsed if elapsed else 0)
+    )
+    return count
@@ -9,17 +9,26 @@ import salt.ext.tornado.gen
 import salt.syspaths
 import salt.utils.files
 
+from functools import partial
 from multiprocessing import Pipe, Queue
 from threading import Thread, Lock
-from time import time, sleep
+from time import perf_counter, time, sleep
 from queue import Empty as QueueEmpty
 
 from saline import restapi
 from saline.data.event import EventParser
-from saline.data.merger import DataMerger
+from saline.data.merger import PIPELINE_STATS, DataMerger
+from saline.data.metrics import get_metrics_groups
+from saline.debug import install_debug_control, memory_action
+from saline.history import get_jobs_history
+from saline.journal import get_events_journal
+from saline.procstats import get_process_stats
+from saline.query import get_query_server
+from saline.shared import SharedBufferWriter
+from saline.snapshot import get_state_snapshot
 
 from salt.ext.tornado.ioloop import IOLoop, PeriodicCallback
-from salt.transport.ipc import IPCMessagePublisher
+from salt.transport.ipc import IPCMessagePublisher, IPCMessageServer
 from salt.utils.event import get_event
 from salt.utils.process import (
     ProcessManager,
@@ -29,6 +38,21 @@ from salt.utils.process import (
 
 log = logging.getLogger(__name__)
 
+# The min time in seconds between the metrics snapshots sent on resync
+METRICS_RESYNC_INTERVAL = 5
+
+
+def get_queue_depth(queue):
+    """
+    Get the approximate number of items in the queue if it can be taken
+    """
+
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # Not implemented on the platforms without sem_getvalue()
+        return None
+
 
 class Saline(SignalHandlingProcess):
     """
@@ -137,6 +161,60 @@ class EventsManager(SignalHandlingProcess):
 
         self._show_connected = False
 
+        internal_metrics = opts.get("internal_metrics", {})
+        self._sample_every = None
+        if internal_metrics.get("enabled", True):
+            self._sample_every = max(int(internal_metrics.get("sample_every", 100)), 1)
+        self._sample_interval = internal_metrics.get("sample_interval", 1)
+        self._sample_last = 0
+        # The numbers of the events passed through the stages since the last sample
+        self._events_counts = {"received": 0, "filtered": 0}
+        self._events_sampled = 0
+        # The number of the events unable to unpack updated by the events bus loop
+        self._events_dropped = 0
+        self._events_dropped_sent = 0
+        # The number of the events not fitting the queue of the events journal
+        self._journal_dropped_sent = 0
+
+        self._process_stats = None
+
+        self.journal = None
+
+    def _get_stats(self, force=False):
+        """
+        Get the stats of the pipeline to send with the event if it's sampled
+        """
+
+        if self._sample_every is None:
+            return None
+        self._events_sampled += 1
+        cur_time = time()
+        if (
+            not force
+            and self._events_sampled < self._sample_every
+            and cur_time - self._sample_last < self._sample_interval
+        ):
+            return None
+        self._events_sampled = 0
+        self._sample_last = cur_time
+        counts = self._events_counts
+        self._events_counts = {"received": 0, "filtered": 0}
+        dropped = self._events_dropped
+        counts["dropped"] = dropped - self._events_dropped_sent
+        self._events_dropped_sent = dropped
+        if self.journal is not None:
+            dropped = self.journal.dropped
+            counts["journal_dropped"] = dropped - self._journal_dropped_sent
+            self._journal_dropped_sent = dropped
+        return {
+            "put": cur_time,
+            "depth": {
+                "events": len(self._int_queue),
+                "requests": get_queue_depth(self.queue),
+            },
+            "counts": counts,
+        }
+
     def process_events(self):
         events_filter_re = re.compile(self.opts["events_regex_filter"])
         events_additional = []
@@ -149,12 +227,16 @@ class EventsManager(SignalHandlingProcess):
             sleep(0.2)
             while self._int_queue:
                 tag, event = self._int_queue.pop(0)
+                self._events_counts["received"] += 1
 
                 if not isinstance(event, dict):
+                    self._events_counts["filtered"] += 1
                     continue
 
                 if events_filter_re.match(tag):
-                    self.queue.put((tag, event))
+                    self.queue.put((tag, event, self._get_stats()))
+                    if self.journal is not None:
+                        self.journal.write(tag, event)
                     continue
 
                 in_additional = False
@@ -163,18 +245,32 @@ class EventsManager(SignalHandlingProcess):
                         in_additional = True
                         break
                 if in_additional:
-                    self.queue.put((tag, event))
+                    self.queue.put((tag, event, self._get_stats()))
+                    if self.journal is not None:
+                        self.journal.write(tag, event)
                     continue
 
+                self._events_counts["filtered"] += 1
                 log.debug("The event tag doesn't match the event filter: %s", tag)
 
+            if (
+                self._sample_every is not None
+                and time() - self._sample_last >= self._sample_interval
+            ):
+                # Send the stats without the event if no event was sampled
+                self.queue.put((None, None, self._get_stats(force=True)))
+
+            if self._process_stats is not None and self._process_stats.due():
+                # The stats are passed to the Data Manager by the readers
+                self.queue.put((None, None, {"process": self._process_stats.get()}))
+
     @salt.ext.tornado.gen.coroutine
     def enqueue_event(self, raw):
         try:
             self._int_queue.append(self.event_bus.unpack(raw))
         except:  # pylint: disable=broad-except
             # Just to ignore any possible exceptions on unpacking data
-            pass
+            self._events_dropped += 1
 
     def _init_event_bus(self):
         if self.event_bus is not None:
@@ -224,10 +320,17 @@ class EventsManager(SignalHandlingProcess):
             self.mopts["transport"],
         )
 
+        self._process_stats = get_process_stats(self.opts, self.name)
+        install_debug_control(self.opts, self.name)
+
+        self.journal = get_events_journal(self.opts)
+
         self._int_queue_thread = Thread(target=self.process_events)
         self._int_queue_thread.start()
 
         self.io_loop = IOLoop(make_current=True)
+        if self._process_stats is not None:
+            self._process_stats.start_loop_lag(self.io_loop)
         self._init_event_bus()
         self._check_connected_cb = PeriodicCallback(
             self._check_connected, 3000, io_loop=self.io_loop
@@ -242,6 +345,10 @@ class EventsManager(SignalHandlingProcess):
         if self._int_queue_thread is not None:
             self._int_queue_exit = True
             self._int_queue_thread = None
+        if self.journal is not None:
+            self.journal.close()
+        if self._process_stats is not None:
+            self._process_stats.close()
         sys.exit(0)
 
 
@@ -266,10 +373,30 @@ class DataManager(SignalHandlingProcess):
         self.queue = queue
 
         self.metrics_epoch = None
+        # The start time makes the ETags of the metrics unique across restarts
+        self.metrics_etag_base = "%x" % int(time())
+        self.metrics_seq = 0
+        # The names of the subscribers requested the metrics snapshot,
+        # None is for all of them
+        self._metrics_resync = {None}
+        self._metrics_resync_last = 0
         self.datamerger = None
 
         self.datamerger_thread = None
         self.maintenance_thread = None
+        # The changes of the merged data are paused with the lock
+        # while the state snapshot is taken
+        self._state_lock = Lock()
+        self.snapshot = None
+        self.query_server = None
+
+        self.publisher = None
+        self.control = None
+        self.metrics_writers = None
+        # The versions of the metrics of the groups written to the shared buffers
+        self._metrics_versions = {}
+
+        self.process_stats = None
 
         self._close_lock = Lock()
 
@@ -280,7 +407,28 @@ class DataManager(SignalHandlingProcess):
 
         log.info("Running Saline Data Manager")
 
+        self.process_stats = get_process_stats(self.opts, self.name)
+
         self.datamerger = DataMerger(self.opts)
+        self.datamerger.history = get_jobs_history(self.opts)
+
+        self.snapshot = get_state_snapshot(self.opts, self.datamerger, self._state_lock)
+        if self.snapshot is not None:
+            self.snapshot.load()
+            self.snapshot.start()
+
+        # The queries are answered by the threads of the query server
+        # with the answers cached until the next metrics epoch is published
+        self.query_server = get_query_server(
+            self.opts, self.datamerger, lambda: self.metrics_epoch
+        )
+
+        debug_control = install_debug_control(self.opts, self.name)
+        # The memory usage of the data structures is computed
+        # in the thread of the debug control not to stall the merging
+        debug_control.actions["memory"] = partial(
+            memory_action, get_memory_stats=self.datamerger.get_memory_stats
+        )
 
         self._stop_datamerger = False
         self.datamerger_thread = Thread(target=self.start_datamerger)
@@ -296,6 +444,8 @@ class DataManager(SignalHandlingProcess):
 
         self._job_jids_cleanup_interval = self.opts.get("job_jids_cleanup_interval", 30)
 
+        self._metrics_expire_interval = self.opts.get("metrics_expire_interval", 60)
+
         self._maintenance_stop = False
         self.maintenance_thread = Thread(target=self.start_maintenance)
         self.maintenance_thread.start()
@@ -305,6 +455,14 @@ class DataManager(SignalHandlingProcess):
     def _handle_signals(self, signum, sigframe):
         self.stop_datamerger()
         self.stop_maintenance()
+        if self.query_server is not None:
+            self.query_server.stop()
+            self.query_server = None
+        if self.snapshot is not None:
+            self.snapshot.stop()
+            self.snapshot = None
+        if self.datamerger is not None and self.datamerger.history is not None:
+            self.datamerger.history.close()
         self.stop_server()
         sys.exit(0)
 
@@ -318,7 +476,12 @@ class DataManager(SignalHandlingProcess):
                 continue
             except (ValueError, OSError):
                 break
-            self.datamerger.add(data)
+            try:
+                with self._state_lock:
+                    self.datamerger.add(data)
+            except Exception:  # pylint: disable=broad-except
+                # The merging is never stopped by a single malformed event
+                log.exception("Unable to merge the event")
 
     def stop_datamerger(self):
         if self.datamerger_thread is not None:
@@ -330,6 +493,7 @@ class DataManager(SignalHandlingProcess):
         run_complete_after = ts + self._job_timeout_check_interval
         run_job_metrics_update_after = ts + self._job_metrics_update_interval
         run_job_jids_cleanup_after = ts + self._job_jids_cleanup_interval
+        run_metrics_expire_after = ts + self._metrics_expire_interval
         while True:
             sleep(0.2)
             if self._maintenance_stop:
@@ -337,13 +501,20 @@ class DataManager(SignalHandlingProcess):
             ts = time()
             if ts > run_complete_after:
                 run_complete_after = ts + self._job_timeout_check_interval
-                self.datamerger.jobs.complete_with_timeout(self._job_timeout, ts=ts)
+                with self._state_lock:
+                    self.datamerger.jobs.complete_with_timeout(self._job_timeout, ts=ts)
             if ts > run_job_metrics_update_after:
                 run_job_metrics_update_after = ts + self._job_metrics_update_interval
                 self.datamerger.jobs_metrics_update()
             if ts > run_job_jids_cleanup_after:
                 run_job_jids_cleanup_after = ts + self._job_jids_cleanup_interval
-                self.datamerger.cleanup_job_jids()
+                with self._state_lock:
+                    self.datamerger.cleanup_job_jids()
+            if ts > run_metrics_expire_after:
+                run_metrics_expire_after = ts + self._metrics_expire_interval
+                self.datamerger.expire_metrics()
+            if self.process_stats is not None and self.process_stats.due():
+                self.datamerger.add_process_stats(*self.process_stats.get())
 
     def stop_maintenance(self):
         if self.maintenance_thread is not None:
@@ -352,6 +523,8 @@ class DataManager(SignalHandlingProcess):
 
     def start_server(self):
         self.io_loop = IOLoop()
+        if self.process_stats is not None:
+            self.process_stats.start_loop_lag(self.io_loop)
         with salt.utils.asynchronous.current_ioloop(self.io_loop):
             pub_uri = os.path.join(self.opts["sock_dir"], "publisher.ipc")
             self.publisher = IPCMessagePublisher(
@@ -359,8 +532,25 @@ class DataManager(SignalHandlingProcess):
                 pub_uri,
                 io_loop=self.io_loop,
             )
+            control_uri = os.path.join(self.opts["sock_dir"], "control.ipc")
+            self.control = IPCMessageServer(
+                control_uri,
+                io_loop=self.io_loop,
+                payload_handler=self.control_handler,
+            )
             with salt.utils.files.set_umask(0o177):
                 self.publisher.start()
+                self.control.start()
+            if self.opts.get("metrics_shared_buffer", False):
+                self.metrics_groups = get_metrics_groups(
+                    self.opts.get("metrics_groups")
+                )
+                self.metrics_writers = {
+                    group: SharedBufferWriter(
+                        restapi.get_metrics_shared_path(self.opts, group)
+                    )
+                    for group in (None, *self.metrics_groups)
+                }
             self.io_loop.add_callback(self.metrics_publisher)
             try:
                 self.io_loop.start()
@@ -372,25 +562,110 @@ class DataManager(SignalHandlingProcess):
             if self.publisher is not None:
                 self.publisher.close()
                 self.publisher = None
+            if self.control is not None:
+                self.control.close()
+                self.control = None
+            if self.metrics_writers is not None:
+                for writer in self.metrics_writers.values():
+                    writer.close()
+                self.metrics_writers = None
+            if self.process_stats is not None:
+                self.process_stats.close()
+                self.process_stats = None
             if self.io_loop is not None:
                 self.io_loop.close()
                 self.io_loop.stop()
                 self.io_loop = None
 
+    @salt.ext.tornado.gen.coroutine
+    def control_handler(self, payload, reply=None):
+        if not isinstance(payload, dict):
+            return
+        resync = payload.get("resync", False)
+        if resync:
+            log.debug("Metrics resync requested by the subscriber: %s", resync)
+            self._metrics_resync.add(None if resync is True else resync)
+        if "process" in payload:
+            self.datamerger.add_process_stats(*payload["process"])
+
+    def get_metrics_etag(self):
+        return '"%s-%x"' % (self.metrics_etag_base, self.metrics_epoch)
+
+    def write_shared_metrics(self):
+        for group, writer in self.metrics_writers.items():
+            metrics = None if group is None else self.metrics_groups[group]
+            version = self.datamerger.get_metrics_version(metrics)
+            # The groups with none of the metrics changed are not rendered again
+            if version == self._metrics_versions.get(group) and writer.touch():
+                continue
+            self._metrics_versions[group] = version
+            if group is None:
+                buf = self.datamerger.get_metrics(reset_changes=True)
+            else:
+                buf = self.datamerger.get_metrics(metrics=self.metrics_groups[group])
+            buf = buf.encode()
+            # The ETag of the group is kept while its metrics are not changed
+            if writer.is_written(buf):
+                tag = writer.get_tag()
+            else:
+                tag = self.get_metrics_etag().encode()
+            writer.write(buf, tag=tag)
+
+    def publish_metrics_snapshot(self):
+        """
+        Publish the full snapshot to the subscribers requested the resync,
+        the snapshot doesn't take the sequence number, so the subscribers
+        continue with the next delta after it and the rest of them ignore it
+        """
+
+        requesters = self._metrics_resync
+        self._metrics_resync = set()
+        if self.metrics_epoch is None:
+            self.metrics_epoch = self.datamerger.get_metrics_epoch()
+        self.publisher.publish(
+            {
+                "metrics_snapshot": {
+                    "seq": self.metrics_seq,
+                    "etag": self.get_metrics_etag(),
+                    "metrics": self.datamerger.get_metrics_snapshot(),
+                    "to": None if None in requesters else sorted(requesters),
+                }
+            }
+        )
+
     @salt.ext.tornado.gen.coroutine
     def metrics_publisher(self):
         last_update = time()
         while True:
             epoch = self.datamerger.get_metrics_epoch()
             cur_time = time()
-            if (
-                epoch != self.metrics_epoch
-                or self.metrics_epoch is None
-                or cur_time - last_update > 110
-            ):
-                self.metrics_epoch = epoch
-                last_update = cur_time
-                self.publisher.publish({"metrics": self.datamerger.get_metrics()})
+            if self.metrics_writers is not None:
+                # The REST API processes read the metrics from the shared buffer,
+                # rewriting it periodically refreshes the time of the last update
+                if epoch != self.metrics_epoch or cur_time - last_update > 110:
+                    self.metrics_epoch = epoch
+                    last_update = cur_time
+                    self.write_shared_metrics()
+            else:
+                if epoch != self.metrics_epoch or cur_time - last_update > 110:
+                    self.metrics_epoch = epoch
+                    self.metrics_seq += 1
+                    last_update = cur_time
+                    self.publisher.publish(
+                        {
+                            "metrics_delta": {
+                                "seq": self.metrics_seq,
+                                "etag": self.get_metrics_etag(),
+                                "metrics": self.datamerger.get_metrics_delta(),
+                            }
+                        }
+                    )
+                if (
+                    self._metrics_resync
+                    and cur_time - self._metrics_resync_last >= METRICS_RESYNC_INTERVAL
+                ):
+                    self.publish_metrics_snapshot()
+                    self._metrics_resync_last = cur_time
             yield salt.ext.tornado.gen.sleep(3)
 
 
@@ -420,6 +695,17 @@ class EventsReader(SignalHandlingProcess):
 
         self.event_parser = EventParser(self.opts)
 
+        # The number of the events ignored by the parser since the last sample
+        self._events_ignored = 0
+
+        self._process_stats = None
+
+    def _add_stats(self, stats):
+        if "depth" in stats:
+            stats["depth"]["results"] = get_queue_depth(self.ret_queue)
+            stats["counts"]["ignored"], self._events_ignored = self._events_ignored, 0
+        return stats
+
     def run(self):
         """
         Saline Events Reader routine processing the captured Salt Events
@@ -427,19 +713,43 @@ class EventsReader(SignalHandlingProcess):
 
         log.info("Running Saline Events Reader: %s", self.name)
 
+        self._process_stats = get_process_stats(self.opts, self.name)
+        install_debug_control(self.opts, self.name)
+
         while True:
             if self._exit:
                 break
+            if self._process_stats is not None and self._process_stats.due():
+                self.ret_queue.put(
+                    {PIPELINE_STATS: {"process": self._process_stats.get()}}
+                )
             try:
                 event = self.req_queue.get(timeout=0.5)
             except QueueEmpty:
                 continue
             except (ValueError, OSError):
                 break
-            parsed_data = self.event_parser.parse(*event)
-            if parsed_data is not None:
-                parsed_data["rix"] = self._idx
-                self.ret_queue.put(parsed_data)
+            tag, data, stats = event
+            if data is None:
+                parsed_data = None
+            elif stats is None:
+                parsed_data = self.event_parser.parse(tag, data)
+            else:
+                start = perf_counter()
+                parsed_data = self.event_parser.parse(tag, data)
+                stats["parse"] = perf_counter() - start
+            if parsed_data is None:
+                if data is not None:
+                    self._events_ignored += 1
+                if stats is not None:
+                    self.ret_queue.put({PIPELINE_STATS: self._add_stats(stats)})
+                continue
+            parsed_data["rix"] = self._idx
+            if stats is not None:
+                parsed_data[PIPELINE_STATS] = self._add_stats(stats)
+            self.ret_queue.put(parsed_data)
+        if self._process_stats is not None:
+            self._process_stats.close()
 
     def _handle_signals(self, signum, sigframe):
         self._exit = True
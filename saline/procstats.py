@@ -0,0 +1,125 @@
+import gc
+import os
+import resource
+import sys
+import threading
+
+from time import perf_counter, time
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ProcessStats:
+    """
+    The resource usage of the current process reported to the Data Manager
+
+    The GC collections and pauses are counted with the gc callbacks,
+    the event loop lag is measured as the delay of the callback scheduled
+    on the IOLoop and the max lag since the last report is reported.
+    """
+
+    def __init__(self, name, interval=10):
+        self.name = name
+        self.interval = interval
+        self._last = time()
+        self._gc_collections = 0
+        self._gc_pause = 0.0
+        self._gc_start = None
+        self._loop_lag = None
+        gc.callbacks.append(self._gc_callback)
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self._gc_start = perf_counter()
+        elif self._gc_start is not None:
+            self._gc_collections += 1
+            self._gc_pause += perf_counter() - self._gc_start
+            self._gc_start = None
+
+    def close(self):
+        """
+        Stop counting the GC collections and pauses of the process
+        """
+
+        try:
+            gc.callbacks.remove(self._gc_callback)
+        except ValueError:
+            pass
+
+    def start_loop_lag(self, io_loop, interval=1.0):
+        """
+        Start measuring the event loop lag of the IOLoop
+        """
+
+        self._loop_lag = 0.0
+        io_loop.call_later(
+            interval,
+            self._check_loop_lag,
+            io_loop,
+            interval,
+            io_loop.time() + interval,
+        )
+
+    def _check_loop_lag(self, io_loop, interval, expected):
+        cur_time = io_loop.time()
+        self._loop_lag = max(self._loop_lag, cur_time - expected, 0.0)
+        io_loop.call_later(
+            interval,
+            self._check_loop_lag,
+            io_loop,
+            interval,
+            cur_time + interval,
+        )
+
+    def _get_rss_threads(self):
+        try:
+            with open("/proc/self/stat", "rb") as fh:
+                # The process name can contain spaces, the fields follow it
+                fields = fh.read().rsplit(b")", 1)[1].split()
+            return int(fields[21]) * PAGE_SIZE, int(fields[17])
+        except (OSError, IndexError, ValueError):
+            # The max RSS is the best available without procfs
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                maxrss *= 1024
+            return maxrss, threading.active_count()
+
+    def due(self):
+        """
+        Check if the stats are to be reported according to the interval
+        """
+
+        return time() - self._last >= self.interval
+
+    def get(self):
+        """
+        Get the name of the process and its stats,
+        the event loop lag is reset on each call
+        """
+
+        self._last = time()
+        times = os.times()
+        rss, threads = self._get_rss_threads()
+        stats = {
+            "rss": rss,
+            "cpu": times.user + times.system,
+            "threads": threads,
+            "gc_collections": self._gc_collections,
+            "gc_pause": self._gc_pause,
+        }
+        if self._loop_lag is not None:
+            stats["loop_lag"] = self._loop_lag
+            self._loop_lag = 0.0
+        return [self.name, stats]
+
+
+def get_process_stats(opts, name):
+    """
+    Get the stats of the current process if the process metrics are enabled
+    """
+
+    process_metrics = opts.get("process_metrics", {})
+    if not process_metrics.get("enabled", True):
+        return None
+    return ProcessStats(name, process_metrics.get("interval", 10))
@@ -0,0 +1,376 @@
+"""
+The queries of the minions and the jobs tracked by the Data Manager
+
+The REST API processes request the pages of the minions and the jobs
+over the Unix socket served by the threads of the Data Manager, so the queries
+never run in the thread merging the events. The minions are taken
+from the indexes by the status and by the last seen time and the jobs
+from the index by the jid, so the cost of the query depends on the size
+of the page requested. The answers are cached until the next metrics epoch
+is published, the completed jobs cleaned up from the memory are answered
+from the jobs history if it's enabled.
+"""
+
+import logging
+import os
+import socketserver
+import struct
+import threading
+
+import msgpack
+import salt.utils.files
+
+from saline.data.state import load_jid
+
+
+log = logging.getLogger(__name__)
+
+
+# The length prefix of the messages
+MESSAGE_HEADER = struct.Struct(">I")
+
+MINION_STATUSES = ("online", "pending", "offline")
+
+JOB_STATUSES = ("pending", "completed")
+
+RESULT_STATUSES = ("pending", "succeeded", "failed", "timedout")
+
+# The fields of the jobs answered from the memory and from the jobs history
+JOB_FIELDS = (
+    "jid",
+    "fun",
+    "mods",
+    "test",
+    "status",
+    "req_ts",
+    "last_resp_ts",
+    "completed_ts",
+    "minions",
+    "pending",
+    "succeeded",
+    "failed",
+    "timedout",
+)
+
+
+def get_query_path(opts):
+    """
+    Get the path to the socket of the queries of the Data Manager
+    """
+
+    return os.path.join(opts["sock_dir"], "query.ipc")
+
+
+def pack_message(msg):
+    body = msgpack.packb(msg, use_bin_type=True)
+    return MESSAGE_HEADER.pack(len(body)) + body
+
+
+def unpack_message(body):
+    return msgpack.unpackb(body, raw=False)
+
+
+def read_message(fh):
+    """
+    Read the message from the stream or get None if the stream is closed
+    """
+
+    header = fh.read(MESSAGE_HEADER.size)
+    if len(header) < MESSAGE_HEADER.size:
+        return None
+    size = MESSAGE_HEADER.unpack(header)[0]
+    body = fh.read(size)
+    if len(body) < size:
+        return None
+    return unpack_message(body)
+
+
+def _get_param(params, name, convert=str, default=None, choices=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = convert(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid value of '%s': %s" % (name, value))
+    if choices is not None and value not in choices:
+        raise ValueError(
+            "Invalid value of '%s', expected one of: %s" % (name, ", ".join(choices))
+        )
+    return value
+
+
+def _get_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("1", "true", "yes"):
+        return True
+    if str(value).lower() in ("0", "false", "no"):
+        return False
+    raise ValueError(value)
+
+
+def _get_job_info(info, history=False):
+    """
+    Get the summary of the job with the same fields
+    either it's in the memory or in the jobs history
+    """
+
+    if history:
+        info.update(status="completed", test=bool(info["test"]), pending=0)
+    return {field: info.get(field) for field in JOB_FIELDS}
+
+
+class DataQueries:
+    """
+    The queries of the data of the Data Merger with the answers cached
+    per the metrics epoch
+    """
+
+    def __init__(self, datamerger, get_epoch, max_limit=1000, cache_size=1000):
+        self._datamerger = datamerger
+        self._get_epoch = get_epoch
+        self.max_limit = max_limit
+        self.cache_size = cache_size
+        self._cache = {}
+        self._cache_epoch = None
+        self._cache_lock = threading.Lock()
+        self._queries = {
+            "minions": self.query_minions,
+            "minion": self.query_minion,
+            "jobs": self.query_jobs,
+            "job": self.query_job,
+        }
+
+    def run(self, req):
+        """
+        Get the answer of the query request or the error with the HTTP status
+        """
+
+        if not isinstance(req, dict):
+            return {"error": "Invalid query request", "status": 400}
+        query = self._queries.get(req.get("query"))
+        if query is None:
+            return {"error": "Unknown query '%s'" % req.get("query"), "status": 404}
+        params = req.get("params") or {}
+        if not isinstance(params, dict):
+            return {"error": "Invalid query parameters", "status": 400}
+        key = (req["query"], tuple(sorted((k, str(v)) for k, v in params.items())))
+        epoch = self._get_epoch()
+        with self._cache_lock:
+            if epoch != self._cache_epoch:
+                self._cache_epoch = epoch
+                self._cache = {}
+            res = self._cache.get(key)
+        if res is not None:
+            return res
+        try:
+            res = query(params)
+        except ValueError as exc:
+            return {"error": str(exc), "status": 400}
+        except Exception as exc:  # pylint: disable=broad-except
+            log.exception("Unable to run the query: %s", req)
+            return {"error": str(exc), "status": 500}
+        if res is None:
+            res = {"error": "Not found", "status": 404}
+        else:
+            res = {"result": res, "epoch": epoch}
+        with self._cache_lock:
+            if epoch == self._cache_epoch:
+                if len(self._cache) >= self.cache_size:
+                    # The oldest answer is evicted
+                    del self._cache[next(iter(self._cache))]
+                self._cache[key] = res
+        return res
+
+    def _get_page(self, params):
+        offset = _get_param(params, "offset", int, 0)
+        limit = _get_param(params, "limit", int, 100)
+        if offset < 0 or limit <= 0:
+            raise ValueError("The offset and the limit are expected to be positive")
+        return offset, min(limit, self.max_limit)
+
+    @staticmethod
+    def _page(items, key, offset, limit, more):
+        return {
+            key: items,
+            "offset": offset,
+            "limit": limit,
+            "next": offset + limit if more else None,
+        }
+
+    def query_minions(self, params):
+        offset, limit = self._get_page(params)
+        minions, more = self._datamerger.minions.query(
+            status=_get_param(params, "status", choices=MINION_STATUSES),
+            group=_get_param(params, "group"),
+            seen_after=_get_param(params, "seen_after", float),
+            offset=offset,
+            limit=limit,
+        )
+        return self._page(minions, "minions", offset, limit, more)
+
+    def query_minion(self, params):
+        return self._datamerger.minions.get_info(_get_param(params, "id"))
+
+    def query_jobs(self, params):
+        offset, limit = self._get_page(params)
+        fun = _get_param(params, "fun")
+        mods = _get_param(params, "mods")
+        minion = _get_param(params, "minion")
+        since = _get_param(params, "since", float)
+        history = self._datamerger.history
+        if _get_param(params, "history", _get_bool, False):
+            if history is None:
+                raise ValueError("The jobs history is not enabled")
+            jobs = history.get_jobs(
+                fun=fun,
+                mods=mods,
+                minion=minion,
+                since=since,
+                limit=limit + 1,
+                offset=offset,
+            )
+            jobs = [_get_job_info(job, history=True) for job in jobs]
+            return self._page(jobs[:limit], "jobs", offset, limit, len(jobs) > limit)
+        jobs, more = self._datamerger.jobs.query(
+            fun=fun,
+            mods=mods,
+            test=_get_param(params, "test", _get_bool),
+            status=_get_param(params, "status", choices=JOB_STATUSES),
+            since=since,
+            minion=minion,
+            offset=offset,
+            limit=limit,
+        )
+        return self._page(
+            [_get_job_info(job) for job in jobs], "jobs", offset, limit, more
+        )
+
+    def query_job(self, params):
+        offset, limit = self._get_page(params)
+        jid = load_jid(_get_param(params, "jid"))
+        minion = _get_param(params, "minion")
+        status = _get_param(params, "status", choices=RESULT_STATUSES)
+        job_info = self._datamerger.jobs.get_job_info(jid)
+        if job_info is not None:
+            info, job = job_info
+            results, more = job.get_minions_results(
+                status=status, minion=minion, offset=offset, limit=limit
+            )
+            res = self._page(
+                [
+                    {"minion": name, "status": result, "ts": ts}
+                    for name, result, ts in results
+                ],
+                "results",
+                offset,
+                limit,
+                more,
+            )
+            res["job"] = _get_job_info(info)
+            return res
+        history = self._datamerger.history
+        if history is None:
+            return None
+        info = history.get_job(jid)
+        if info is None:
+            return None
+        results = history.get_job_results(
+            jid, minion=minion, status=status, limit=limit + 1, offset=offset
+        )
+        res = self._page(
+            results[:limit], "results", offset, limit, len(results) > limit
+        )
+        res["job"] = _get_job_info(info, history=True)
+        return res
+
+
+class _QueryRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # The connection is kept open for the next requests of the client
+        while True:
+            try:
+                req = read_message(self.rfile)
+            except (OSError, ValueError) as exc:
+                log.debug("Unable to read the query request: %s", exc)
+                return
+            if req is None:
+                return
+            try:
+                self.wfile.write(pack_message(self.server.queries.run(req)))
+            except OSError as exc:
+                log.debug("Unable to write the query answer: %s", exc)
+                return
+
+
+class QueryServer:
+    """
+    The server of the queries on the Unix socket
+    handling each connection in the separate thread
+    """
+
+    def __init__(self, path, queries):
+        self.path = path
+        self.queries = queries
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start the thread accepting the connections
+        """
+
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            with salt.utils.files.set_umask(0o177):
+                self._server = socketserver.ThreadingUnixStreamServer(
+                    self.path, _QueryRequestHandler
+                )
+        except OSError as exc:
+            log.error("Unable to start the query server on %s: %s", self.path, exc)
+            return False
+        self._server.daemon_threads = True
+        self._server.queries = self.queries
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stop accepting the connections and remove the socket
+        """
+
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._thread = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def get_query_server(opts, datamerger, get_epoch):
+    """
+    Get the started query server if the query API is enabled
+    """
+
+    query_opts = opts.get("query_api", {})
+    if not query_opts.get("enabled", False):
+        return None
+    server = QueryServer(
+        get_query_path(opts),
+        DataQueries(
+            datamerger,
+            get_epoch,
+            max_limit=query_opts.get("max_limit", 1000),
+            cache_size=query_opts.get("cache_size", 1000),
+        ),
+    )
+    if not server.start():
+        return None
+    return server
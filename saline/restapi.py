@@ -1,30 +1,134 @@
+import gzip
+import hmac
 import logging
 import os
+import socket
 import ssl
 import tornado
+import tornado.gen
 import tornado.log
+import tornado.process
 import tornado.web
 
+from datetime import timedelta
 from threading import Thread
 from time import time, sleep
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 
-from tornado.iostream import StreamClosedError
-from salt.transport.ipc import IPCMessageSubscriber
+from tornado.iostream import IOStream, StreamClosedError
+from salt.ext.tornado.gen import coroutine
+from salt.transport.ipc import IPCMessageClient, IPCMessageSubscriber
 from salt.utils.asynchronous import current_ioloop as ctx_current_ioloop
 
+from saline.data.exposition import (
+    CONTENT_TYPES,
+    FORMAT_NAMES,
+    FORMAT_TEXT,
+    MetricsTable,
+    get_metrics_formats,
+    negotiate_format,
+)
+from saline.data.metrics import get_metrics_groups
+from saline.debug import (
+    PROFILE_FORMATS,
+    PROFILE_MAX_SECONDS,
+    cancel_debug,
+    get_debug_result,
+    install_debug_control,
+    request_debug,
+)
+from saline.procstats import get_process_stats
+from saline.query import MESSAGE_HEADER, get_query_path, pack_message, unpack_message
+from saline.shared import SharedBufferReader
+
 log = logging.getLogger(__name__)
 
 
+def get_metrics_shared_path(opts, group=None):
+    """
+    Get the path to the shared buffer of the metrics of the scrape group
+    """
+
+    if group is None:
+        return os.path.join(opts["sock_dir"], "metrics.shm")
+    return os.path.join(opts["sock_dir"], f"metrics.{group}.shm")
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Check if the gzip encoding is acceptable with the Accept-Encoding header
+    """
+
+    gzip_q = None
+    any_q = None
+    for coding in (accept_encoding or "").split(","):
+        name, *params = coding.split(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if name in ("gzip", "x-gzip"):
+            gzip_q = q
+        elif name == "*":
+            any_q = q
+    if gzip_q is None:
+        gzip_q = any_q
+    return gzip_q is not None and gzip_q > 0
+
+
 class SalineChannels:
     def __init__(self, opts):
         self.opts = opts
-        self.metrics_buf = None
+        self.metrics_connected = False
         self.metrics_last = None
         self.metrics_timeout = opts.get("metrics_timeout", 120)
+        self.metrics_groups = get_metrics_groups(opts.get("metrics_groups"))
+        self.metrics_table = MetricsTable(groups=self.metrics_groups)
+        self.metrics_formats = get_metrics_formats(opts.get("metrics_formats"))
+        self.metrics_readers = None
+        self._resync_last = 0
+        self.process_name = None
+        self.process_stats = None
+        # The gzip compressed buffers and their ETags
+        # by the scrape groups and the exposition formats
+        self._gzip_bufs = {}
+        query_opts = opts.get("query_api", {})
+        self.query_enabled = query_opts.get("enabled", False)
+        self.query_timeout = query_opts.get("timeout", 10)
+        # The connections to the query server not used by the running queries
+        self._query_streams = []
 
     def run_channels(self):
         self.io_loop = IOLoop.current()
+        self.control_uri = os.path.join(self.opts["sock_dir"], "control.ipc")
+        with ctx_current_ioloop(self.io_loop):
+            self.control = IPCMessageClient(self.control_uri, io_loop=self.io_loop)
+        task_id = tornado.process.task_id()
+        self.process_name = "TornadoSrv" if task_id is None else f"TornadoSrv-{task_id}"
+        install_debug_control(self.opts, self.process_name)
+        if self.process_stats is not None:
+            # The GC of the process is not to be counted twice
+            self.process_stats.close()
+        self.process_stats = get_process_stats(self.opts, self.process_name)
+        if self.process_stats is not None:
+            self.process_stats.start_loop_lag(self.io_loop)
+            PeriodicCallback(
+                self.report_process_stats, self.process_stats.interval * 1000
+            ).start()
+        if self.opts.get("metrics_shared_buffer", False):
+            # The metrics are read from the buffer shared by all the processes
+            # instead of maintaining the copy in each of them
+            self.metrics_readers = {
+                group: SharedBufferReader(get_metrics_shared_path(self.opts, group))
+                for group in (None, *self.metrics_groups)
+            }
+            self.metrics_last = time()
+            return
         self.pub_uri = os.path.join(self.opts["sock_dir"], "publisher.ipc")
         with ctx_current_ioloop(self.io_loop):
             self.subscriber = IPCMessageSubscriber(self.pub_uri, io_loop=self.io_loop)
@@ -39,36 +143,336 @@ class SalineChannels:
 
     def channel_connected(self, _):
         log.debug("Connected to Saline publisher channel")
-        self.metrics_buf = ""
+        self.metrics_connected = True
         self.metrics_last = time()
+        self.request_resync()
+
+    @coroutine
+    def _send_control(self, msg):
+        try:
+            yield self.control.send(msg)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error("Unable to send the message to Saline control channel: %s", exc)
+
+    def request_resync(self):
+        # Limit the rate of requests as the deltas can be received
+        # before the snapshot requested previously
+        cur_time = time()
+        if cur_time - self._resync_last < 5:
+            return
+        self._resync_last = cur_time
+        # The snapshot is sent to the requesting process only
+        self.io_loop.spawn_callback(
+            self._send_control, {"resync": self.process_name or True}
+        )
+
+    def report_process_stats(self):
+        # The stats of the process are reported via the control channel
+        # as the REST API processes don't pass the events to the Data Manager
+        self.io_loop.spawn_callback(
+            self._send_control, {"process": self.process_stats.get()}
+        )
 
     def channel_event_handler(self, raw):
         log.trace("Received from Saline publisher: %s", raw)
-        if "metrics" in raw:
-            self.metrics_buf = raw["metrics"]
-            self.metrics_last = time()
+        if "metrics_snapshot" in raw:
+            to = raw["metrics_snapshot"].get("to")
+            if to is not None and self.process_name not in to:
+                # The snapshot requested by the other process
+                return
+            self.metrics_table.apply_snapshot(
+                raw["metrics_snapshot"]["seq"],
+                raw["metrics_snapshot"]["metrics"],
+                etag=raw["metrics_snapshot"].get("etag"),
+            )
+        elif "metrics_delta" in raw:
+            if not self.metrics_table.apply_delta(
+                raw["metrics_delta"]["seq"],
+                raw["metrics_delta"]["metrics"],
+                etag=raw["metrics_delta"].get("etag"),
+            ):
+                log.debug(
+                    "Unexpected metrics delta sequence number %s after %s",
+                    raw["metrics_delta"]["seq"],
+                    self.metrics_table.seq,
+                )
+                self.request_resync()
+                return
+        else:
+            return
+        self.metrics_last = time()
+
+    def has_metrics_group(self, group):
+        return group is None or group in self.metrics_groups
+
+    def get_metrics_format(self, accept):
+        """
+        Get the exposition format negotiated with the Accept header
+        """
+
+        if self.metrics_readers is not None:
+            # Only the text format is rendered to the shared buffers
+            return FORMAT_TEXT
+        return negotiate_format(accept, self.metrics_formats)
+
+    def _get_metrics_etag(self, etag, fmt):
+        if not etag or fmt == FORMAT_TEXT:
+            return etag or None
+        return '%s-%s"' % (etag[:-1], FORMAT_NAMES[fmt])
+
+    def get_metrics_state(self, group=None, fmt=FORMAT_TEXT):
+        """
+        Get the time of the last update and the ETag of the metrics
+        of the scrape group in the exposition format
+        """
+
+        if self.metrics_readers is not None:
+            updated, etag = self.metrics_readers[group].read_header()
+            if updated is not None:
+                return updated, self._get_metrics_etag(etag, fmt)
+            return self.metrics_last, None
+        if not self.metrics_connected:
+            return self.metrics_last, None
+        return (
+            self.metrics_last,
+            self._get_metrics_etag(self.metrics_table.get_etag(group), fmt),
+        )
+
+    def get_metrics(self, group=None, fmt=FORMAT_TEXT, compress=False):
+        """
+        Get the rendered metrics of the scrape group in the exposition format,
+        the gzip compressed metrics are compressed once per update
+        """
+
+        if self.metrics_readers is not None:
+            buf, _, etag = self.metrics_readers[group].read()
+        elif self.metrics_connected:
+            buf = self.metrics_table.get_buf(group, fmt)
+            etag = self.metrics_table.get_etag(group)
+        else:
+            buf, etag = None, None
+        if buf is None or not compress:
+            return buf
+        if etag and (group, fmt) in self._gzip_bufs:
+            gzip_etag, gzip_buf = self._gzip_bufs[(group, fmt)]
+            if etag == gzip_etag:
+                return gzip_buf
+        if isinstance(buf, str):
+            buf = buf.encode()
+        gzip_buf = gzip.compress(buf, compresslevel=6)
+        if etag:
+            self._gzip_bufs[(group, fmt)] = (etag, gzip_buf)
+        return gzip_buf
+
+    async def _query(self, msg):
+        while True:
+            stream = self._query_streams.pop() if self._query_streams else None
+            reused = stream is not None
+            if stream is None:
+                stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+                await stream.connect(get_query_path(self.opts))
+            try:
+                await stream.write(msg)
+                header = await stream.read_bytes(MESSAGE_HEADER.size)
+                body = await stream.read_bytes(MESSAGE_HEADER.unpack(header)[0])
+            except StreamClosedError:
+                if reused:
+                    # The connection kept was closed by the Data Manager restarted
+                    continue
+                raise
+            # The connection is reused by the next queries once the answer is read
+            self._query_streams.append(stream)
+            return unpack_message(body)
+
+    async def query(self, query, params):
+        """
+        Get the answer of the query of the Data Manager
+        """
+
+        return await tornado.gen.with_timeout(
+            timedelta(seconds=self.query_timeout),
+            self._query(pack_message({"query": query, "params": params})),
+        )
 
 
 class MetricsHandler(tornado.web.RequestHandler):  # pylint: disable=W0223
-    def get(self, _):  # pylint: disable=arguments-differ
-        if (
-            time() - self.application.channels.metrics_last
-            > self.application.channels.metrics_timeout
-        ):
+    def compute_etag(self):
+        # The ETag is set from the metrics update instead of hashing the body
+        return None
+
+    def get(self, path):  # pylint: disable=arguments-differ
+        channels = self.application.channels
+        group = (path.strip("/") or None) if path else None
+        if not channels.has_metrics_group(group):
+            self.send_error(404)
+            return
+        fmt = channels.get_metrics_format(self.request.headers.get("Accept"))
+        metrics_last, metrics_etag = channels.get_metrics_state(group, fmt)
+        if time() - metrics_last > channels.metrics_timeout:
             log.error(
                 "No metrics update for more than %s sec.",
-                self.application.channels.metrics_timeout,
+                channels.metrics_timeout,
             )
             self.send_error(500)
             return
-        elif self.application.channels.metrics_buf is not None:
-            self.set_header("Cache-Control", "no-cache")
-            self.set_header("Content-Type", "text/plain;version=0.0.4;charset=utf-8")
-            self.write(self.application.channels.metrics_buf)
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Content-Type", CONTENT_TYPES[fmt])
+        self.set_header("Vary", "Accept, Accept-Encoding")
+        compress = accepts_gzip(self.request.headers.get("Accept-Encoding"))
+        if metrics_etag is not None:
+            if compress:
+                # The compressed body is the different representation
+                metrics_etag = '%s-gzip"' % metrics_etag[:-1]
+            self.set_header("Etag", metrics_etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+                return
+        metrics_buf = channels.get_metrics(group, fmt, compress=compress)
+        if metrics_buf is not None:
+            if compress:
+                self.set_header("Content-Encoding", "gzip")
+            self.write(metrics_buf)
 
         self.finish()
 
 
+class DebugHandler(tornado.web.RequestHandler):  # pylint: disable=W0223
+    """
+    The base of the diagnostic endpoints available with the debug token only
+    """
+
+    def prepare(self):
+        debug_token = self.application.debug_token
+        if not debug_token:
+            # The diagnostic endpoints are disabled without the token
+            self.send_error(404)
+            return
+        scheme, _, token = self.request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            token.strip().encode(), debug_token.encode()
+        ):
+            self.set_status(401)
+            self.set_header("WWW-Authenticate", 'Bearer realm="saline"')
+            self.finish()
+            return
+        self.request.saline_user = "debug"
+
+    async def run_debug(self, action, params, timeout, content_type="text/plain"):
+        """
+        Request the diagnostic action of the process and wait for the result
+        """
+
+        opts = self.application.channels.opts
+        process = self.get_argument("process", "DataManager")
+        req_id = request_debug(opts, process, action, params)
+        if req_id is None:
+            self.send_error(404)
+            return
+        deadline = time() + timeout
+        while True:
+            res = get_debug_result(opts, req_id)
+            if res is not None:
+                break
+            if time() > deadline:
+                log.error("No result of %s of %s in %s sec.", action, process, timeout)
+                cancel_debug(opts, process, req_id)
+                self.send_error(504)
+                return
+            await tornado.gen.sleep(0.5)
+        self.set_header("Cache-Control", "no-cache")
+        if "error" in res:
+            self.set_header("Content-Type", "text/plain;charset=utf-8")
+            self.set_status(400)
+            self.finish(res["error"])
+            return
+        self.set_header("Content-Type", f"{content_type};charset=utf-8")
+        self.finish(res["output"])
+
+
+class ProfileHandler(DebugHandler):  # pylint: disable=W0223
+    async def get(self):  # pylint: disable=arguments-differ
+        try:
+            seconds = min(float(self.get_argument("seconds", 10)), PROFILE_MAX_SECONDS)
+        except ValueError:
+            self.send_error(400)
+            return
+        params = {
+            "seconds": seconds,
+            "interval": self.get_argument("interval", 0.01),
+            "format": self.get_argument("format", "collapsed"),
+        }
+        if params["format"] not in PROFILE_FORMATS:
+            self.send_error(400)
+            return
+        await self.run_debug("profile", params, seconds + 30)
+
+
+class MemoryHandler(DebugHandler):  # pylint: disable=W0223
+    async def get(self):  # pylint: disable=arguments-differ
+        try:
+            limit = int(self.get_argument("tracemalloc", 0))
+            seconds = min(float(self.get_argument("seconds", 10)), PROFILE_MAX_SECONDS)
+        except ValueError:
+            self.send_error(400)
+            return
+        await self.run_debug(
+            "memory",
+            {"tracemalloc": limit, "seconds": seconds},
+            (seconds if limit > 0 else 0) + 60,
+            content_type="application/json",
+        )
+
+
+class QueryHandler(tornado.web.RequestHandler):  # pylint: disable=W0223
+    """
+    The base of the JSON API answered by the queries of the Data Manager
+    """
+
+    def prepare(self):
+        if not self.application.channels.query_enabled:
+            self.send_error(404)
+
+    async def run_query(self, query, **params):
+        channels = self.application.channels
+        for name in self.request.arguments:
+            params.setdefault(name, self.get_argument(name))
+        try:
+            res = await channels.query(query, params)
+        except tornado.gen.TimeoutError:
+            log.error(
+                "No answer of the query %s in %s sec.", query, channels.query_timeout
+            )
+            self.send_error(504)
+            return
+        except (OSError, StreamClosedError) as exc:
+            log.error("Unable to query the Data Manager: %s", exc)
+            self.send_error(503)
+            return
+        self.set_header("Cache-Control", "no-cache")
+        if "error" in res:
+            self.set_status(res.get("status", 400))
+            self.finish({"error": res["error"]})
+            return
+        self.finish(res["result"])
+
+
+class MinionsQueryHandler(QueryHandler):  # pylint: disable=W0223
+    async def get(self, minion_id=None):  # pylint: disable=arguments-differ
+        if minion_id is None:
+            await self.run_query("minions")
+        else:
+            await self.run_query("minion", id=minion_id)
+
+
+class JobsQueryHandler(QueryHandler):  # pylint: disable=W0223
+    async def get(self, jid=None):  # pylint: disable=arguments-differ
+        if jid is None:
+            await self.run_query("jobs")
+        else:
+            await self.run_query("job", jid=jid)
+
+
 def get_app(opts):
     """
     Returns a Tornado Web APP
@@ -78,6 +482,10 @@ def get_app(opts):
 
     paths = [
         (r"/metrics(/.*)?", MetricsHandler),
+        (r"/debug/profile", ProfileHandler),
+        (r"/debug/memory", MemoryHandler),
+        (r"/api/minions(?:/([^/]+))?/?", MinionsQueryHandler),
+        (r"/api/jobs(?:/([^/]+))?/?", JobsQueryHandler),
     ]
 
     access_log = logging.getLogger("tornado.access")
@@ -137,6 +545,8 @@ def get_app(opts):
     )
 
     app.channels = SalineChannels(opts)
+    # The token required to access the diagnostic endpoints
+    app.debug_token = restapi_opts.get("debug_token")
 
     return app
 
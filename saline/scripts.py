@@ -16,3 +16,13 @@ def saline_daemon():
 
     saline = saline.daemon.Saline()
     saline.start()
+
+
+def saline_bench():
+    """
+    Run the load generator against the running Saline.
+    """
+
+    import saline.bench.load
+
+    saline.bench.load.main()
@@ -0,0 +1,211 @@
+import logging
+import mmap
+import os
+import struct
+
+from time import time
+
+import salt.utils.files
+
+
+log = logging.getLogger(__name__)
+
+
+class SharedBuffer:
+    """
+    The double buffered memory mapped file shared between the processes
+
+    The header contains the generation counter which is odd while the header
+    is being updated, the time of the last update, the tag of the data,
+    the index of the active slot and the lengths of the data in the slots. The data is written to the
+    inactive slot and then the slot is activated, so the readers can read
+    the active slot without locking.
+    """
+
+    MAGIC = b"SALINESB"
+    # magic, generation, updated, tag, active slot, reopen flag, slot size, lengths
+    HEADER = struct.Struct("<8sQd32sIIQQQ")
+    HEADER_SIZE = 128
+    MIN_SLOT_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._mm = None
+
+    def _read_header(self):
+        return self.HEADER.unpack_from(self._mm, 0)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class SharedBufferWriter(SharedBuffer):
+    def __init__(self, path):
+        super().__init__(path)
+        self._generation = 0
+        self._active = 1
+        self._slot_size = 0
+        self._lengths = [0, 0]
+        self._tag = b""
+
+    def _write_header(self, mm=None, reopen=0):
+        self.HEADER.pack_into(
+            self._mm if mm is None else mm,
+            0,
+            self.MAGIC,
+            self._generation,
+            time(),
+            self._tag,
+            self._active,
+            reopen,
+            self._slot_size,
+            *self._lengths,
+        )
+
+    def _create(self, slot_size):
+        old_mm = self._mm
+        old_fh = self._fh
+        self._slot_size = slot_size
+        self._lengths = [0, 0]
+        tmp_path = "%s.tmp" % self.path
+        with salt.utils.files.set_umask(0o177):
+            self._fh = open(tmp_path, "w+b")
+        self._fh.truncate(self.HEADER_SIZE + 2 * slot_size)
+        self._mm = mmap.mmap(self._fh.fileno(), 0)
+        self._write_header()
+        os.rename(tmp_path, self.path)
+        if old_mm is not None:
+            # Tell the readers of the old file to open the new one
+            self._write_header(mm=old_mm, reopen=1)
+            old_mm.close()
+            old_fh.close()
+
+    def get_tag(self):
+        return self._tag
+
+    def is_written(self, data):
+        """
+        Check if the data is the same as in the active slot
+        """
+
+        if self._mm is None or self._lengths[self._active] != len(data):
+            return False
+        offset = self.HEADER_SIZE + self._active * self._slot_size
+        with memoryview(self._mm) as mv:
+            return mv[offset : offset + len(data)] == data
+
+    def touch(self):
+        """
+        Refresh the time of the last update keeping the data written
+        """
+
+        if self._mm is None:
+            return False
+        self._generation += 1
+        self._write_header()
+        self._generation += 1
+        self._write_header()
+        return True
+
+    def write(self, data, tag=b""):
+        """
+        Write the data to the inactive slot and activate it
+        """
+
+        if self._mm is None or len(data) > self._slot_size:
+            self._create(max(len(data) * 2, self.MIN_SLOT_SIZE))
+        slot = 1 - self._active
+        offset = self.HEADER_SIZE + slot * self._slot_size
+        self._mm[offset : offset + len(data)] = data
+        self._lengths[slot] = len(data)
+        self._generation += 1
+        self._write_header()
+        self._active = slot
+        self._tag = tag
+        self._generation += 1
+        self._write_header()
+
+    def close(self):
+        if self._mm is not None:
+            # Tell the readers to open the file created by the next writer
+            self._write_header(reopen=1)
+        super().close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class SharedBufferReader(SharedBuffer):
+    def _open(self):
+        self.close()
+        try:
+            self._fh = open(self.path, "rb")
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            log.debug("Unable to open the shared buffer %s: %s", self.path, exc)
+            self.close()
+            return False
+        return True
+
+    def _is_replaced(self):
+        """
+        Check if the file opened was replaced or removed
+        by the writer not able to tell it with the header
+        """
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        opened = os.fstat(self._fh.fileno())
+        return (st.st_ino, st.st_dev) != (opened.st_ino, opened.st_dev)
+
+    def read_header(self, retries=10):
+        """
+        Get the time of the last update and the tag without reading the data
+        """
+
+        for _ in range(retries):
+            if self._mm is None and not self._open():
+                return None, None
+            magic, gen, updated, tag, _, reopen, _, _, _ = self._read_header()
+            if magic != self.MAGIC:
+                return None, None
+            if reopen or self._is_replaced():
+                self._open()
+                continue
+            if gen % 2 == 0 and self._read_header()[1] == gen:
+                return updated, tag.rstrip(b"\0").decode()
+        return None, None
+
+    def read(self, retries=10):
+        """
+        Get the data of the active slot, the time of the last update and the tag
+        """
+
+        for _ in range(retries):
+            if self._mm is None and not self._open():
+                return None, None, None
+            magic, gen, updated, tag, active, reopen, slot_size, *lengths = (
+                self._read_header()
+            )
+            if magic != self.MAGIC:
+                return None, None, None
+            if reopen or self._is_replaced():
+                self._open()
+                continue
+            if gen % 2:
+                continue
+            offset = self.HEADER_SIZE + active * slot_size
+            data = self._mm[offset : offset + lengths[active]]
+            # The slot is not overwritten until the other slot is activated
+            if self._read_header()[1] - gen < 2:
+                return data, updated, tag.rstrip(b"\0").decode()
+        return None, None, None
@@ -0,0 +1,213 @@
+"""
+The snapshot of the state of the merged data to restore on restart
+
+The state of the metrics, the minions, the state jobs and the merging rules
+is written by the Data Manager periodically and on stopping to the single
+file with the versioned header and the compressed msgpack body.
+The state is copied while the merging is paused with the lock
+and written by the background thread, the file is replaced atomically,
+so the previous snapshot is kept if writing is interrupted.
+"""
+
+import contextlib
+import gc
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from time import perf_counter, time
+
+import msgpack
+import salt.syspaths
+import salt.utils.files
+
+
+log = logging.getLogger(__name__)
+
+
+SNAPSHOT_MAGIC = b"SALINESS"
+
+# The version of the format of the state to increase on incompatible changes
+SNAPSHOT_VERSION = 2
+
+# The magic, the version of the format and the time of taking the snapshot
+SNAPSHOT_HEADER = struct.Struct(">8sHd")
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Pause the garbage collection while the state is copied or restored,
+    the collections triggered by allocating the millions of the objects
+    would take most of the time
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def write_snapshot(path, state, ts=None):
+    """
+    Write the state to the snapshot file replacing it atomically
+    """
+
+    if ts is None:
+        ts = time()
+    body = zlib.compress(msgpack.packb(state, use_bin_type=True), 1)
+    tmp_path = "%s.tmp" % path
+    with salt.utils.files.set_umask(0o177):
+        with open(tmp_path, "wb") as fh:
+            fh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, ts))
+            fh.write(body)
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.rename(tmp_path, path)
+    return len(body) + SNAPSHOT_HEADER.size
+
+
+def read_snapshot(path):
+    """
+    Read the state and the time of taking it from the snapshot file,
+    None is returned if the file is missing or has the different version
+    """
+
+    try:
+        with open(path, "rb") as fh:
+            header = fh.read(SNAPSHOT_HEADER.size)
+            body = fh.read()
+    except FileNotFoundError:
+        return None
+    if len(header) < SNAPSHOT_HEADER.size:
+        log.warning("The state snapshot %s is truncated", path)
+        return None
+    magic, version, ts = SNAPSHOT_HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC:
+        log.warning("The file %s is not a state snapshot", path)
+        return None
+    if version != SNAPSHOT_VERSION:
+        log.warning(
+            "The state snapshot %s has the unsupported version %d", path, version
+        )
+        return None
+    return msgpack.unpackb(zlib.decompress(body), raw=False), ts
+
+
+class StateSnapshot:
+    """
+    The writer of the periodic snapshots of the state of the Data Merger
+    """
+
+    def __init__(self, path, datamerger, lock, interval=300):
+        self.path = path
+        self.interval = interval
+        self._datamerger = datamerger
+        # The lock pausing the changes of the data while the state is copied
+        self._lock = lock
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Restore the state of the Data Merger from the snapshot if it exists
+        """
+
+        start = perf_counter()
+        try:
+            with gc_paused():
+                snapshot = read_snapshot(self.path)
+                if snapshot is None:
+                    return False
+                state, ts = snapshot
+                with self._lock:
+                    self._datamerger.set_state(state)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error("Unable to restore the state snapshot %s: %s", self.path, exc)
+            return False
+        log.info(
+            "Restored the state snapshot taken %.0f seconds ago in %.3f sec.",
+            time() - ts,
+            perf_counter() - start,
+        )
+        return True
+
+    def save(self):
+        """
+        Copy the state of the Data Merger and write it to the snapshot
+        """
+
+        start = perf_counter()
+        ts = time()
+        try:
+            with gc_paused(), self._lock:
+                state = self._datamerger.get_state()
+            copied = perf_counter() - start
+            size = write_snapshot(self.path, state, ts)
+        except (OSError, TypeError, ValueError, OverflowError) as exc:
+            log.error("Unable to write the state snapshot %s: %s", self.path, exc)
+            return False
+        log.debug(
+            "Written the state snapshot of %d bytes in %.3f sec. (copied in %.3f sec.)",
+            size,
+            perf_counter() - start,
+            copied,
+        )
+        return True
+
+    def start(self):
+        """
+        Start the thread writing the snapshots periodically
+        """
+
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o750, exist_ok=True)
+        except OSError as exc:
+            log.error("Unable to create the state snapshot directory: %s", exc)
+            return False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=30):
+        """
+        Stop the thread and write the final snapshot
+        """
+
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            log.warning("The final state snapshot was not written in time")
+        self._thread = None
+
+    def _writer(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+        # The final snapshot is written by the thread to keep the signal
+        # handler of the process from blocking on the locks it could hold
+        self.save()
+
+
+def get_state_snapshot(opts, datamerger, lock):
+    """
+    Get the state snapshot of the Data Merger if it's enabled
+    """
+
+    snapshot_opts = opts.get("state_snapshot", {})
+    if not snapshot_opts.get("enabled", False):
+        return None
+    return StateSnapshot(
+        snapshot_opts.get(
+            "path", os.path.join(salt.syspaths.CACHE_DIR, "saline", "state.snapshot")
+        ),
+        datamerger,
+        lock,
+        interval=snapshot_opts.get("interval", 300),
+    )
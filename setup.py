@@ -31,5 +31,5 @@ setup(
     version=str(Version(get_saline_version())),
     packages=find_packages(),
     license="Apache-2.0",
-    scripts=["salined"],
+    scripts=["salined", "saline-bench"],
 )